@@ -44,6 +44,7 @@
     "write_npy": None,
     "write_visual_hull": None,
     "use_npy": False,
+    "build_npy_only": False,
     "data_split_seed": None,
     "valid_exp": None,
     "norm_method":"layer",
@@ -52,7 +53,11 @@
     "predict_labeled_only": False,
     "training_fraction": None,
     "custom_model": None,
-    "label3d_index": 0
+    "label3d_index": 0,
+    "frame_cache_mb": 0,
+    "frame_prefetch_depth": 0,
+    "use_keyframe_index": False,
+    "frame_store_dir": None,
 }
 _param_defaults_dannce = {
     "dataset": "label3d",
@@ -119,7 +124,23 @@
     "inference_ttt": None,
     ## augmentation
     "form_batch": False,
-    "form_bs": None
+    "form_bs": None,
+    "decode_processes": 0,
+    "generator_device": None,
+    "generator_threads": None,
+    "device_inference": False,
+    "compact_grids": False,
+    "max_targets_on_device": False,
+    "mip_sampling": False,
+    "inference_workers": 0,
+    "inference_max_batches": 4,
+    "predict_topk": 0,
+    "debug_max_tifdir": None,
+    "debug_max_interval": 100,
+    "save_heatmaps": False,
+    "heatmap_encoding": None,
+    "heatmap_topk": 64,
+    "resume_predictions": False,
 }
 _param_defaults_com = {
     "dsmode": "nn",
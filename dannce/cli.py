@@ -282,6 +282,33 @@ def add_shared_args(
         type=int,
     )
 
+    parser.add_argument(
+        "--frame-cache-mb",
+        dest="frame_cache_mb",
+        type=float,
+        help="Memory budget (MB) of the decoded video frame cache shared by all generators. 0 disables the cache.",
+    )
+
+    parser.add_argument(
+        "--frame-prefetch-depth",
+        dest="frame_prefetch_depth",
+        type=int,
+        help="Number of video frames per camera decoded ahead in background threads during prediction. 0 disables prefetching.",
+    )
+
+    parser.add_argument(
+        "--use-keyframe-index",
+        dest="use_keyframe_index",
+        type=ast.literal_eval,
+        help="If True, index the keyframes of each video (requires ffprobe) into a sidecar file and use it to seek to frames. All videos are indexed before training starts; prediction reads videos with imageio and does not use the index.",
+    )
+
+    parser.add_argument(
+        "--frame-store-dir",
+        dest="frame_store_dir",
+        help="Directory of labeled frames pre-extracted from the videos as memory-mapped arrays. Extracted on first use, then read instead of decoding the videos during training.",
+    )
+
     return parser
 
 
@@ -477,7 +504,13 @@ def add_dannce_shared_args(
     parser.add_argument(
         "--interp",
         dest="interp",
-        help="Voxel interpolation for 3D grid. Linear or nearest.",
+        help="Voxel interpolation for 3D grid. Linear, nearest, grid_sample (same result as linear, using torch.nn.functional.grid_sample), or bilinear_exact (standard bilinear weights; models trained with linear or grid_sample may need retraining).",
+    )
+    parser.add_argument(
+        "--mip-sampling",
+        dest="mip_sampling",
+        type=ast.literal_eval,
+        help="If True, sample each camera from the level of an image pyramid whose pixel size best matches the projected voxel size, reducing aliasing when voxels span several pixels.",
     )
     parser.add_argument(
         "--depth",
@@ -532,6 +565,32 @@ def add_dannce_shared_args(
         dest="dannce_finetune_weights",
         help="Path to weights of initial model for dannce fine tuning.",
     )
+    parser.add_argument(
+        "--decode-processes",
+        dest="decode_processes",
+        type=int,
+        help="If > 0, decode video frames in this many worker processes per camera, sharing frames through shared memory, instead of in threads. Set --frame-prefetch-depth to keep several frames per camera in flight.",
+    )
+
+    parser.add_argument(
+        "--generator-device",
+        dest="generator_device",
+        help="Device used to generate input volumes, 'cuda' or 'cpu'. Defaults to the GPU if one is available.",
+    )
+
+    parser.add_argument(
+        "--compact-grids",
+        dest="compact_grids",
+        type=ast.literal_eval,
+        help="If True, voxel grids are kept as the COM of each grid only, both in memory and in npy grid volumes, and the full voxel grid is rebuilt when loaded.",
+    )
+
+    parser.add_argument(
+        "--generator-threads",
+        dest="generator_threads",
+        type=int,
+        help="Number of torch threads used when generating volumes on the CPU.",
+    )
 
     parser.add_argument(
         "--use-silhouette",
@@ -606,6 +665,12 @@ def add_dannce_train_args(
         type=ast.literal_eval,
         help="If True, loads training data from npy files",
     )
+    parser.add_argument(
+        "--build-npy-only",
+        dest="build_npy_only",
+        type=ast.literal_eval,
+        help="If True, writes the missing npy volumes (requires use_npy) and exits without training. Does not require a GPU.",
+    )
     parser.add_argument(
         "--rand-view-replace",
         dest="rand_view_replace",
@@ -636,6 +701,12 @@ def add_dannce_train_args(
         type=float,
         help="Sets the weight on the heatmap regularization term in the objective function.",
     )
+    parser.add_argument(
+        "--max-targets-on-device",
+        dest="max_targets_on_device",
+        type=ast.literal_eval,
+        help="If True, MAX networks are trained from 3D keypoints and grids, and the Gaussian target volumes are built per batch on the training device instead of being stored.",
+    )
     parser.add_argument(
         "--save-pred-targets",
         dest="save_pred_targets",
@@ -731,6 +802,64 @@ def add_dannce_predict_args(
         type=int,
         default=0,
     )
+    parser.add_argument(
+        "--device-inference",
+        dest="device_inference",
+        type=ast.literal_eval,
+        help="If True, keep input volumes and grids as torch tensors on the generator device and normalize them there, instead of copying them to numpy and back for every batch.",
+    )
+    parser.add_argument(
+        "--inference-workers",
+        dest="inference_workers",
+        type=int,
+        help="If > 0, generate volumes in this many threads, overlapped with network evaluation and result storage. If 0, predict batches one after another.",
+    )
+    parser.add_argument(
+        "--inference-max-batches",
+        dest="inference_max_batches",
+        type=int,
+        help="With inference-workers, the maximum number of generated batches evaluated by the network in one call.",
+    )
+    parser.add_argument(
+        "--resume-predictions",
+        dest="resume_predictions",
+        type=ast.literal_eval,
+        help="If True, resume an interrupted prediction after the batches it already stored, provided the model, COM file and generation settings are unchanged. If False, prediction starts over.",
+    )
+    parser.add_argument(
+        "--predict-topk",
+        dest="predict_topk",
+        type=int,
+        help="If > 0, AVG predictions also save the values and flat voxel indices of the k largest heatmap voxels of each joint.",
+    )
+    parser.add_argument(
+        "--debug-max-tifdir",
+        dest="debug_max_tifdir",
+        help="If set, MAX predictions write the heatmaps of sampled frames to this directory as tifs, one per joint.",
+    )
+    parser.add_argument(
+        "--debug-max-interval",
+        dest="debug_max_interval",
+        type=int,
+        help="With debug-max-tifdir, save the heatmaps of every n-th predicted sample.",
+    )
+    parser.add_argument(
+        "--save-heatmaps",
+        dest="save_heatmaps",
+        type=ast.literal_eval,
+        help="If True, AVG predictions save the heatmaps of every sample.",
+    )
+    parser.add_argument(
+        "--heatmap-encoding",
+        dest="heatmap_encoding",
+        help="With save-heatmaps, append heatmaps to a sharded archive encoded as float16, topk (the heatmap-topk largest voxels per joint) or uint8 (quantized per joint), instead of one float32 npy file per sample.",
+    )
+    parser.add_argument(
+        "--heatmap-topk",
+        dest="heatmap_topk",
+        type=int,
+        help="Number of voxels per joint kept by the topk heatmap encoding.",
+    )
 
     return parser
 
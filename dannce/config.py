@@ -456,7 +456,11 @@ def setup_train(params):
     cam3_train = True if params["cam3_train"] else False
     # We apply data augmentation with another data generator class
     randflag = params["channel_combo"] == "random"
-    outmode = "coordinates" if params["expval"] else "3dprob"
+    # When MAX targets are synthesized by the trainer, the datasets serve 3D
+    # keypoints and grids, as for AVG networks
+    params["max_targets_on_device"] = params["max_targets_on_device"] and not params["expval"]
+    keypoint_targets = params["expval"] or params["max_targets_on_device"]
+    outmode = "coordinates" if keypoint_targets else "3dprob"
 
     if params["use_npy"]:
         # mono conversion will happen from RGB npy files, and the generator
@@ -508,13 +512,18 @@ def setup_train(params):
         # "chunks": total_chunks,
         "mono": params["mono"],
         "mirror": params["mirror"],
+        "decode_processes": params["decode_processes"],
+        "device": params["generator_device"],
+        "mip_sampling": params["mip_sampling"],
     }    
 
     # dataset params
     shared_args = {
         "chan_num": params["chan_num"],
-        "expval": params["expval"],
+        "expval": keypoint_targets,
         "nvox": params["nvox"],
+        "vmin": params["vmin"],
+        "vmax": params["vmax"],
         "heatmap_reg": params["heatmap_reg"],
         "heatmap_reg_coeff": params["heatmap_reg_coeff"],
         "occlusion": params["downscale_occluded_view"]
@@ -525,7 +534,9 @@ def setup_train(params):
         "augment_hue": params["augment_hue"],
         "augment_brightness": params["augment_brightness"],
         "augment_continuous_rotation": params["augment_continuous_rotation"],
-        "mirror_augmentation": params["mirror_augmentation"],
+        # mirroring is only implemented for AVG networks, and stays off for MAX
+        # networks trained on keypoint targets
+        "mirror_augmentation": params["mirror_augmentation"] and params["expval"],
         "right_keypoints": params["right_keypoints"],
         "left_keypoints": params["left_keypoints"],
         "bright_val": params["augment_bright_val"],
@@ -638,6 +649,10 @@ def setup_predict(params):
         "mono": params["mono"],
         "mirror": params["mirror"],
         "predict_flag": True,
+        "decode_processes": params["decode_processes"],
+        "device": params["generator_device"],
+        "tensor_output": params["device_inference"],
+        "mip_sampling": params["mip_sampling"],
     }
 
     if params.get("social_joint_training", False):
@@ -2,7 +2,7 @@
 import random
 import cv2
 import numpy as np
-from dannce.engine.data import processing
+from dannce.engine.data import processing, ops
 import warnings
 import scipy.io as sio
 
@@ -26,19 +26,22 @@ class PoseDatasetFromMem(torch.utils.data.Dataset):
         augment_hue (bool): If True, applies hue augmentation
         bright_val (float): Brightness augmentation range (-bright_val, bright_val), as fraction of raw image brightness
         chan_num (int): Number of input channels
-        data (np.ndarray): Image volumes
+        data (np.ndarray): Image volumes. uint8 volumes hold raw intensities and are normalized when loaded.
         expval (bool): If True, crafts input for an AVG network
         hue_val (float): Hue augmentation range (-hue_val, hue_val), as fraction of raw image hue range
         indexes (np.ndarray): Sample indices used for batch generation
         labels (Dict): Label dictionary
         list_IDs (List): List of sampleIDs
         nvox (int): Number of voxels in each grid dimension
+        vmin (float): Lower bound of the grids relative to their COM, used to build compact grids
+        vmax (float): Upper bound of the grids relative to their COM, used to build compact grids
         random (bool): If True, shuffles camera order for each batch
         rotation (bool): If True, applies rotation augmentation in 90 degree increments
         rotation_val (float): Range of angles used for continuous rotation augmentation
         shuffle (bool): If True, shuffle the samples before each epoch
         var_reg (bool): If True, returns input used for variance regularization
-        xgrid (np.ndarray): For the AVG network, this contains the 3D grid coordinates
+        xgrid (np.ndarray): For the AVG network, this contains the 3D grid coordinates, or
+            a processing.CompactGrids holding only the COM of each grid
         n_rand_views (int): Number of reviews to sample randomly from the full set
         replace (bool): If True, samples n_rand_views with replacement
         aux_labels (np.ndarray): If not None, contains the 3D MAX training targets for AVG+MAX training.
@@ -58,6 +61,8 @@ def __init__(
         xgrid=None,
         var_reg=False,
         nvox=64,
+        vmin=None,
+        vmax=None,
         augment_brightness=True,
         augment_hue=True,
         augment_continuous_rotation=True,
@@ -100,6 +105,8 @@ def __init__(
         self.var_reg = var_reg
         self.xgrid = xgrid
         self.nvox = nvox
+        self.vmin = vmin
+        self.vmax = vmax
         self.bright_val = bright_val
         self.hue_val = hue_val
         self.rotation_val = rotation_val
@@ -486,6 +493,12 @@ def __data_generation(self, list_IDs_temp):
             else:
                 aux = None
 
+        if self.data.dtype == np.uint8:
+            # volumes are stored as raw intensities to save memory
+            if X.dtype == np.uint8:
+                X = X.astype("float32")
+            X = processing.preprocess_3d(X)
+
         X, X_grid, y_3d, aux = self.do_augmentation(X, X_grid, y_3d, aux)
         # Randomly re-order, if desired
         X = self.do_random(X)
@@ -698,11 +711,13 @@ def __data_generation(self, list_IDs_temp):
             X.append(vol)
 
             y_3d.append(self.labels_3d[ID])
-            X_grid.append(
-                np.load(
-                    os.path.join(self.npydir[eID], self.griddir, "0_" + sID + ".npy")
-                )
+            grid = np.load(
+                os.path.join(self.npydir[eID], self.griddir, "0_" + sID + ".npy")
             )
+            if grid.ndim == 1:
+                # compact grid files only hold the grid COM
+                grid = processing.grid_from_com(grid, self.vmin, self.vmax, self.nvox)
+            X_grid.append(grid)
 
             if self.aux:
                 aux.append(
@@ -723,19 +738,13 @@ def __data_generation(self, list_IDs_temp):
 
         if not self.expval:
             X_grid = np.reshape(X_grid, (-1, self.nvox, self.nvox, self.nvox, 3))
-            for gridi in range(X_grid.shape[0]):
-                x_coord_3d = X_grid[gridi, :, :, :, 0]
-                y_coord_3d = X_grid[gridi, :, :, :, 1]
-                z_coord_3d = X_grid[gridi, :, :, :, 2]
-                for j in range(y_3d_max.shape[-1]):
-                    y_3d_max[gridi, :, :, :, j] = np.exp(
-                        -(
-                            (y_coord_3d - y_3d[gridi, 1, j]) ** 2
-                            + (x_coord_3d - y_3d[gridi, 0, j]) ** 2
-                            + (z_coord_3d - y_3d[gridi, 2, j]) ** 2
-                        )
-                        / (2 * self.sigma ** 2)
-                    )
+            # separable Gaussian targets for all samples and joints at once
+            grid = torch.as_tensor(X_grid)
+            y_3d_max[:] = ops.gaussian_targets(
+                torch.as_tensor(y_3d, dtype=grid.dtype),
+                ops.grid_profiles([grid[..., k] for k in range(3)]),
+                self.sigma,
+            ).permute(0, 2, 3, 4, 1).numpy()
             X_grid = np.reshape(X_grid, (X_grid.shape[0], -1, 3))
             y_3d = y_3d_max
 
@@ -2,10 +2,12 @@
 """
 import os
 from copy import deepcopy
+from collections import OrderedDict
+import threading
 import numpy as np
 
 from dannce.engine.data import processing, ops
-from dannce.engine.data.video import LoadVideoFrame
+from dannce.engine.data.video import LoadVideoFrame, ProcessFrameLoader
 from dannce.engine.data.ops import Camera
 import warnings
 import time
@@ -20,6 +22,41 @@
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 
+def generator_device(gpu_id: Text = "0", device: Text = None) -> torch.device:
+    """Torch device used to generate volumes.
+
+    Args:
+        gpu_id (Text, optional): Identity of GPU to use.
+        device (Text, optional): Requested device, "cpu" or "cuda". Defaults to
+            the GPU if one is available, else the CPU.
+
+    Returns:
+        torch.device: Generator device.
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cuda":
+        device = "cuda:" + gpu_id
+    return torch.device(device)
+
+
+def configure_cpu_threads(n_threads: int = None):
+    """Set the number of threads torch uses for ops on the CPU.
+
+    Generating volumes on the CPU is dominated by large gathers and matrix
+    products over the voxel grid, which torch parallelizes internally.
+
+    Args:
+        n_threads (int, optional): Number of intra-op threads. If None, torch's
+            default (the number of physical cores) is kept.
+    """
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+
+
+# Number of per-box-size offset grids kept by DataGenerator_Dynamic
+MAX_CACHED_GRIDS = 64
+
 MISSING_KEYPOINTS_MSG = (
     "If mirror augmentation is used, the right_keypoints indices and left_keypoints "
     + "indices must be specified as well. "
@@ -131,6 +168,46 @@ def __len__(self) -> int:
         """
         return int(np.floor(len(self.list_IDs) / self.batch_size))
 
+    def frame_schedule(self, indices: List) -> Dict:
+        """Video frames read by each camera when generating the given batches.
+
+        Args:
+            indices (List): Batch indices, in the order they will be requested.
+
+        Returns:
+            Dict: Camera names mapped to the ordered list of frame indices.
+        """
+        schedule = {}
+        for index in indices:
+            for ID in self.list_IDs[index * self.batch_size : (index + 1) * self.batch_size]:
+                experimentID = int(ID.split("_")[0])
+                # in mirror mode, all views are read from the first camera's video
+                camnames = self.camnames[experimentID]
+                camnames = camnames[:1] if self.mirror else camnames
+                for camname in camnames:
+                    schedule.setdefault(camname, []).append(
+                        self.labels[ID]["frames"][camname]
+                    )
+        return schedule
+
+    def start_prefetch(self, indices: List, depth: int = 8):
+        """Decode the frames of the given batches ahead of time in the background.
+
+        Args:
+            indices (List): Batch indices, in the order they will be requested.
+            depth (int, optional): Maximum number of frames buffered per camera.
+        """
+        self.load_frame.start_prefetch(
+            self.frame_schedule(indices), self.extension, depth
+        )
+
+    def stop_prefetch(self):
+        self.load_frame.stop_prefetch()
+
+    def close(self):
+        """Release the video readers and decoder processes of the frame loader."""
+        self.load_frame.close()
+
 class DataGenerator_3Dconv(DataGenerator):
     """Update generator class to handle multiple experiments.
     """
@@ -177,6 +254,10 @@ def __init__(
         mirror: bool = False,
         predict_flag: bool = False,
         segmentation_model=None,
+        decode_processes: int = 0,
+        device: Text = None,
+        tensor_output: bool = False,
+        mip_sampling: bool = False,
     ):
         """Initialize data generator.
 
@@ -219,6 +300,15 @@ def __init__(
             chunks (int, optional): Size of chunks when using chunked mp4.
             mono (bool, optional): If True, use grayscale image.
             predict_flag (bool, optional): If True, use imageio for reading videos, rather than OpenCV
+            segmentation_model (optional): Instance segmentation model used to mask the images.
+            decode_processes (int, optional): If > 0, decode video frames in this many
+                worker processes per camera instead of in the projection threads.
+            device (Text, optional): Torch device used to generate volumes, e.g. "cpu".
+                Defaults to the GPU given by gpu_id, or the CPU if none is available.
+            tensor_output (bool, optional): If True, input volumes and grids are returned
+                as torch tensors on the generator device rather than numpy arrays.
+            mip_sampling (bool, optional): If True, sample each camera from the level of
+                an image pyramid whose pixel size best matches the projected voxel size.
         """
         DataGenerator.__init__(
             self,
@@ -267,29 +357,36 @@ def __init__(
         # If saving npy as uint8 rather than training directly, dont normalize
         self.norm_im = norm_im
 
-        self.device = torch.device("cuda:" + self.gpu_id)
+        self.device = generator_device(self.gpu_id, device)
+        self.tensor_output = tensor_output
+        self.mip_sampling = mip_sampling
 
         self.threadpool = ThreadPool(len(self.camnames[0]))
         self.segmentation_model = segmentation_model
 
-        ts = time.time()
-
-        for ID in list_IDs:
-            experimentID = int(ID.split("_")[0])
-            for camname in self.camnames[experimentID]:
-                # M only needs to be computed once for each camera
-                K = self.camera_params[experimentID][camname]["K"]
-                R = self.camera_params[experimentID][camname]["R"]
-                t = self.camera_params[experimentID][camname]["t"]
-                M = torch.as_tensor(
-                    ops.camera_matrix(K, R, t), dtype=torch.float32
-                )
-                self.camera_params[experimentID][camname]["M"] = M
+        if decode_processes > 0 and self.vidreaders is not None:
+            self.load_frame = ProcessFrameLoader(
+                self._N_VIDEO_FRAMES,
+                self.vidreaders,
+                self.camnames,
+                self.predict_flag,
+                n_workers=decode_processes,
+            )
 
-        print("Init took {} sec.".format(time.time() - ts))
+        # camera matrices and distortion coefficients, built once per experiment
+        self.cameras = ops.CameraBank(self.camera_params, self.camnames, self.device)
 
         self.pj_method = self.pj_grid_mirror if self.mirror else self.pj_grid
 
+        # All cameras can be projected and sampled in one vectorized pass
+        # unless images are cropped around the COM, mirrored or segmented
+        # one camera at a time
+        self.batched_projection = (
+            not self.mirror and not self.crop_im and self.segmentation_model is None
+        )
+        # voxel center offsets from the COM, shared by all samples
+        self._base_grid = None
+
     def __getitem__(self, index: int):
         """Generate one batch of data.
 
@@ -334,14 +431,13 @@ def pj_grid(self, X_grid, camname, ID, experimentID):
         this_y[1, :] = this_y[1, :] - self.crop_height[0]
         com = torch.mean(this_y, axis=1)
 
-        thisim = self.load_frame.load_vid_frame(
+        thisim = self.load_frame.load_cropped_frame(
             self.labels[ID]["frames"][camname],
             camname,
+            self.crop_height,
+            self.crop_width,
             extension=self.extension,
-        )[
-            self.crop_height[0] : self.crop_height[1],
-            self.crop_width[0] : self.crop_width[1],
-        ]
+        )
         return self.pj_grid_post(
             X_grid, camname, ID, experimentID, com, com_precrop, thisim
         )
@@ -379,6 +475,112 @@ def pj_grid_mirror(self, X_grid, camname, ID, experimentID, thisim):
             X_grid, camname, ID, experimentID, com, com_precrop, passim
         )
 
+    def _sampling_inputs(self, im, proj_grid):
+        """Image region, pyramid level and matching coordinates to sample a camera from.
+
+        Args:
+            im (np.ndarray): Camera image, [H, W, C]
+            proj_grid (torch.Tensor): Projected voxel centers in image pixels, [N, 2]
+
+        Returns:
+            Tuple: image region at the selected level and coordinates in it.
+        """
+        # blank frames for missing COMs are already on the device
+        if torch.is_tensor(im):
+            return im, proj_grid
+        # only the region covered by the grid is converted and uploaded
+        im, proj_grid = ops.crop_to_roi(
+            im, proj_grid, ops.projection_roi(proj_grid, im.shape)
+        )
+        if not self.mip_sampling:
+            return im, proj_grid
+        level = ops.mip_level(proj_grid)
+        if level == 0:
+            return im, proj_grid
+        level_im = ops.downsample_image(im, level)
+        return level_im, ops.rescale_coords(proj_grid, im.shape, level_im.shape)
+
+    def pj_grid_batch(self, X_grid, ID, experimentID):
+        """Projects 3D voxel centers into all cameras and samples their images
+        in one vectorized pass. Frames are still loaded in parallel threads.
+        Cameras whose frames differ in size are sampled one at a time.
+
+        Args:
+            X_grid (np.ndarray): 3-D array containing center coordinates of each voxel.
+            ID (Text): string denoting a sample ID
+            experimentID (int): identifier for a video recording session.
+
+        Returns:
+            torch.Tensor: Sampled volumes for every camera, [n_cams, *dim_out_3d, n_channels]
+        """
+        camnames = self.camnames[experimentID]
+        arglist = [
+            (
+                self.labels[ID]["frames"][camname],
+                camname,
+                self.crop_height,
+                self.crop_width,
+                self.extension,
+            )
+            for camname in camnames
+        ]
+        ims = self.threadpool.starmap(self.load_frame.load_cropped_frame, arglist)
+
+        cams = self.cameras[experimentID]
+        proj_grid = ops.project_to2d_batch(X_grid, cams["M"], self.device)[..., :2]
+        if self.distort:
+            proj_grid = ops.distortPoints_batch(
+                proj_grid, cams["K"], cams["RDistort"], cams["TDistort"], self.device
+            )
+
+        # correct for crops at the borders
+        crop_offset = torch.as_tensor(
+            (self.crop_width[0], self.crop_height[0]),
+            dtype=torch.float32,
+            device=self.device,
+        )
+        proj_grid = proj_grid - crop_offset
+
+        if len(set(im.shape for im in ims)) > 1:
+            # frames of cameras with different resolutions cannot be stacked,
+            # so sample them one camera at a time
+            rgb = torch.cat(
+                [
+                    ops.sample_grid(
+                        *self._sampling_inputs(im, pg), self.device, method=self.interp
+                    )
+                    for im, pg in zip(ims, proj_grid)
+                ]
+            )
+            return rgb.permute(0, 2, 3, 4, 1)
+
+        # crop every frame to a region of common size covering its projected grid,
+        # moved back inside the frame where the enlarged region overhangs it
+        rois = [ops.projection_roi(pg, im.shape) for im, pg in zip(ims, proj_grid)]
+        roi_w = max(x1 - x0 for x0, _, x1, _ in rois)
+        roi_h = max(y1 - y0 for _, y0, _, y1 in rois)
+        rois = [
+            (min(x0, im.shape[1] - roi_w), min(y0, im.shape[0] - roi_h))
+            for (x0, y0, _, _), im in zip(rois, ims)
+        ]
+        rois = [(x0, y0, x0 + roi_w, y0 + roi_h) for x0, y0 in rois]
+        ims, proj_grid = zip(
+            *[ops.crop_to_roi(im, pg, roi) for im, pg, roi in zip(ims, proj_grid, rois)]
+        )
+        proj_grid = torch.stack(proj_grid)
+
+        if self.mip_sampling:
+            # cameras are sampled together, so use the finest level any of them needs
+            level = min(ops.mip_level(pg) for pg in proj_grid)
+            if level > 0:
+                shape = ims[0].shape
+                ims = [ops.downsample_image(im, level) for im in ims]
+                proj_grid = ops.rescale_coords(proj_grid, shape, ims[0].shape)
+        ims = torch.as_tensor(np.stack(ims), device=self.device)
+
+        rgb = ops.sample_grid_batch(ims, proj_grid, self.device, method=self.interp)
+        return rgb.permute(0, 2, 3, 4, 1)
+
     def pj_grid_post(self, X_grid, camname, ID, experimentID, com, com_precrop, thisim):
         # separate the porjection and sampling into its own function so that
         # when mirror == True, this can be called directly
@@ -403,24 +605,24 @@ def pj_grid_post(self, X_grid, camname, ID, experimentID, com, com_precrop, this
             # bbox = prediction["boxes"][0].cpu().numpy()
             # com_pred = ((bbox[0] + bbox[2]) / 2, (bbox[1]+bbox[3]) / 2)
             
-            thisim *= mask # return the segmented foreground object
+            # return the segmented foreground object. Not in place, as the
+            # frame may be shared through the decoded frame cache
+            thisim = thisim * mask
 
         ts = time.time()
-        proj_grid = ops.project_to2d(
-            X_grid, self.camera_params[experimentID][camname]["M"], self.device
-        )
+        cam = self.cameras.camera(experimentID, camname)
+        proj_grid = ops.project_to2d(X_grid, cam["M"], self.device)
         # print('Project2d took {} sec.'.format(time.time() - ts))
 
         ts = time.time()
         if self.distort:
-            proj_grid = ops.distortPoints(
-                proj_grid[:, :2],
-                self.camera_params[experimentID][camname]["K"],
-                np.squeeze(self.camera_params[experimentID][camname]["RDistort"]),
-                np.squeeze(self.camera_params[experimentID][camname]["TDistort"]),
+            proj_grid = ops.distortPoints_batch(
+                proj_grid[None, :, :2],
+                cam["K"][None],
+                cam["RDistort"][None],
+                cam["TDistort"][None],
                 self.device,
-            )
-            proj_grid = proj_grid.transpose(0, 1)
+            )[0]
             # print('Distort took {} sec.'.format(time.time() - ts))
 
         ts = time.time()
@@ -433,6 +635,7 @@ def pj_grid_post(self, X_grid, camname, ID, experimentID, com, com_precrop, this
             proj_grid[:, 0] = proj_grid[:, 0] - self.crop_width[0]
             proj_grid[:, 1] = proj_grid[:, 1] - self.crop_height[0]
 
+        thisim, proj_grid = self._sampling_inputs(thisim, proj_grid)
         rgb = ops.sample_grid(thisim, proj_grid, self.device, method=self.interp)
         # print('Sample grid {} sec.'.format(time.time() - ts))
 
@@ -480,56 +683,51 @@ def _init_vars(self, first_exp):
 
         return X, y_3d, X_grid
     
-    def _generate_coord_grid(self, this_COM_3d):
-        xgrid = torch.arange(
-            self.vmin + this_COM_3d[0] + self.vsize / 2,
-            this_COM_3d[0] + self.vmax,
-            self.vsize,
-            dtype=torch.float32,
-            device=self.device,
-        )
-        ygrid = torch.arange(
-            self.vmin + this_COM_3d[1] + self.vsize / 2,
-            this_COM_3d[1] + self.vmax,
-            self.vsize,
-            dtype=torch.float32,
-            device=self.device,
-        )
-        zgrid = torch.arange(
-            self.vmin + this_COM_3d[2] + self.vsize / 2,
-            this_COM_3d[2] + self.vmax,
-            self.vsize,
-            dtype=torch.float32,
-            device=self.device,
-        )
-        (x_coord_3d, y_coord_3d, z_coord_3d) = torch.meshgrid(
-            xgrid, ygrid, zgrid
+    def _offset_coords(self, bbox_min, vsizes):
+        """Voxel center offsets from the COM along each axis.
+
+        Args:
+            bbox_min (Tuple): Lower bound of the volume along x, y and z.
+            vsizes (Tuple): Voxel size along x, y and z.
+
+        Returns:
+            Tuple: x, y and z offsets of every voxel, in torch.meshgrid ('ij') layout.
+        """
+        steps = torch.arange(self.nvox, dtype=torch.float32, device=self.device)
+        return torch.meshgrid(
+            *[
+                float(bmin) + float(vsize) / 2 + steps * float(vsize)
+                for bmin, vsize in zip(bbox_min, vsizes)
+            ]
         )
 
-        # torch.meshgrid current behavior is the same as np.meshgrid('ij')
-        # need to convert to 'xy' for generating correct Gaussian targets
-        x_coord_3d, y_coord_3d, z_coord_3d = x_coord_3d.transpose(0, 1), y_coord_3d.transpose(0, 1), z_coord_3d.transpose(0, 1)
+    def _generate_coord_grid(self, this_COM_3d):
+        if self._base_grid is None:
+            coords = self._offset_coords((self.vmin,) * 3, (self.vsize,) * 3)
+            # torch.meshgrid current behavior is the same as np.meshgrid('ij')
+            # need to convert to 'xy' for generating correct Gaussian targets
+            coords = tuple(c.transpose(0, 1) for c in coords)
+            grid = torch.stack([c.flatten() for c in coords], dim=1)
+            self._base_grid = (coords, grid)
 
-        grid = torch.stack((x_coord_3d.flatten(), y_coord_3d.flatten(), z_coord_3d.flatten()), dim=1)
+        # only the COM translation changes between samples
+        coords, grid = self._base_grid
+        coords_3d = tuple(c + this_COM_3d[d] for d, c in enumerate(coords))
 
-        return (x_coord_3d, y_coord_3d, z_coord_3d), grid
+        return coords_3d, grid + this_COM_3d
 
     def _generate_targets(self, i, y_3d, this_y_3d, coords_3d):
         if self.mode == "3dprob":
-            # generate Gaussian targets
-            for j in range(self.n_channels_out):
-                y_3d[i, j] = torch.exp(
-                    -(
-                        (coords_3d[1] - this_y_3d[1, j]) ** 2
-                        + (coords_3d[0] - this_y_3d[0, j]) ** 2
-                        + (coords_3d[2] - this_y_3d[2, j]) ** 2
-                    )
-                    / (2 * self.out_scale ** 2)
-                )
-                # When the voxel grid is coarse, we will likely miss
-                # the peak of the probability distribution, as it
-                # will lie somewhere in the middle of a large voxel.
-                # So here we renormalize to [~, 1]
+            # generate Gaussian targets, for all joints at once
+            y_3d[i] = ops.gaussian_targets(
+                this_y_3d[None, :, : self.n_channels_out],
+                ops.grid_profiles([c[None] for c in coords_3d]),
+                self.out_scale,
+            )[0]
+            # When the voxel grid is coarse, we will likely miss
+            # the peak of the probability distribution, as it
+            # will lie somewhere in the middle of a large voxel.
+            # So here we renormalize to [~, 1]
         
         if self.mode == "coordinates":
             if this_y_3d.shape == y_3d[i].shape:
@@ -571,6 +769,15 @@ def _adjust_vol_channels(self, X, y_3d, first_exp, num_cams):
  
     def _convert_tensor_to_numpy(self, X, y_3d, X_grid):
         # ts = time.time()
+        if self.tensor_output:
+            # volumes and grids stay on the device; only the (small) targets
+            # are copied to host
+            if torch.is_tensor(X):
+                X = X.float()
+            if torch.is_tensor(y_3d):
+                y_3d = y_3d.cpu().numpy()
+            return X, y_3d, X_grid
+
         if torch.is_tensor(X):
             X = X.float().cpu().numpy()
         if torch.is_tensor(y_3d):
@@ -634,6 +841,12 @@ def __data_generation(self, list_IDs_temp):
             # Generate training targets
             y_3d = self._generate_targets(i, y_3d, this_y_3d, coords_3d)
 
+            if self.batched_projection:
+                X[i * num_cams : (i + 1) * num_cams] = self.pj_grid_batch(
+                    X_grid[i], ID, experimentID
+                )
+                continue
+
             # Compute projected images in parallel using multithreading
             # ts = time.time()
             arglist = []
@@ -641,14 +854,13 @@ def __data_generation(self, list_IDs_temp):
                 # Here we only load the video once, and then parallelize the projection
                 # and sampling after mirror flipping. For setups that collect views
                 # in a single image with the use of mirrors
-                loadim = self.load_frame.load_vid_frame(
+                loadim = self.load_frame.load_cropped_frame(
                     self.labels[ID]["frames"][self.camnames[experimentID][0]],
                     self.camnames[experimentID][0],
+                    self.crop_height,
+                    self.crop_width,
                     extension=self.extension,
-                )[
-                    self.crop_height[0] : self.crop_height[1],
-                    self.crop_width[0] : self.crop_width[1],
-                ]
+                )
 
             for c in range(num_cams):
                 args = [X_grid[i], self.camnames[experimentID][c], ID, experimentID]
@@ -721,6 +933,26 @@ def __len__(self) -> int:
         """
         return len(self.list_IDs)
 
+    def frame_schedule(self, indices: List) -> Dict:
+        """Video frames read by each camera when generating the given batches.
+        The frame is loaded once, through the first instance, for all animals.
+
+        Args:
+            indices (List): Batch indices, in the order they will be requested.
+
+        Returns:
+            Dict: Camera names mapped to the ordered list of frame indices.
+        """
+        schedule = {}
+        for index in indices:
+            ID = self.list_IDs[index]
+            experimentID = int(ID.split("_")[0])
+            for camname in self.camnames[experimentID]:
+                schedule.setdefault(camname, []).append(
+                    self.labels[ID]["frames"][camname]
+                )
+        return schedule
+
     def __getitem__(self, index: int):
         """Generate one batch of data.
 
@@ -760,14 +992,13 @@ def proj_grid(self, X_grids, camnames, IDs, experimentIDs, com_3ds):
         thisims, coms, com_precrops = [], [], []
 
         # only load the frame once for all animals present
-        thisim = self.load_frame.load_vid_frame(
+        thisim = self.load_frame.load_cropped_frame(
             self.labels[IDs[0]]["frames"][camnames[0]],
             camnames[0],
+            self.crop_height,
+            self.crop_width,
             extension=self.extension,
-        )[
-            self.crop_height[0] : self.crop_height[1],
-            self.crop_width[0] : self.crop_width[1],
-        ]
+        )
         
         for i in range(self.n_instances):
             this_y = torch.as_tensor(
@@ -896,7 +1127,7 @@ def pj_grid_post(self, X_grids, camnames, IDs, experimentIDs, coms, com_precrops
         # convert 3D COMs into camera coordinate frame for occlusion check
         com_3ds_cam = ops.world_to_cam(
             com_3ds.clone(), 
-            self.camera_params[experimentIDs[0]][camnames[0]]["M"],
+            self.cameras.camera(experimentIDs[0], camnames[0])["M"],
             self.device
         ).detach().cpu().numpy()
         depths = com_3ds_cam[:, 2]
@@ -989,21 +1220,19 @@ def pj_grid_post(self, X_grids, camnames, IDs, experimentIDs, coms, com_precrops
         X = []
         for i in range(self.n_instances):
             # ts = time.time()
-            proj_grid = ops.project_to2d(
-                X_grids[i], self.camera_params[experimentIDs[i]][camnames[i]]["M"], self.device
-            )
+            cam = self.cameras.camera(experimentIDs[i], camnames[i])
+            proj_grid = ops.project_to2d(X_grids[i], cam["M"], self.device)
             # print('Project2d took {} sec.'.format(time.time() - ts))
 
             # ts = time.time()
             if self.distort:
-                proj_grid = ops.distortPoints(
-                    proj_grid[:, :2],
-                    self.camera_params[experimentIDs[i]][camnames[i]]["K"],
-                    np.squeeze(self.camera_params[experimentIDs[i]][camnames[i]]["RDistort"]),
-                    np.squeeze(self.camera_params[experimentIDs[i]][camnames[i]]["TDistort"]),
+                proj_grid = ops.distortPoints_batch(
+                    proj_grid[None, :, :2],
+                    cam["K"][None],
+                    cam["RDistort"][None],
+                    cam["TDistort"][None],
                     self.device,
-                )
-                proj_grid = proj_grid.transpose(0, 1)
+                )[0]
                 # print('Distort took {} sec.'.format(time.time() - ts))
 
             # ts = time.time()
@@ -1016,7 +1245,8 @@ def pj_grid_post(self, X_grids, camnames, IDs, experimentIDs, coms, com_precrops
                 proj_grid[:, 0] = proj_grid[:, 0] - self.crop_width[0]
                 proj_grid[:, 1] = proj_grid[:, 1] - self.crop_height[0]
 
-            rgb = ops.sample_grid(thisims[i], proj_grid, self.device, method=self.interp)
+            thisim, proj_grid = self._sampling_inputs(thisims[i], proj_grid)
+            rgb = ops.sample_grid(thisim, proj_grid, self.device, method=self.interp)
 
             if (
                 ~torch.any(torch.isnan(com_precrops[i]))
@@ -1379,54 +1609,42 @@ def __init__(
         )
 
         self.dim_dict = dim_dict
+        self._base_grids = OrderedDict()
+        # samples may be generated from several threads
+        self._base_grids_lock = threading.Lock()
 
     def _generate_coord_grid(self, this_COM_3d, bbox_dim):
-        # print(this_COM_3d, bbox_dim)
-        bbox_min = -5*(bbox_dim // 10)  # rounding
-        bbox_max = 5*(bbox_dim // 10)
-
-        # if (bbox_max < self.vmax*0.4).sum() > 0:
-        #     # print("degenerate prediction")
-        #     bbox_min = bbox_min.new_ones(bbox_min.shape) * self.vmin*0.8
-        #     bbox_max = bbox_max.new_ones(bbox_max.shape) * self.vmax*0.8
-        bbox_dim = bbox_max - bbox_min
-        vsizes = (bbox_dim) / self.nvox
-        
-        xgrid = torch.arange(
-            bbox_min[0] + this_COM_3d[0] + vsizes[0] / 2,
-            this_COM_3d[0] + bbox_max[0],
-            vsizes[0],
-            dtype=torch.float32,
-            device=self.device,
-        )
-        ygrid = torch.arange(
-            bbox_min[1] + this_COM_3d[1] + vsizes[1] / 2,
-            this_COM_3d[1] + bbox_max[1],
-            vsizes[1],
-            dtype=torch.float32,
-            device=self.device,
-        )
-        zgrid = torch.arange(
-            bbox_min[2] + this_COM_3d[2] + vsizes[2] / 2,
-            this_COM_3d[2] + bbox_max[2],
-            vsizes[2],
-            dtype=torch.float32,
-            device=self.device,
-        )
-        (x_coord_3d, y_coord_3d, z_coord_3d) = torch.meshgrid(
-            xgrid, ygrid, zgrid
-        )
+        # offset grids are cached per (rounded) box size, as only the COM
+        # translation changes between samples of the same size
+        key = tuple((bbox_dim // 10).tolist())
+        with self._base_grids_lock:
+            base_grid = self._base_grids.get(key, None)
+            if base_grid is not None:
+                self._base_grids.move_to_end(key)
+        if base_grid is None:
+            bbox_min = -5*(bbox_dim // 10)  # rounding
+            bbox_max = 5*(bbox_dim // 10)
+
+            # if (bbox_max < self.vmax*0.4).sum() > 0:
+            #     # print("degenerate prediction")
+            #     bbox_min = bbox_min.new_ones(bbox_min.shape) * self.vmin*0.8
+            #     bbox_max = bbox_max.new_ones(bbox_max.shape) * self.vmax*0.8
+            vsizes = (bbox_max - bbox_min) / self.nvox
+
+            coords = self._offset_coords(bbox_min.tolist(), vsizes.tolist())
+            grid = torch.stack(
+                [c.transpose(0, 1).flatten() for c in coords], dim=1
+            )
+            base_grid = (coords, grid)
+            with self._base_grids_lock:
+                self._base_grids[key] = base_grid
+                if len(self._base_grids) > MAX_CACHED_GRIDS:
+                    self._base_grids.popitem(last=False)
 
-        grid = torch.stack(
-            (
-            x_coord_3d.transpose(0, 1).flatten(),
-            y_coord_3d.transpose(0, 1).flatten(),
-            z_coord_3d.transpose(0, 1).flatten(),
-            ),
-            dim=1,
-        )
+        coords, grid = base_grid
+        coords_3d = tuple(c + this_COM_3d[d] for d, c in enumerate(coords))
 
-        return (x_coord_3d, y_coord_3d, z_coord_3d), grid
+        return coords_3d, grid + this_COM_3d
 
         
     def __data_generation(self, list_IDs_temp):
@@ -1457,6 +1675,12 @@ def __data_generation(self, list_IDs_temp):
             # Generate training targets
             y_3d = self._generate_targets(i, y_3d, this_y_3d, coords_3d)
 
+            if self.batched_projection:
+                X[i * num_cams : (i + 1) * num_cams] = self.pj_grid_batch(
+                    X_grid[i], ID, experimentID
+                )
+                continue
+
             # Compute projected images in parallel using multithreading
             # ts = time.time()
             arglist = []
@@ -1464,14 +1688,13 @@ def __data_generation(self, list_IDs_temp):
                 # Here we only load the video once, and then parallelize the projection
                 # and sampling after mirror flipping. For setups that collect views
                 # in a single image with the use of mirrors
-                loadim = self.load_frame.load_vid_frame(
+                loadim = self.load_frame.load_cropped_frame(
                     self.labels[ID]["frames"][self.camnames[experimentID][0]],
                     self.camnames[experimentID][0],
+                    self.crop_height,
+                    self.crop_width,
                     extension=self.extension,
-                )[
-                    self.crop_height[0] : self.crop_height[1],
-                    self.crop_width[0] : self.crop_width[1],
-                ]
+                )
 
             for c in range(num_cams):
                 args = [X_grid[i], self.camnames[experimentID][c], ID, experimentID]
@@ -1606,6 +1829,44 @@ def on_epoch_end(self):
         if self.shuffle:
             np.random.shuffle(self.indexes)
 
+    def frame_schedule(self, indices):
+        """Video frames read by each camera when generating the given samples.
+
+        Args:
+            indices (List): Sample indices, in the order they will be requested.
+
+        Returns:
+            Dict: Camera names mapped to the ordered list of frame indices.
+        """
+        schedule = {}
+        for index in indices:
+            ID = self.list_IDs[index]
+            experimentID = int(ID.split("_")[0]) if "_" in ID else 0
+            for camname in self.camnames[experimentID]:
+                schedule.setdefault(camname, []).append(
+                    self.labels[ID]["frames"][camname]
+                )
+        return schedule
+
+    def start_prefetch(self, indices, depth=8):
+        """Decode the frames of the given samples ahead of time in the background.
+
+        Args:
+            indices (List): Sample indices, in the order they will be requested.
+            depth (int, optional): Maximum number of frames buffered per camera.
+        """
+        if self.immode == "video":
+            self.load_frame.start_prefetch(
+                self.frame_schedule(indices), self.extension, depth
+            )
+
+    def stop_prefetch(self):
+        self.load_frame.stop_prefetch()
+
+    def close(self):
+        """Release the video readers of the frame loader."""
+        self.load_frame.close()
+
     def load_tif_frame(self, ind, camname):
         """Load frames in tif mode."""
         # In tif mode, vidreaders should just be paths to the tif directory
@@ -1662,14 +1923,13 @@ def __data_generation(self, list_IDs_temp):
                 # Store sample
                 # TODO(Refactor): This section is tricky to read
                 if self.immode == "video":
-                    X[cnt] = self.load_frame.load_vid_frame(
+                    X[cnt] = self.load_frame.load_cropped_frame(
                         self.labels[ID]["frames"][camname],
                         camname,
-                        self.extension,
-                    )[
-                        self.crop_height[0] : self.crop_height[1],
-                        self.crop_width[0] : self.crop_width[1],
-                    ]
+                        self.crop_height,
+                        self.crop_width,
+                        extension=self.extension,
+                    )
                 elif self.immode == "tif":
                     X[cnt] = self.load_tif_frame(
                         self.labels[ID]["frames"][camname], camname
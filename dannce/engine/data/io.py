@@ -1,7 +1,11 @@
 """Data loading and saving operations."""
+import glob
+import json
+import os
+import pickle
 import numpy as np
 import scipy.io as sio
-from typing import List, Dict, Text, Union
+from typing import List, Dict, Text, Tuple, Union
 import mat73
 
 
@@ -130,3 +134,305 @@ def load_camnames(path: Text) -> Union[List, None]:
         if "camnames" in label_3d_file:
             camnames = [name[0] for name in label_3d_file["camnames"]] 
     return camnames
+
+
+class PredictionStore:
+    """Append-only, chunked store of per-batch predictions.
+
+    Predictions are buffered by batch and written as chunk files that are
+    never rewritten, so saving progress costs the same at any point of a run.
+    Chunks left by an interrupted run are loaded back to resume after the
+    batches they hold, unless they were made with different settings.
+    """
+
+    META_FILE = "meta.json"
+
+    def __init__(self, path: Text, meta: Dict = None, batches_per_chunk: int = 100):
+        """Open or create a prediction store.
+
+        Args:
+            path (Text): Store directory
+            meta (Dict, optional): Settings the predictions depend on. Existing
+                chunks are discarded if they were made with other settings.
+            batches_per_chunk (int, optional): Number of batches per chunk file.
+        """
+        self.path = path
+        self.batches_per_chunk = batches_per_chunk
+        self._buffer = {}
+        os.makedirs(path, exist_ok=True)
+
+        meta = json.loads(json.dumps(meta or {}, default=str))
+        meta_file = os.path.join(path, self.META_FILE)
+        if os.path.exists(meta_file):
+            with open(meta_file, "r") as f:
+                stored_meta = json.load(f)
+            if stored_meta != meta and self._chunk_files():
+                print(
+                    "Discarding predictions in {} made with different settings".format(path)
+                )
+                for chunk_file in self._chunk_files():
+                    os.remove(chunk_file)
+        with open(meta_file, "w") as f:
+            json.dump(meta, f)
+        self._n_chunks = len(self._chunk_files())
+
+    def _chunk_files(self) -> List:
+        return sorted(glob.glob(os.path.join(self.path, "chunk_*.pickle")))
+
+    def load(self) -> Tuple[Dict, set]:
+        """Load the stored predictions.
+
+        Returns:
+            Tuple[Dict, set]: Predictions by sample index, and the indices of
+                the batches they come from.
+        """
+        data, batches = {}, set()
+        for chunk_file in self._chunk_files():
+            with open(chunk_file, "rb") as f:
+                chunk = pickle.load(f)
+            for batch, records in chunk.items():
+                data.update(records)
+                batches.add(batch)
+        return dict(sorted(data.items())), batches
+
+    def append(self, batch: int, records: Dict):
+        """Add the predictions of a batch.
+
+        Args:
+            batch (int): Batch index
+            records (Dict): Predictions of the batch by sample index.
+        """
+        self._buffer[batch] = records
+        if len(self._buffer) >= self.batches_per_chunk:
+            self.flush()
+
+    def flush(self):
+        """Write buffered batches to a new chunk file."""
+        if not self._buffer:
+            return
+        chunk_file = os.path.join(self.path, "chunk_{:06d}.pickle".format(self._n_chunks))
+        # chunks appear complete or not at all
+        with open(chunk_file + ".tmp", "wb") as f:
+            pickle.dump(self._buffer, f)
+        os.replace(chunk_file + ".tmp", chunk_file)
+        self._n_chunks += 1
+        self._buffer = {}
+
+    def clear(self):
+        """Discard all stored and buffered predictions."""
+        for chunk_file in self._chunk_files():
+            os.remove(chunk_file)
+        self._n_chunks = 0
+        self._buffer = {}
+
+
+HEATMAP_ENCODINGS = ("float16", "topk", "uint8")
+
+
+def encode_heatmaps(heatmaps: np.ndarray, encoding: Text, k: int = 64) -> bytes:
+    """Encode the heatmaps of a sample.
+
+    Args:
+        heatmaps (np.ndarray): Heatmaps, [n_joints, ...]
+        encoding (Text): "float16"; "topk", the k largest voxels of each joint
+            and the joint's minimum as background; or "uint8", quantized
+            between each joint's minimum and maximum.
+        k (int, optional): Number of voxels per joint kept by "topk", at most
+            the number of voxels per joint.
+
+    Returns:
+        bytes: Encoded heatmaps
+    """
+    flat = heatmaps.reshape(heatmaps.shape[0], -1).astype(np.float32)
+    if encoding == "float16":
+        return flat.astype(np.float16).tobytes()
+    lo = flat.min(axis=1)
+    if encoding == "topk":
+        k = min(k, flat.shape[1])
+        indices = np.argpartition(flat, -k, axis=1)[:, -k:].astype(np.int32)
+        values = np.take_along_axis(flat, indices, axis=1)
+        return lo.tobytes() + indices.tobytes() + values.tobytes()
+    if encoding == "uint8":
+        scale = (flat.max(axis=1) - lo) / 255
+        q = np.round((flat - lo[:, None]) / np.maximum(scale, 1e-12)[:, None])
+        return lo.tobytes() + scale.astype(np.float32).tobytes() + q.astype(np.uint8).tobytes()
+    raise Exception("Unknown heatmap encoding {}".format(encoding))
+
+
+def decode_heatmaps(buffer: bytes, encoding: Text, shape: Tuple, k: int = 64) -> np.ndarray:
+    """Reconstruct dense heatmaps encoded with encode_heatmaps.
+
+    Args:
+        buffer (bytes): Encoded heatmaps
+        encoding (Text): Encoding
+        shape (Tuple): Heatmaps shape, [n_joints, ...]
+        k (int, optional): Number of voxels per joint kept by "topk".
+
+    Returns:
+        np.ndarray: float32 heatmaps
+    """
+    n_joints, n_voxels = shape[0], int(np.prod(shape[1:]))
+    if encoding == "float16":
+        flat = np.frombuffer(buffer, dtype=np.float16).astype(np.float32)
+        return flat.reshape(shape)
+    lo = np.frombuffer(buffer, dtype=np.float32, count=n_joints)
+    offset = lo.nbytes
+    if encoding == "topk":
+        k = min(k, n_voxels)
+        indices = np.frombuffer(buffer, dtype=np.int32, count=n_joints * k, offset=offset)
+        values = np.frombuffer(
+            buffer, dtype=np.float32, count=n_joints * k, offset=offset + indices.nbytes
+        )
+        flat = np.repeat(lo[:, None], n_voxels, axis=1)
+        np.put_along_axis(flat, indices.reshape(n_joints, k), values.reshape(n_joints, k), axis=1)
+        return flat.reshape(shape)
+    if encoding == "uint8":
+        scale = np.frombuffer(buffer, dtype=np.float32, count=n_joints, offset=offset)
+        q = np.frombuffer(
+            buffer, dtype=np.uint8, count=n_joints * n_voxels, offset=offset + scale.nbytes
+        )
+        flat = q.reshape(n_joints, n_voxels) * scale[:, None] + lo[:, None]
+        return flat.astype(np.float32).reshape(shape)
+    raise Exception("Unknown heatmap encoding {}".format(encoding))
+
+
+class HeatmapArchive:
+    """Append-only archive of encoded per-sample heatmaps.
+
+    Samples are appended to shard files, starting a new shard once the
+    current one exceeds shard_mb, and every sample is recorded in an index
+    with its shard, offset and size (and k for "topk"). Reopening an archive appends new shards,
+    and a sample written more than once is read from its latest record.
+    """
+
+    META_FILE = "meta.json"
+    INDEX_FILE = "index.jsonl"
+
+    def __init__(self, path: Text, encoding: Text = "float16", k: int = 64, shard_mb: float = 1024):
+        """Open or create a heatmap archive.
+
+        Args:
+            path (Text): Archive directory
+            encoding (Text, optional): One of HEATMAP_ENCODINGS, see encode_heatmaps.
+            k (int, optional): Number of voxels per joint kept by "topk". Clamped
+                to the number of voxels per joint once the heatmap shape is known.
+            shard_mb (float, optional): Shard size after which a new shard is started.
+        """
+        if encoding not in HEATMAP_ENCODINGS:
+            raise Exception(
+                "heatmap encoding must be one of {}, not {}".format(HEATMAP_ENCODINGS, encoding)
+            )
+        self.path = path
+        self.encoding = encoding
+        self.k = k
+        self.shard_bytes = int(shard_mb * 2 ** 20)
+        self.shape = None
+        os.makedirs(path, exist_ok=True)
+
+        meta_file = os.path.join(path, self.META_FILE)
+        if os.path.exists(meta_file):
+            with open(meta_file, "r") as f:
+                meta = json.load(f)
+            self.shape = tuple(meta["shape"])
+            self.k = min(k, int(np.prod(self.shape[1:])))
+            if (meta["encoding"], meta["k"]) != (encoding, self.k):
+                raise Exception(
+                    "Heatmap archive {} was written with encoding {} (k={})".format(
+                        path, meta["encoding"], meta["k"]
+                    )
+                )
+        self._shard = len(glob.glob(os.path.join(path, "shard_*.bin")))
+        self._file = None
+        self._index = open(os.path.join(path, self.INDEX_FILE), "a")
+
+    def _write_meta(self):
+        with open(os.path.join(self.path, self.META_FILE), "w") as f:
+            json.dump({"encoding": self.encoding, "k": self.k, "shape": list(self.shape)}, f)
+
+    def append(self, sampleID, heatmaps: np.ndarray):
+        """Encode and append the heatmaps of a sample.
+
+        Args:
+            sampleID: Sample ID
+            heatmaps (np.ndarray): Heatmaps, [n_joints, ...]
+        """
+        if self.shape is None:
+            self.shape = tuple(heatmaps.shape)
+            self.k = min(self.k, int(np.prod(self.shape[1:])))
+            self._write_meta()
+        elif tuple(heatmaps.shape) != self.shape:
+            raise Exception(
+                "Heatmaps of shape {} do not match the archive's {}".format(
+                    heatmaps.shape, self.shape
+                )
+            )
+        if self._file is None or self._file.tell() >= self.shard_bytes:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(
+                os.path.join(self.path, "shard_{:05d}.bin".format(self._shard)), "ab"
+            )
+            self._shard += 1
+        buffer = encode_heatmaps(heatmaps, self.encoding, self.k)
+        offset = self._file.tell()
+        self._file.write(buffer)
+        # the index only records samples whose data was written
+        self._file.flush()
+        record = {
+            "sampleID": str(sampleID),
+            "shard": os.path.basename(self._file.name),
+            "offset": offset,
+            "nbytes": len(buffer),
+        }
+        if self.encoding == "topk":
+            record["k"] = self.k
+        self._index.write(json.dumps(record) + "\n")
+        self._index.flush()
+
+    def close(self):
+        """Close the current shard and the index."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._index.close()
+
+
+class HeatmapArchiveReader:
+    """Read dense heatmaps from a HeatmapArchive on demand."""
+
+    def __init__(self, path: Text):
+        """Open a heatmap archive.
+
+        Args:
+            path (Text): Archive directory
+        """
+        self.path = path
+        with open(os.path.join(path, HeatmapArchive.META_FILE), "r") as f:
+            meta = json.load(f)
+        self.encoding = meta["encoding"]
+        self.k = meta["k"]
+        self.shape = tuple(meta["shape"])
+        self.index = {}
+        with open(os.path.join(path, HeatmapArchive.INDEX_FILE), "r") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.index[record["sampleID"]] = record
+
+    def sample_ids(self) -> List:
+        """Sample IDs in the archive, in order of first appearance."""
+        return list(self.index.keys())
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, sampleID) -> bool:
+        return str(sampleID) in self.index
+
+    def __getitem__(self, sampleID) -> np.ndarray:
+        """Dense float32 heatmaps of a sample, [n_joints, ...]."""
+        record = self.index[str(sampleID)]
+        with open(os.path.join(self.path, record["shard"]), "rb") as f:
+            f.seek(record["offset"])
+            buffer = f.read(record["nbytes"])
+        return decode_heatmaps(buffer, self.encoding, self.shape, record.get("k", self.k))
@@ -1,11 +1,15 @@
 """Operations for dannce."""
 import numpy as np
 import cv2
+import threading
 import time
-from typing import Text
+from typing import Dict, Text, Tuple
 import torch
 import torch.nn.functional as F
 
+# Coarsest image pyramid level used when sampling grids (1/16 resolution)
+MAX_MIP_LEVEL = 4
+
 class Camera:
     def __init__(self, R, t, K, tdist, rdist, name=""):
         self.R = torch.tensor(R).float() # rotation matrix
@@ -67,6 +71,86 @@ def camera_matrix(K: np.ndarray, R: np.ndarray, t: np.ndarray) -> np.ndarray:
     """
     return np.concatenate((R, t), axis=0) @ K
 
+
+class CameraBank:
+    """Camera parameters of every experiment as tensors on a device.
+
+    Tensors are built once per experiment, the first time it is requested,
+    so setup cost does not depend on the number of samples and projections
+    index into existing tensors.
+    """
+
+    def __init__(self, camera_params: Dict, camnames: Dict, device: Text):
+        """Initialize the camera bank.
+
+        Args:
+            camera_params (Dict): Camera parameter dictionaries ("K", "R", "t",
+                "RDistort", "TDistort"), by experiment and camera name.
+            camnames (Dict): Camera names of each experiment.
+            device (Text): Torch device holding the tensors.
+        """
+        self.camera_params = camera_params
+        self.camnames = camnames
+        self.device = device
+        self._stacks = {}
+        self._cameras = {}
+        # samples may be generated from several threads
+        self._lock = threading.RLock()
+
+    def __getitem__(self, experimentID: int) -> Dict:
+        """Stacked parameters of all cameras of an experiment.
+
+        Args:
+            experimentID (int): identifier for a video recording session.
+
+        Returns:
+            Dict: "M" [n_cams, 4, 3], "K" [n_cams, 3, 3], "RDistort" [n_cams, 3]
+                (zero-padded) and "TDistort" [n_cams, 2] tensors, in camnames order.
+        """
+        with self._lock:
+            if experimentID not in self._stacks:
+                self._stacks[experimentID] = self._stack(experimentID)
+            return self._stacks[experimentID]
+
+    def _stack(self, experimentID: int) -> Dict:
+        params = [
+            self.camera_params[experimentID][camname]
+            for camname in self.camnames[experimentID]
+        ]
+        rdist = np.zeros((len(params), 3), dtype=np.float32)
+        for c, p in enumerate(params):
+            r = np.ravel(p["RDistort"])[:3]
+            rdist[c, : len(r)] = r
+        stack = {
+            "M": np.stack([camera_matrix(p["K"], p["R"], p["t"]) for p in params]),
+            "K": np.stack([p["K"] for p in params]),
+            "RDistort": rdist,
+            "TDistort": np.stack([np.ravel(p["TDistort"])[:2] for p in params]),
+        }
+        return {
+            key: torch.as_tensor(value, dtype=torch.float32, device=self.device)
+            for key, value in stack.items()
+        }
+
+    def camera(self, experimentID: int, camname: Text) -> Dict:
+        """Parameters of a single camera.
+
+        Args:
+            experimentID (int): identifier for a video recording session.
+            camname (Text): camera name
+
+        Returns:
+            Dict: "M" [4, 3], "K" [3, 3], "RDistort" [3] and "TDistort" [2] tensors.
+        """
+        key = (experimentID, camname)
+        with self._lock:
+            if key not in self._cameras:
+                stack = self[experimentID]
+                c = list(self.camnames[experimentID]).index(camname)
+                self._cameras[key] = {name: value[c] for name, value in stack.items()}
+            return self._cameras[key]
+
+
 def world_to_cam(pts, M, device):
     M = M.to(device=device)
     pts1 = torch.ones(pts.shape[0], 1, dtype=torch.float32, device=device)
@@ -192,6 +276,187 @@ def sample_grid_linear(
     return Ibilin.reshape((c, c, c, -1)).permute(3, 0, 1, 2).unsqueeze(0)
 
 
+def _grid_sample(
+    feats: torch.Tensor, projPts: torch.Tensor, exact: bool = False
+) -> torch.Tensor:
+    """Bilinearly sample images [B, H, W, C] at pixel coordinates [B, N, 2]
+    with torch.nn.functional.grid_sample.
+
+    Coordinates outside the image are clamped to its border. By default the
+    result matches sample_grid_linear, whose weights for the (y0, x1) and
+    (y1, x0) corners use the fractional offsets of the other axis, and whose
+    corners past the image contribute zero: this is standard bilinear
+    interpolation at the point with its fractional offsets swapped and zero
+    padding. With exact, standard bilinear weights are used and the image
+    border is replicated. Returns [B, N, C].
+    """
+    n, fh, fw, fdim = list(feats.shape)
+    feats = feats.permute(0, 3, 1, 2).type(torch.float)
+
+    pts = projPts[..., :2]
+    if exact:
+        padding_mode = "border"
+    else:
+        upper = torch.as_tensor((fw - 1, fh - 1), dtype=pts.dtype, device=pts.device)
+        pts = torch.minimum(torch.clamp(pts, min=0), upper)
+        base = torch.floor(pts)
+        pts = base + (pts - base).flip(-1)
+        padding_mode = "zeros"
+
+    # normalize pixel coordinates to [-1, 1], with -1 and 1 at the centers
+    # of the first and last pixels
+    scale = torch.as_tensor(
+        (2.0 / max(fw - 1, 1), 2.0 / max(fh - 1, 1)),
+        dtype=torch.float32,
+        device=feats.device,
+    )
+    grid = (pts * scale - 1).unsqueeze(1)
+
+    out = F.grid_sample(
+        feats, grid, mode="bilinear", padding_mode=padding_mode, align_corners=True
+    )
+    return out.squeeze(2).permute(0, 2, 1)
+
+
+def sample_grid_gridsample(
+    im: np.ndarray, projPts: np.ndarray, device: Text, exact: bool = False
+) -> torch.Tensor:
+    """Unproject features with bilinear interpolation by grid_sample.
+
+    Matches sample_grid_linear without building per-corner temporaries
+    the size of the voxel grid. With exact, uses standard bilinear weights
+    instead, see _grid_sample.
+    """
+    feats = torch.as_tensor(im.copy(), device=device) if not torch.is_tensor(im) else im
+    c = int(round(projPts.shape[0] ** (1 / 3.0)))
+
+    Ibilin = _grid_sample(feats.unsqueeze(0), projPts.unsqueeze(0), exact)[0]
+
+    return Ibilin.reshape((c, c, c, -1)).permute(3, 0, 1, 2).unsqueeze(0)
+
+
+def projection_roi(projPts: torch.Tensor, shape: Tuple) -> Tuple:
+    """Bounds of the image region read when sampling at projected points.
+
+    The samplers clamp coordinates to the image, then read the pixel at the
+    floor of each coordinate and, with non-zero weight only inside the image,
+    the next one. The region spans the clamped floor of the smallest
+    coordinates to one pixel past the clamped floor of the largest, so it
+    holds every pixel that contributes to a sample. A grid lying entirely
+    outside the image gets the one-pixel-wide border column or row its
+    clamped points fall on.
+
+    Args:
+        projPts (torch.Tensor): Projected points in pixels (x, y), [..., 2]
+        shape (Tuple): Image shape (H, W, ...)
+
+    Returns:
+        Tuple: (x0, y0, x1, y1) pixel bounds, x1 and y1 exclusive. The whole
+            image if any coordinate is not finite.
+    """
+    h, w = shape[:2]
+    pts = projPts[..., :2].reshape(-1, 2)
+    (xmin, ymin), (xmax, ymax) = torch.stack(
+        (pts.amin(dim=0), pts.amax(dim=0))
+    ).tolist()
+    if not np.all(np.isfinite([xmin, ymin, xmax, ymax])):
+        return 0, 0, w, h
+    x0 = int(np.clip(np.floor(xmin), 0, w - 1))
+    y0 = int(np.clip(np.floor(ymin), 0, h - 1))
+    x1 = int(np.clip(np.floor(xmax) + 1, 0, w - 1)) + 1
+    y1 = int(np.clip(np.floor(ymax) + 1, 0, h - 1)) + 1
+    return x0, y0, x1, y1
+
+
+def crop_to_roi(im: np.ndarray, projPts: torch.Tensor, roi: Tuple):
+    """Crop an image to a region and shift projected points into it.
+
+    Args:
+        im (np.ndarray): Image, [H, W, C]
+        projPts (torch.Tensor): Projected points in pixels (x, y), [..., 2]
+        roi (Tuple): (x0, y0, x1, y1) region bounds, x1 and y1 exclusive
+
+    Returns:
+        Tuple: view of the image region and shifted points.
+    """
+    x0, y0, x1, y1 = roi
+    offset = torch.as_tensor((x0, y0), dtype=projPts.dtype, device=projPts.device)
+    return im[y0:y1, x0:x1], projPts[..., :2] - offset
+
+
+def mip_level(projPts: torch.Tensor, max_level: int = MAX_MIP_LEVEL) -> int:
+    """Image pyramid level whose pixel size best matches the projected voxel size.
+
+    The voxel footprint is measured at the center of the grid, as the largest
+    distance, in pixels, between the projections of its neighbors along the
+    three grid axes.
+
+    Args:
+        projPts (torch.Tensor): Projected voxel centers, [c**3, 2]
+        max_level (int, optional): Coarsest level
+
+    Returns:
+        int: Pyramid level, 0 being full resolution.
+    """
+    c = int(round(projPts.shape[0] ** (1 / 3.0)))
+    if c < 2:
+        return 0
+    grid = projPts[:, :2].reshape(c, c, c, 2)
+    m = (c - 1) // 2
+    neighbors = torch.stack((grid[m + 1, m, m], grid[m, m + 1, m], grid[m, m, m + 1]))
+    footprint = float((neighbors - grid[m, m, m]).norm(dim=1).max())
+    if not footprint > 1:
+        return 0
+    return min(int(np.floor(np.log2(footprint))), max_level)
+
+
+def downsample_image(im: np.ndarray, level: int) -> np.ndarray:
+    """Image at a pyramid level, by successive 2x2 box filtering (mipmapping).
+
+    Args:
+        im (np.ndarray): Image, [H, W, C]
+        level (int): Pyramid level
+
+    Returns:
+        np.ndarray: Downsampled image, [~H / 2**level, ~W / 2**level, C]
+    """
+    for _ in range(level):
+        h, w = im.shape[:2]
+        if h < 2 or w < 2:
+            break
+        n_channels = im.shape[-1]
+        im = cv2.resize(im, (w // 2, h // 2), interpolation=cv2.INTER_AREA)
+        if im.ndim == 2:
+            im = im.reshape(*im.shape, n_channels)
+    return im
+
+
+def rescale_coords(projPts: torch.Tensor, shape: Tuple, level_shape: Tuple) -> torch.Tensor:
+    """Map pixel coordinates in an image of a given shape to a resized version of it.
+
+    Args:
+        projPts (torch.Tensor): Pixel coordinates (x, y), [..., 2]
+        shape (Tuple): Original image shape (H, W, ...)
+        level_shape (Tuple): Resized image shape (H, W, ...)
+
+    Returns:
+        torch.Tensor: Pixel coordinates in the resized image, clamped to it.
+    """
+    scale = torch.as_tensor(
+        (level_shape[1] / shape[1], level_shape[0] / shape[0]),
+        dtype=projPts.dtype,
+        device=projPts.device,
+    )
+    # pixel centers are at integer coordinates
+    pts = (projPts[..., :2] + 0.5) * scale - 0.5
+    # points on or past the border of the original image stay on the border
+    # pixels, which the first and last half pixels would otherwise leave
+    upper = torch.as_tensor(
+        (level_shape[1] - 1, level_shape[0] - 1), dtype=pts.dtype, device=pts.device
+    )
+    return torch.minimum(torch.clamp(pts, min=0), upper)
+
+
 def sample_grid(im: np.ndarray, projPts: np.ndarray, device: Text, method: Text = "linear"):
     """Transfer 3d features to 2d by projecting down to 2d grid, using torch.
 
@@ -204,11 +469,167 @@ def sample_grid(im: np.ndarray, projPts: np.ndarray, device: Text, method: Text
         proj_rgb = sample_grid_nearest(im, projPts, device)
     elif method == "linear" or method == "bilinear":
         proj_rgb = sample_grid_linear(im, projPts, device)
+    elif method == "grid_sample":
+        proj_rgb = sample_grid_gridsample(im, projPts, device)
+    elif method == "bilinear_exact":
+        proj_rgb = sample_grid_gridsample(im, projPts, device, exact=True)
     else:
         raise Exception("{} not a valid interpolation method".format(method))
 
     return proj_rgb
 
+def project_to2d_batch(pts: torch.Tensor, Ms: torch.Tensor, device: Text) -> torch.Tensor:
+    """Project 3d points to 2d in several cameras at once.
+
+    Batched version of project_to2d.
+
+    Args:
+        pts (torch.Tensor): 3d points, [N, 3]
+        Ms (torch.Tensor): Stacked camera matrices, [n_cams, 4, 3]
+        device (Text): Torch device
+
+    Returns:
+        torch.Tensor: Projected points, [n_cams, N, 3], with pixel
+            coordinates in the first two columns
+    """
+    Ms = Ms.to(device=device)
+    pts1 = torch.ones(pts.shape[0], 1, dtype=torch.float32, device=device)
+
+    projPts = torch.matmul(torch.cat((pts, pts1), 1).unsqueeze(0), Ms)
+    projPts[..., :2] = projPts[..., :2] / projPts[..., 2:]
+
+    return projPts
+
+
+def distortPoints_batch(
+    points: torch.Tensor,
+    intrinsicMatrices: torch.Tensor,
+    radialDistortions: torch.Tensor,
+    tangentialDistortions: torch.Tensor,
+    device: Text,
+) -> torch.Tensor:
+    """Distort points in several cameras at once.
+
+    Batched version of distortPoints.
+
+    Args:
+        points (torch.Tensor): Pixel coordinates per camera, [n_cams, N, 2]
+        intrinsicMatrices (torch.Tensor): Stacked intrinsic matrices, [n_cams, 3, 3]
+        radialDistortions (torch.Tensor): Stacked radial distortion coefficients,
+            zero-padded to [n_cams, 3]
+        tangentialDistortions (torch.Tensor): Stacked tangential distortion
+            coefficients, [n_cams, 2]
+        device (Text): Torch device
+
+    Returns:
+        torch.Tensor: Distorted pixel coordinates, [n_cams, N, 2]
+    """
+    K = intrinsicMatrices.to(device=device)
+    k = radialDistortions.to(device=device).unsqueeze(1)
+    p = tangentialDistortions.to(device=device).unsqueeze(1)
+
+    # unpack the intrinsic matrices, as [n_cams, 1] to broadcast over points
+    cx, cy = K[:, 2, 0:1], K[:, 2, 1:2]
+    fx, fy = K[:, 0, 0:1], K[:, 1, 1:2]
+    skew = K[:, 1, 0:1]
+
+    # center and normalize the points
+    yNorm = (points[..., 1] - cy) / fy
+    xNorm = (points[..., 0] - cx - skew * yNorm) / fx
+
+    # compute radial distortion
+    r2 = xNorm ** 2 + yNorm ** 2
+    r4 = r2 * r2
+    r6 = r2 * r4
+    alpha = k[..., 0] * r2 + k[..., 1] * r4 + k[..., 2] * r6
+
+    # compute tangential distortion
+    xyProduct = xNorm * yNorm
+    dxTangential = 2 * p[..., 0] * xyProduct + p[..., 1] * (r2 + 2 * xNorm ** 2)
+    dyTangential = p[..., 0] * (r2 + 2 * yNorm ** 2) + 2 * p[..., 1] * xyProduct
+
+    # apply the distortion to the points
+    xDist = xNorm + xNorm * alpha + dxTangential
+    yDist = yNorm + yNorm * alpha + dyTangential
+
+    return torch.stack((xDist * fx + cx + skew * yDist, yDist * fy + cy), dim=-1)
+
+
+def sample_grid_batch(
+    ims: torch.Tensor, projPts: torch.Tensor, device: Text, method: Text = "linear"
+) -> torch.Tensor:
+    """Sample the images of several cameras at their projected grid points at once.
+
+    Batched version of sample_grid, with the same boundary handling. The
+    images are flattened together so that every camera is gathered in a
+    single indexing operation.
+
+    Args:
+        ims (torch.Tensor): Stacked images, [n_cams, H, W, C]
+        projPts (torch.Tensor): Projected grid points per camera, [n_cams, N, 2]
+        device (Text): Torch device
+        method (Text, optional): Interpolation method
+
+    Returns:
+        torch.Tensor: Sampled volumes, [n_cams, C, c, c, c]
+    """
+    feats = torch.as_tensor(ims, device=device)
+    n_cams, fh, fw, fdim = list(feats.shape)
+    c = int(round(projPts.shape[1] ** (1 / 3.0)))
+    feats = feats.reshape(n_cams * fh * fw, fdim)
+    offsets = (
+        torch.arange(n_cams, dtype=torch.long, device=device) * (fh * fw)
+    ).unsqueeze(1)
+
+    def gather(y, x):
+        return feats[offsets + y * fw + x]
+
+    # make sure all projected indices fit onto the feature map
+    im_x = torch.clamp(projPts[..., 0], 0, fw - 1)
+    im_y = torch.clamp(projPts[..., 1], 0, fh - 1)
+
+    if method == "nearest" or method == "out2d":
+        out = gather(im_y.round().type(torch.long), im_x.round().type(torch.long))
+    elif method == "grid_sample" or method == "bilinear_exact":
+        out = _grid_sample(
+            torch.as_tensor(ims, device=device), projPts, method == "bilinear_exact"
+        )
+    elif method == "linear" or method == "bilinear":
+        im_x0 = torch.floor(im_x).type(torch.long)
+        im_y0 = torch.floor(im_y).type(torch.long)
+        im_x1 = im_x0 + 1
+        im_y1 = im_y0 + 1
+        im_x0_f, im_x1_f = im_x0.type(torch.float), im_x1.type(torch.float)
+        im_y0_f, im_y1_f = im_y0.type(torch.float), im_y1.type(torch.float)
+
+        # clip the +1 corners, and zero out the values that fall outside bounds
+        x_out = (im_x1 > fw - 1).unsqueeze(-1)
+        y_out = (im_y1 > fh - 1).unsqueeze(-1)
+        im_x1_safe = torch.clamp(im_x1, 0, fw - 1)
+        im_y1_safe = torch.clamp(im_y1, 0, fh - 1)
+
+        Ia = gather(im_y0, im_x0)
+        Ib = gather(im_y0, im_x1_safe).masked_fill(x_out, 0)
+        Ic = gather(im_y1_safe, im_x0).masked_fill(y_out, 0)
+        Id = gather(im_y1_safe, im_x1_safe).masked_fill(x_out | y_out, 0)
+
+        wa = (im_x1_f - im_x) * (im_y1_f - im_y)
+        wb = (im_x1_f - im_x) * (im_y - im_y0_f)
+        wc = (im_x - im_x0_f) * (im_y1_f - im_y)
+        wd = (im_x - im_x0_f) * (im_y - im_y0_f)
+
+        out = (
+            wa.unsqueeze(-1) * Ia
+            + wb.unsqueeze(-1) * Ib
+            + wc.unsqueeze(-1) * Ic
+            + wd.unsqueeze(-1) * Id
+        )
+    else:
+        raise Exception("{} not a valid interpolation method".format(method))
+
+    return out.reshape((n_cams, c, c, c, -1)).permute(0, 4, 1, 2, 3)
+
+
 def unDistortPoints(
     pts,
     intrinsicMatrix,
@@ -386,6 +807,78 @@ def distortPoints(
 
     return distortedPoints
 
+def grid_profiles(coords):
+    """Reduce the voxel center coordinates of axis-aligned grids to 1D profiles.
+
+    Args:
+        coords: x, y and z coordinates of every voxel, each [B, n0, n1, n2].
+            Each coordinate must vary along a single volume axis.
+
+    Returns:
+        List[torch.Tensor]: x, y and z profiles, each of size n along the axis
+            it varies on and 1 elsewhere, e.g. [B, 1, n1, 1].
+    """
+    profiles = []
+    for c in coords:
+        origin = c[:, :1, :1, :1]
+        lines = [
+            c[:, :, :1, :1],
+            c[:, :1, :, :1],
+            c[:, :1, :1, :],
+        ]
+        profile = origin
+        for line in lines:
+            if line.shape[1:] != origin.shape[1:] and not torch.equal(line, origin.expand_as(line)):
+                profile = line
+                break
+        profiles.append(profile)
+    return profiles
+
+
+def profiles_match(coords, profiles, rtol: float = 1e-5, atol: float = 1e-3) -> bool:
+    """Whether grid profiles reproduce the voxel coordinates they were reduced
+    from, i.e. whether the grids are axis-aligned. Grids rotated by arbitrary
+    angles are not, and need dense coordinates.
+
+    Args:
+        coords: x, y and z coordinates of every voxel, each [B, n0, n1, n2].
+        profiles (List[torch.Tensor]): Profiles from grid_profiles(coords)
+
+    Returns:
+        bool: True if the profiles describe the grids exactly.
+    """
+    return all(
+        torch.allclose(p.expand_as(c), c, rtol=rtol, atol=atol)
+        for c, p in zip(coords, profiles)
+    )
+
+
+def gaussian_targets(centers, profiles, sigma):
+    """3D Gaussian heatmap targets for all samples and joints at once.
+
+    An isotropic Gaussian factorizes across x, y and z, so each target is
+    the outer product of three 1D Gaussians evaluated on the grid profiles.
+
+    Args:
+        centers (torch.Tensor): Gaussian centers (e.g. 3D keypoints), [B, 3, n_joints]
+        profiles (List[torch.Tensor]): x, y and z grid profiles from grid_profiles,
+            or the dense voxel coordinates, each [B, n0, n1, n2], for grids that
+            are not axis-aligned.
+        sigma (float): Gaussian standard deviation
+
+    Returns:
+        torch.Tensor: Targets, [B, n_joints, n0, n1, n2]
+    """
+    targets = None
+    for k, profile in enumerate(profiles):
+        g = torch.exp(
+            -((profile.unsqueeze(1) - centers[:, k, :, None, None, None]) ** 2)
+            / (2 * sigma ** 2)
+        )
+        targets = g if targets is None else targets * g
+    return targets
+
+
 def expected_value_3d(prob_map, grid_centers):
     bs, channels, h, w, d = prob_map.shape
 
@@ -661,13 +661,18 @@ def resplit_social(partition):
 
 def align_social_data(X, X_grid, y, aux, n_animals=2):
     X = X.reshape((n_animals, -1, *X.shape[1:]))
-    X_grid = X_grid.reshape((n_animals, -1, *X_grid.shape[1:]))
+    if isinstance(X_grid, CompactGrids):
+        X_grid = X_grid.with_coms(
+            np.transpose(X_grid.coms.reshape((n_animals, -1, 3)), (1, 0, 2))
+        )
+    else:
+        X_grid = X_grid.reshape((n_animals, -1, *X_grid.shape[1:]))
+        X_grid = np.transpose(X_grid, (1, 0, 2, 3))
     y = y.reshape((n_animals, -1, *y.shape[1:]))
     if aux is not None:
         aux = aux.reshape((n_animals, -1, *aux.shape[1:]))
 
     X = np.transpose(X, (1, 0, 2, 3, 4, 5))
-    X_grid = np.transpose(X_grid, (1, 0, 2, 3))
     y = np.transpose(y, (1, 0, 2, 3))
     if aux is not None:
         aux = np.transpose(aux, (1, 0, 2, 3, 4, 5)) 
@@ -713,64 +718,181 @@ def remove_samples_npy(npydir, samples, params):
 """
 PRELOAD DATA INTO MEMORY
 """
+def _grid_offsets(vmin: float, vmax: float, nvox: int) -> np.ndarray:
+    """Voxel center offsets from the grid COM, [nvox**3, 3], in the same order
+    as the grids built by the 3D generators.
+    """
+    vsize = (vmax - vmin) / nvox
+    steps = (vmin + vsize / 2 + np.arange(nvox) * vsize).astype("float32")
+    x, y, z = np.meshgrid(steps, steps, steps, indexing="xy")
+    return np.stack((x.ravel(), y.ravel(), z.ravel()), axis=1)
+
+
+def grid_from_com(com: np.ndarray, vmin: float, vmax: float, nvox: int) -> np.ndarray:
+    """Voxel center coordinates of grids centered on COMs.
+
+    Args:
+        com (np.ndarray): Grid COMs, [..., 3]
+        vmin (float): Lower bound of the grid relative to the COM
+        vmax (float): Upper bound of the grid relative to the COM
+        nvox (int): Number of voxels along each dimension
+
+    Returns:
+        np.ndarray: Voxel center coordinates, [..., nvox**3, 3]
+    """
+    com = np.asarray(com, dtype="float32")
+    return com[..., np.newaxis, :] + _grid_offsets(vmin, vmax, nvox)
+
+
+def com_from_grid(grid: np.ndarray, vmin: float, vmax: float, nvox: int) -> np.ndarray:
+    """COMs of voxel center grids, the inverse of grid_from_com.
+
+    Args:
+        grid (np.ndarray): Voxel center coordinates, [..., nvox**3, 3]
+        vmin (float): Lower bound of the grid relative to the COM
+        vmax (float): Upper bound of the grid relative to the COM
+        nvox (int): Number of voxels along each dimension
+
+    Returns:
+        np.ndarray: Grid COMs, [..., 3]
+    """
+    vsize = (vmax - vmin) / nvox
+    return (np.asarray(grid)[..., 0, :] - (vmin + vsize / 2)).astype("float32")
+
+
+class CompactGrids:
+    """Voxel center grids stored as their COMs only.
+
+    Indexing returns full grids, built on the fly with grid_from_com, so that
+    this can stand in for a [n_samples, nvox**3, 3] grid array.
+
+    Attributes:
+        coms (np.ndarray): Grid COMs, [n_samples, ..., 3]
+        vmin (float): Lower bound of the grids relative to their COMs
+        vmax (float): Upper bound of the grids relative to their COMs
+        nvox (int): Number of voxels along each dimension
+    """
+
+    def __init__(self, coms: np.ndarray, vmin: float, vmax: float, nvox: int):
+        self.coms = coms
+        self.vmin = vmin
+        self.vmax = vmax
+        self.nvox = nvox
+
+    @property
+    def shape(self):
+        return (*self.coms.shape[:-1], self.nvox ** 3, 3)
+
+    def __len__(self):
+        return len(self.coms)
+
+    def __getitem__(self, index):
+        return grid_from_com(self.coms[index], self.vmin, self.vmax, self.nvox)
+
+    def __setitem__(self, index, grid):
+        self.coms[index] = com_from_grid(grid, self.vmin, self.vmax, self.nvox)
+
+    def with_coms(self, coms: np.ndarray):
+        """Same grid parameters, other COMs."""
+        return CompactGrids(coms, self.vmin, self.vmax, self.nvox)
+
+
 def load_volumes_into_mem(params, logger, partition, n_cams, generator, train=True, silhouette=False, social=False):
     n_samples = len(partition["train_sampleIDs"]) if train else len(partition["valid_sampleIDs"]) 
     message = "Loading training data into memory" if train else "Loading validation data into memory"
     gridsize = tuple([params["nvox"]] * 3)
 
+    # Image volumes are kept as raw uint8 intensities, 4x smaller than float32,
+    # and normalized per sample by PoseDatasetFromMem. Averaged and mono
+    # volumes are not integer-valued, and silhouettes concatenated to the
+    # volumes must not be normalized, so those stay float32.
+    store_uint8 = not (
+        silhouette
+        or generator.var_reg
+        or params["mono"]
+        or params["channel_combo"] == "avg"
+        or params["use_silhouette_in_volume"]
+    )
+
     # initialize vars
     if silhouette:
         X = np.empty((n_samples, *gridsize, 1), dtype="float32")
     else:
-        X = np.empty((n_samples, *gridsize, params["chan_num"]*n_cams), dtype="float32")
+        X = np.empty(
+            (n_samples, *gridsize, params["chan_num"]*n_cams),
+            dtype="uint8" if store_uint8 else "float32",
+        )
     logger.info(message)
 
-    X_grid = np.empty((n_samples, params["nvox"] ** 3, 3), dtype="float32")
+    # grids are translated copies of the same voxel offsets, so with
+    # compact_grids only their COMs are kept
+    if params["compact_grids"]:
+        X_grid = CompactGrids(
+            np.empty((n_samples, 3), dtype="float32"),
+            params["vmin"],
+            params["vmax"],
+            params["nvox"],
+        )
+    else:
+        X_grid = np.empty((n_samples, params["nvox"] ** 3, 3), dtype="float32")
     y = None
-    if params["expval"]:
+    # MAX targets synthesized by the trainer only need the 3D keypoints
+    keypoint_targets = params["expval"] or params["max_targets_on_device"]
+    if keypoint_targets:
         if not silhouette: 
             y = np.empty((n_samples, 3, params["n_channels_out"]), dtype="float32")   
     else:
         y = np.empty((n_samples, *gridsize, params["n_channels_out"]), dtype="float32")
 
-    # load data from generator
-    if social:
-        X = np.reshape(X, (2, -1, *X.shape[1:]))
-        if X_grid is not None:
-            X_grid = np.reshape(X_grid, (2, -1, *X_grid.shape[1:]))
-        if y is not None:
-            y = np.reshape(y, (2, -1, *y.shape[1:]))
-
-        for i in tqdm(range(n_samples//2)):
-            rr = generator.__getitem__(i)
-            for j in range(2):
-                vol = rr[0][0][j]
-                if not silhouette: 
-                    X[j, i] = vol
-                    X_grid[j, i], y[j, i] = rr[0][1][j], rr[1][0][j]
-                else:
-                    X[j, i] = extract_3d_sil(vol)
-                    X_grid[j, i] = rr[0][1][j]
+    # load data from generator. It yields raw intensities for uint8 volumes,
+    # its own normalization setting is restored afterwards
+    norm_im = generator.norm_im
+    if store_uint8:
+        generator.norm_im = False
+    try:
+        if social:
+            X = np.reshape(X, (2, -1, *X.shape[1:]))
+            if isinstance(X_grid, CompactGrids):
+                X_grid = X_grid.with_coms(np.reshape(X_grid.coms, (2, -1, 3)))
+            elif X_grid is not None:
+                X_grid = np.reshape(X_grid, (2, -1, *X_grid.shape[1:]))
+            if y is not None:
+                y = np.reshape(y, (2, -1, *y.shape[1:]))
+
+            for i in tqdm(range(n_samples//2)):
+                rr = generator.__getitem__(i)
+                for j in range(2):
+                    vol = rr[0][0][j]
+                    if not silhouette: 
+                        X[j, i] = vol
+                        X_grid[j, i], y[j, i] = rr[0][1][j], rr[1][0][j]
+                    else:
+                        X[j, i] = extract_3d_sil(vol)
+                        X_grid[j, i] = rr[0][1][j]
 
-        X = np.reshape(X, (-1, *X.shape[2:]))
-        if X_grid is not None:
-            X_grid = np.reshape(X_grid, (-1, *X_grid.shape[2:]))
-        if y is not None:
-            y = np.reshape(y, (-1, *y.shape[2:]))
+            X = np.reshape(X, (-1, *X.shape[2:]))
+            if isinstance(X_grid, CompactGrids):
+                X_grid = X_grid.with_coms(np.reshape(X_grid.coms, (-1, 3)))
+            elif X_grid is not None:
+                X_grid = np.reshape(X_grid, (-1, *X_grid.shape[2:]))
+            if y is not None:
+                y = np.reshape(y, (-1, *y.shape[2:]))
 
-    else:
-        for i in tqdm(range(n_samples)):
-            rr = generator.__getitem__(i)
-            if params["expval"]:
-                vol = rr[0][0][0]
-                if not silhouette: 
-                    X[i] = vol
-                    X_grid[i], y[i] = rr[0][1], rr[1][0]
+        else:
+            for i in tqdm(range(n_samples)):
+                rr = generator.__getitem__(i)
+                if keypoint_targets:
+                    vol = rr[0][0][0]
+                    if not silhouette: 
+                        X[i] = vol
+                        X_grid[i], y[i] = rr[0][1], rr[1][0]
+                    else:
+                        X[i] = extract_3d_sil(vol)
+                        X_grid[i] = rr[0][1]
                 else:
-                    X[i] = extract_3d_sil(vol)
-                    X_grid[i] = rr[0][1]
-            else:
-                X[i], y[i] = rr[0][0], rr[1][0]
+                    X[i], y[i] = rr[0][0], rr[1][0]
+    finally:
+        generator.norm_im = norm_im
 
     if silhouette:
         logger.info("Now loading binary silhouettes")        
@@ -860,6 +982,8 @@ def save_volumes_into_npy(params, npy_generator, missing_npydir, samples, logger
                 if not silhouette:
                     X = rr[0][0][j].astype("uint8")
                     X_grid, y = rr[0][1][j], rr[1][0][j]
+                    if params["compact_grids"]:
+                        X_grid = com_from_grid(X_grid, params["vmin"], params["vmax"], params["nvox"])
 
                     for savedir, data in zip(['image_volumes', "grid_volumes", "targets"], [X, X_grid, y]):
                         outdir = os.path.join(save_root, savedir, fname)
@@ -876,6 +1000,8 @@ def save_volumes_into_npy(params, npy_generator, missing_npydir, samples, logger
             save_root = missing_npydir[exp]
             
             X, X_grid, y = rr[0][0][0].astype("uint8"), rr[0][1][0], rr[1][0] 
+            if params["compact_grids"]:
+                X_grid = com_from_grid(X_grid, params["vmin"], params["vmax"], params["nvox"])
             
             if not silhouette:
                 for savedir, data in zip(['image_volumes', "grid_volumes", "targets"], [X, X_grid, y]):
@@ -1228,6 +1354,10 @@ def savedata_expval(
             "sampleID": sID,
             #"metadata": #prepare_save_metadata(params),
         }
+    # per-joint top-k heatmap voxels, if they were predicted
+    if len(data) > 0 and "topk_values" in data[list(data.keys())[0]]:
+        sdict["topk_values"] = np.stack([data[key]["topk_values"] for key in data.keys()])
+        sdict["topk_indices"] = np.stack([data[key]["topk_indices"] for key in data.keys()])
     if write and data is None:
         sio.savemat(
             fname.split(".pickle")[0] + ".mat",
@@ -1316,18 +1446,15 @@ def __initAvgMax(t, g, o, params):
     Helper function for creating 3D targets
     """
     gridsize = tuple([params["nvox"]] * 3)
-    g = np.reshape(
-        g,
-        (-1, *gridsize, 3),
-    )
 
     for i in range(o.shape[0]):
+        gi = np.reshape(g[i], (*gridsize, 3))
         for j in range(o.shape[-1]):
             o[i, ..., j] = np.exp(
                 -(
-                    (g[i, ..., 1] - t[i, 1, j]) ** 2
-                    + (g[i, ..., 0] - t[i, 0, j]) ** 2
-                    + (g[i, ..., 2] - t[i, 2, j]) ** 2
+                    (gi[..., 1] - t[i, 1, j]) ** 2
+                    + (gi[..., 0] - t[i, 0, j]) ** 2
+                    + (gi[..., 2] - t[i, 2, j]) ** 2
                 )
                 / (2 * params["sigma"] ** 2)
             )
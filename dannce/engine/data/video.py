@@ -1,14 +1,524 @@
 """ Video reading and writing interfaces for different formats. """
 from copy import Error
+import abc
 import os
+import bisect
 import cv2
 import numpy as np
 import attr
 import multiprocessing
+import threading
+import queue
 import imageio
 import time
+import shutil
+import subprocess
+import warnings
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Tuple, Text
 
+# Largest forward jump (in frames) that is decoded through rather than seeked.
+# Seeking lands on the previous keyframe and decodes from there anyway, so for
+# short gaps grabbing the intermediate frames is never slower.
+MAX_STREAM_GAP = 64
+
+# Distance (in frames) from the end of a chunk at which the next chunk is
+# opened in the background.
+PREOPEN_FRAMES = 100
+
+
+class FrameCache:
+    """
+    Least-recently-used cache of decoded video frames, bounded in bytes.
+    A single instance is shared by all frame loaders of the process so that
+    a frame requested by several generators (e.g. social instances, silhouette
+    generators, overlapping temporal chunks) is decoded only once.
+    Cached frames are shared with the caller and must not be modified in place.
+    Args:
+        max_bytes: Byte budget of the cache. 0 disables caching.
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: Tuple) -> np.ndarray:
+        """Return the cached frame for key, or None on a miss."""
+        with self._lock:
+            frame = self._frames.get(key, None)
+            if frame is None:
+                self.misses += 1
+                return None
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return frame
+
+    def put(self, key: Tuple, frame: np.ndarray):
+        """Insert a frame, evicting the least recently used ones over budget."""
+        if frame.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._frames:
+                self.nbytes -= self._frames.pop(key).nbytes
+            self._frames[key] = frame
+            self.nbytes += frame.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._frames.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def resize(self, max_bytes: int):
+        """Change the byte budget, evicting frames if needed."""
+        with self._lock:
+            self.max_bytes = int(max_bytes)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._frames.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict:
+        """Return hit/miss counters and current occupancy."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total > 0 else 0.0,
+                "frames": len(self._frames),
+                "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class ChunkIndex:
+    """
+    Resolves global frame numbers of a recording split into chunked video
+    files (named by their first frame) to the file and the frame within it,
+    using a binary search over the chunk start frames.
+    Args:
+        first_frames: Sorted first frame of each chunk
+        paths: Video file of each chunk, None for chunks without a reader
+        keynames: Reader key of each chunk, used in error messages
+    """
+
+    def __init__(self, first_frames: List, paths: List, keynames: List):
+        self.first_frames = [int(f) for f in first_frames]
+        self.paths = paths
+        self.keynames = keynames
+
+    @classmethod
+    def from_chunks(
+        cls, camname: Text, chunks: List, vidreaders: Dict, extension: Text = ".mp4"
+    ) -> "ChunkIndex":
+        """Build the index of one camera.
+
+        Args:
+            camname: Camera name
+            chunks: First frame of each chunk, as produced by processing.load_expdict
+            vidreaders: Reader keys of this camera mapped to video file paths
+            extension: Video extension
+        """
+        keynames = [os.path.join(camname, str(f) + extension) for f in chunks]
+        paths = [vidreaders.get(key, None) for key in keynames]
+        return cls(chunks, paths, keynames)
+
+    def resolve(self, ind: int) -> Tuple[Text, int]:
+        """Return the video file containing frame ind and the frame number within it."""
+        i = bisect.bisect_right(self.first_frames, ind) - 1
+        if i < 0:
+            raise IndexError(f"Frame {ind} precedes the first video chunk.")
+        if self.paths[i] is None:
+            raise KeyError(self.keynames[i])
+        return self.paths[i], int(ind - self.first_frames[i])
+
+
+# chunk indexes shared by all frame loaders of the process, see get_chunk_index
+_CHUNK_INDEXES = {}
+
+
+def get_chunk_index(
+    camname: Text, chunks: List, vidreaders: Dict, extension: Text = ".mp4"
+) -> ChunkIndex:
+    """Return the ChunkIndex of a camera, building it on first use.
+
+    Indexes are shared across generators. The first chunk's file path is part
+    of the key, so recordings of the same camera read from different video
+    directories (e.g. silhouette videos) get separate indexes.
+    """
+    first_key = os.path.join(camname, str(chunks[0]) + extension) if len(chunks) else None
+    key = (
+        camname,
+        extension,
+        tuple(int(c) for c in chunks),
+        vidreaders.get(first_key, None),
+    )
+    index = _CHUNK_INDEXES.get(key, None)
+    if index is None:
+        index = ChunkIndex.from_chunks(camname, chunks, vidreaders, extension)
+        _CHUNK_INDEXES[key] = index
+    return index
+
+
+class ReaderPool:
+    """
+    Keeps the most recently used video readers of each camera open, so that
+    alternating between chunks does not reopen files, and opens upcoming
+    chunks ahead of time.
+    Readers of the same physical camera across experiments (camera names
+    sharing the part after the experiment prefix) share the pool slots.
+    Opening and closing run on a background thread, so a slow ffmpeg start or
+    shutdown never blocks frame requests that do not need that reader.
+    Readers are not thread-safe: callers decode while holding lock(path), and
+    an evicted reader is only closed once its lock is free.
+    close() closes all readers and stops the background thread. A closed pool
+    can be used again, and then starts a new thread.
+    Args:
+        predict_flag: If True, uses imageio rather than OpenCV
+        size: Number of readers kept open per camera
+        n_open_attempts: Attempts to open a file before giving up
+        open_backoff: Delay before the first reopen attempt (s), doubled after
+            each failure
+        use_keyframe_index: If True, OpenCV readers seek using the keyframe
+            index of their video
+    """
+
+    def __init__(
+        self,
+        predict_flag: bool,
+        size: int = 2,
+        n_open_attempts: int = 5,
+        open_backoff: float = 0.05,
+        use_keyframe_index: bool = False,
+    ):
+        self.predict_flag = predict_flag
+        self.use_keyframe_index = use_keyframe_index
+        self.seek_stats = SeekStats()
+        self.size = max(int(size), 1)
+        self.n_open_attempts = n_open_attempts
+        self.open_backoff = open_backoff
+        self._readers = {}
+        self._pending = {}
+        self._path_locks = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._closing = False
+
+    def _submit(self, fn, *args):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            return self._executor.submit(fn, *args)
+
+    def lock(self, path: Text) -> threading.Lock:
+        """Lock to hold while using the reader of path."""
+        with self._lock:
+            return self._path_locks.setdefault(path, threading.Lock())
+
+    @staticmethod
+    def _group(camname: Text) -> Text:
+        # Assumes the camera names do not contain underscores other than the expid.
+        return camname.split("_")[-1]
+
+    def _open(self, path: Text):
+        # use imageio for prediction, because linear seeking
+        # is faster with imageio than opencv
+        delay = self.open_backoff
+        for attempt in range(self.n_open_attempts):
+            try:
+                if self.predict_flag:
+                    return imageio.get_reader(path)
+                vid = MediaVideo(
+                    path,
+                    grayscale=False,
+                    keyframes=load_keyframe_index(path) if self.use_keyframe_index else None,
+                    seek_stats=self.seek_stats,
+                )
+                # MediaVideo opens lazily, force it here
+                vid.frames
+                return vid
+            except (OSError, IOError, RuntimeError):
+                # Files can lock while other processes are accessing them
+                if attempt == self.n_open_attempts - 1:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+    def _close(self, vid):
+        if self.predict_flag:
+            vid.close()
+        elif vid._reader_ is not None:
+            vid._reader_.release()
+
+    def _close_idle(self, path: Text, vid):
+        lock = self.lock(path)
+        # while closing, no open is queued behind this close, so wait
+        if not lock.acquire(timeout=-1 if self._closing else 0.05):
+            # still decoding, retry after the other queued opens and closes
+            self._submit(self._close_idle, path, vid)
+            return
+        try:
+            self._close(vid)
+        finally:
+            lock.release()
+
+    def _insert(self, group: Text, path: Text, vid):
+        # callers hold self._lock
+        readers = self._readers.setdefault(group, OrderedDict())
+        readers[path] = vid
+        readers.move_to_end(path)
+        while len(readers) > self.size:
+            evicted_path, evicted = readers.popitem(last=False)
+            self._submit(self._close_idle, evicted_path, evicted)
+
+    def get(self, camname: Text, path: Text):
+        """Return an open reader of path, opening it if needed."""
+        group = self._group(camname)
+        with self._lock:
+            readers = self._readers.get(group, {})
+            if path in readers:
+                readers.move_to_end(path)
+                return readers[path]
+            pending = self._pending.pop(path, None)
+
+        if pending is not None:
+            vid = pending.result()
+        else:
+            print("Loading new video: {} for {}".format(path.split("/")[-1], camname))
+            vid = self._open(path)
+
+        with self._lock:
+            self._insert(group, path, vid)
+        return vid
+
+    def open_ahead(self, camname: Text, path: Text):
+        """Start opening path in the background unless it is already open."""
+        group = self._group(camname)
+        with self._lock:
+            if path in self._readers.get(group, {}) or path in self._pending:
+                return
+            self._pending[path] = self._submit(self._open, path)
+
+    def reopen(self, camname: Text, path: Text):
+        """Drop the reader of path and open it again, e.g. after a failed read."""
+        group = self._group(camname)
+        with self._lock:
+            vid = self._readers.get(group, {}).pop(path, None)
+        if vid is not None:
+            self._submit(self._close_idle, path, vid)
+        return self.get(camname, path)
+
+    def close(self):
+        """Close all readers and stop the background thread."""
+        self._closing = True
+        try:
+            with self._lock:
+                readers = [vid for group in self._readers.values() for vid in group.values()]
+                pending = list(self._pending.values())
+                self._readers = {}
+                self._pending = {}
+            for future in pending:
+                try:
+                    readers.append(future.result())
+                except (OSError, IOError, RuntimeError):
+                    pass
+            # finishes the queued closes of evicted readers
+            with self._executor_lock:
+                executor, self._executor = self._executor, None
+            if executor is not None:
+                executor.shutdown(wait=True)
+        finally:
+            self._closing = False
+        for vid in readers:
+            self._close(vid)
+
+
+# process-wide decoded frame cache, disabled until given a budget
+FRAME_CACHE = FrameCache()
+
+
+def configure_frame_cache(size_mb: float):
+    """Set the byte budget of the process-wide frame cache, in megabytes."""
+    FRAME_CACHE.resize(int((size_mb or 0) * 1024 ** 2))
+
+
+class SeekStats:
+    """
+    Counters describing how frame requests were positioned in their videos,
+    for benchmarking seek strategies. Shared by all readers of a frame loader.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.seeks = 0
+            self.decoded_through = 0
+            self.elapsed = 0.0
+
+    def record(self, seeked: bool, decoded_through: int, elapsed: float):
+        """Record one request.
+
+        Args:
+            seeked: Whether the decoder was repositioned with a seek
+            decoded_through: Frames decoded and discarded to reach the request
+            elapsed: Time spent positioning and reading the frame (s)
+        """
+        with self._lock:
+            self.requests += 1
+            self.seeks += int(seeked)
+            self.decoded_through += decoded_through
+            self.elapsed += elapsed
+
+    def summary(self) -> Dict:
+        with self._lock:
+            n = max(self.requests, 1)
+            return {
+                "requests": self.requests,
+                "seeks": self.seeks,
+                "decoded_through": self.decoded_through,
+                "mean_decoded_through": self.decoded_through / n,
+                "mean_request_time": self.elapsed / n,
+            }
+
+
+# Use sidecar keyframe indexes to position MediaVideo readers, see configure_seeking
+_USE_KEYFRAME_INDEX = False
+
+# keyframe indexes loaded by this process, by video file
+_KEYFRAME_INDEXES = {}
+
+
+def configure_seeking(use_keyframe_index: bool):
+    """Enable or disable keyframe-index based seeking for new frame loaders."""
+    global _USE_KEYFRAME_INDEX
+    _USE_KEYFRAME_INDEX = bool(use_keyframe_index)
+
+
+def keyframe_index_path(filename: Text) -> Text:
+    """Sidecar file holding the keyframe index of a video.
+
+    The leading underscore keeps it out of the video file listings.
+    """
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, "_" + basename + ".keyframes.npy")
+
+
+def scan_keyframes(filename: Text) -> np.ndarray:
+    """Find the keyframes of a video with ffprobe, without decoding it.
+
+    Args:
+        filename: Path to the video file
+
+    Returns:
+        np.ndarray: Frame indices (in display order) of the keyframes
+
+    Raises:
+        ValueError: If some packets have no timestamp, so that their display
+            order, and with it the index of every later frame, is unknown.
+    """
+    ffprobe = shutil.which("ffprobe")
+    if ffprobe is None:
+        raise FileNotFoundError("ffprobe is required to scan video keyframes.")
+
+    out = subprocess.run(
+        [
+            ffprobe, "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "packet=pts,flags", "-of", "csv=p=0", filename,
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+    pts, is_key = [], []
+    for line in out.splitlines():
+        fields = line.strip().split(",")
+        if len(fields) < 2:
+            continue
+        if not fields[0].lstrip("-").isdigit():
+            raise ValueError(f"{filename} has packets without a timestamp.")
+        pts.append(int(fields[0]))
+        is_key.append("K" in fields[1])
+
+    # packets come in decoding order, sort them into display order
+    order = np.argsort(pts, kind="stable")
+    return np.flatnonzero(np.asarray(is_key, dtype=bool)[order])
+
+
+def load_keyframe_index(filename: Text, scan: bool = True) -> np.ndarray:
+    """Load the keyframe index of a video from its sidecar file.
+
+    Args:
+        filename: Path to the video file
+        scan: If True, scan the video when the sidecar is missing or older
+            than the video, and write a new sidecar
+
+    Returns:
+        np.ndarray: Keyframe indices, or None if unavailable
+    """
+    if filename in _KEYFRAME_INDEXES:
+        return _KEYFRAME_INDEXES[filename]
+    sidecar = keyframe_index_path(filename)
+    if os.path.isfile(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(filename):
+        _KEYFRAME_INDEXES[filename] = np.load(sidecar)
+        return _KEYFRAME_INDEXES[filename]
+    if not scan:
+        return None
+
+    try:
+        keyframes = scan_keyframes(filename)
+    except (OSError, ValueError, subprocess.CalledProcessError) as err:
+        warnings.warn(f"Could not index keyframes of {filename}: {err}")
+        return None
+    if len(keyframes) == 0:
+        return None
+
+    try:
+        np.save(sidecar, keyframes)
+    except OSError:
+        # read-only video directory, keep the index for this run only
+        pass
+    _KEYFRAME_INDEXES[filename] = keyframes
+    return keyframes
+
+
+def build_keyframe_indexes(vidreaders: Dict, n_threads: int = 8):
+    """Write sidecar keyframe indexes for every video of a vidreaders dict.
+
+    Indexing all videos up front, with several ffprobe processes at once,
+    spares the frame loaders (and their decoder processes) from scanning
+    videos on first access.
+
+    Args:
+        vidreaders: Camera names mapped to dicts of video file paths, as made
+            by processing.initialize_all_vids
+        n_threads: Number of videos scanned concurrently
+    """
+    filenames = sorted(
+        {filename for files in vidreaders.values() for filename in files.values()}
+    )
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        list(executor.map(load_keyframe_index, filenames))
+
 
 @attr.s(auto_attribs=True, eq=False, order=False)
 class MediaVideo:
@@ -31,6 +541,10 @@ class MediaVideo:
     dataset: str = attr.ib(default="")
     input_format: str = attr.ib(default="")
 
+    # Sorted keyframe indices used to position the decoder, see load_keyframe_index
+    keyframes: np.ndarray = attr.ib(default=None, eq=False, repr=False)
+    seek_stats: SeekStats = attr.ib(default=None, eq=False, repr=False)
+
     _detect_grayscale = False
     _reader_ = None
     _test_frame_ = None
@@ -137,15 +651,45 @@ def reset(self):
         """Reloads the video."""
         self._reader_ = None
 
-    def get_frame(self, idx: int, grayscale: bool = None) -> np.ndarray:
-        """See :class:`Video`."""
+    def get_frame(
+        self, idx: int, grayscale: bool = None, max_forward: int = 0
+    ) -> np.ndarray:
+        """See :class:`Video`.
 
+        Args:
+            idx: Frame index
+            grayscale: Whether to return a single channel frame
+            max_forward: If the requested frame lies at most this many frames
+                ahead of the current decoder position, decode forward to it
+                instead of seeking. Ignored when keyframes are known.
+        """
+
+        ts = time.perf_counter()
         with self.__lock:
-            if self.__reader.get(cv2.CAP_PROP_POS_FRAMES) != idx:
-                self.__reader.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            pos = int(self.__reader.get(cv2.CAP_PROP_POS_FRAMES))
+            start, seek = pos, False
+            if pos != idx:
+                if self.keyframes is not None:
+                    # A seek has to decode from the preceding keyframe anyway,
+                    # so only seek when the decoder is not already within the GOP
+                    key = self.keyframes[
+                        max(np.searchsorted(self.keyframes, idx, side="right") - 1, 0)
+                    ]
+                    if not key <= pos < idx:
+                        start, seek = int(key), True
+                elif not 0 < idx - pos <= max_forward:
+                    start, seek = idx, True
+
+                if seek:
+                    self.__reader.set(cv2.CAP_PROP_POS_FRAMES, start)
+                for _ in range(idx - start):
+                    self.__reader.grab()
 
             success, frame = self.__reader.read()
 
+        if self.seek_stats is not None:
+            self.seek_stats.record(seek, idx - start, time.perf_counter() - ts)
+
         if not success or frame is None:
             raise KeyError(f"Unable to load frame {idx} from {self}.")
 
@@ -161,7 +705,259 @@ def get_frame(self, idx: int, grayscale: bool = None) -> np.ndarray:
         return frame
 
 
-class LoadVideoFrame:
+class FrameStore:
+    """
+    Reader of video frames pre-extracted by extract_labeled_frames: one
+    memory-mapped uint8 array of frames per camera, plus the sorted frame
+    indices of its rows. Frames are served without any decoding.
+    Args:
+        store_dir: Directory written by extract_labeled_frames
+    """
+
+    META_FILE = "frame_store.json"
+
+    def __init__(self, store_dir: Text):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, self.META_FILE), "r") as f:
+            meta = json.load(f)
+        self.crop_height = meta["crop_height"]
+        self.crop_width = meta["crop_width"]
+        self.frames, self.index = {}, {}
+        for camname, (frames_file, index_file) in meta["cameras"].items():
+            self.frames[camname] = np.load(
+                os.path.join(store_dir, frames_file), mmap_mode="r"
+            )
+            self.index[camname] = np.load(os.path.join(store_dir, index_file))
+
+    @classmethod
+    def exists(cls, store_dir: Text) -> bool:
+        return store_dir is not None and os.path.isfile(
+            os.path.join(store_dir, cls.META_FILE)
+        )
+
+    def serves_crop(self, crop_height: Tuple = None, crop_width: Tuple = None) -> bool:
+        """Whether the stored frames contain the crop (crop_height, crop_width),
+        given in full frame coordinates, so that it can be served without decoding.
+        """
+        stored_crop = (self.crop_height, self.crop_width)
+        for frames in self.frames.values():
+            if len(frames) > 0 and _recrop(
+                frames[0], stored_crop, (crop_height, crop_width)
+            ) is None:
+                return False
+        return True
+
+    def covers(self, datadict: Dict) -> bool:
+        """Whether every frame referenced by a label datadict is in the store."""
+        for entry in datadict.values():
+            for camname, ind in entry["frames"].items():
+                if self._row(int(ind), camname) is None:
+                    return False
+        return True
+
+    def _row(self, ind: int, camname: Text) -> int:
+        index = self.index.get(camname, None)
+        if index is None:
+            return None
+        row = np.searchsorted(index, ind)
+        if row == len(index) or index[row] != ind:
+            return None
+        return int(row)
+
+    def get(
+        self, ind: int, camname: Text, crop_height: Tuple = None, crop_width: Tuple = None
+    ) -> np.ndarray:
+        """Return a stored frame, cropped to (crop_height, crop_width).
+
+        Args:
+            ind (int): Frame index
+            camname (Text): Camera name
+            crop_height (Tuple, optional): (first, last) pixels in image height
+                of the full frame. None for the full height.
+            crop_width (Tuple, optional): (first, last) pixels in image width
+                of the full frame. None for the full width.
+
+        Returns:
+            np.ndarray: The frame, or None if it is not stored or the stored
+                crop does not contain the requested one.
+        """
+        row = self._row(ind, camname)
+        if row is None:
+            return None
+        im = self.frames[camname][row]
+        return _recrop(im, (self.crop_height, self.crop_width), (crop_height, crop_width))
+
+
+def _recrop(im, stored_crop, crop):
+    """Crop an image that was itself cropped with stored_crop to crop, both
+    given in full frame coordinates as ((h0, h1), (w0, w1)); None stands for
+    the full extent. Returns None if crop is not inside stored_crop.
+
+    Like numpy slicing, crops reaching past the frame are clipped to it. A
+    stored image shorter than its crop reaches the end of the frame, so the
+    requested crop is clipped to it as well.
+    """
+    slices = []
+    for axis, (stored, wanted) in enumerate(zip(stored_crop, crop)):
+        stored = stored if stored is not None else (0, None)
+        # whether the stored image extends to the end of the frame
+        to_frame_end = stored[1] is None or stored[0] + im.shape[axis] < stored[1]
+        if wanted is None:
+            if stored[0] != 0 or not to_frame_end:
+                return None
+            slices.append(slice(None))
+            continue
+        start = wanted[0] - stored[0]
+        stop = wanted[1] - stored[0]
+        if to_frame_end:
+            stop = min(stop, im.shape[axis])
+        if start < 0 or stop > im.shape[axis]:
+            return None
+        slices.append(slice(start, stop))
+    return im[tuple(slices)]
+
+
+def extract_labeled_frames(
+    datadict: Dict,
+    vidreaders: Dict,
+    chunks: Dict,
+    store_dir: Text,
+    crop_height: Tuple = None,
+    crop_width: Tuple = None,
+    predict_flag: bool = False,
+) -> FrameStore:
+    """Extract the video frames referenced by a label datadict into a FrameStore.
+
+    Frames are decoded in increasing order per camera, so that each video is
+    read sequentially, and cropped before they are written.
+
+    Args:
+        datadict (Dict): Label dictionary mapping sample IDs to their "frames" per camera
+        vidreaders (Dict): Dictionary of all video file paths
+        chunks (Dict): Array of chunked video indices for each camera
+        store_dir (Text): Output directory
+        crop_height (Tuple, optional): (first, last) pixels in image height to keep.
+        crop_width (Tuple, optional): (first, last) pixels in image width to keep.
+        predict_flag (bool, optional): If True, uses imageio rather than OpenCV
+
+    Returns:
+        FrameStore: Reader of the extracted frames.
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    # invalidate a previous store first, so that an interrupted re-extraction
+    # is not mistaken for a complete one
+    meta_file = os.path.join(store_dir, FrameStore.META_FILE)
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+
+    frames = {}
+    for entry in datadict.values():
+        for camname, ind in entry["frames"].items():
+            frames.setdefault(camname, set()).add(int(ind))
+
+    loader = LoadVideoFrame(
+        chunks, vidreaders, {0: list(frames.keys())}, predict_flag, frame_cache=FrameCache(0)
+    )
+    crop = (
+        slice(*crop_height) if crop_height is not None else slice(None),
+        slice(*crop_width) if crop_width is not None else slice(None),
+    )
+
+    cameras = {}
+    for camname, inds in frames.items():
+        inds = np.array(sorted(inds), dtype=np.int64)
+        extension = "." + list(vidreaders[camname].keys())[0].rsplit(".")[-1]
+        frames_file = f"{camname}_frames.npy"
+        index_file = f"{camname}_index.npy"
+        print("Extracting {} frames for {}".format(len(inds), camname))
+
+        im = loader.load_vid_frame(inds[0], camname, extension)[crop]
+        out = np.lib.format.open_memmap(
+            os.path.join(store_dir, frames_file),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(len(inds), *im.shape),
+        )
+        out[0] = im
+        for i in range(1, len(inds)):
+            out[i] = loader.load_vid_frame(inds[i], camname, extension)[crop]
+        out.flush()
+        del out
+        np.save(os.path.join(store_dir, index_file), inds)
+        cameras[camname] = (frames_file, index_file)
+    loader.close()
+
+    # the metadata is written last, so a store interrupted mid-extraction is not used
+    with open(os.path.join(store_dir, FrameStore.META_FILE), "w") as f:
+        json.dump(
+            {
+                "crop_height": list(crop_height) if crop_height is not None else None,
+                "crop_width": list(crop_width) if crop_width is not None else None,
+                "cameras": cameras,
+            },
+            f,
+        )
+    return FrameStore(store_dir)
+
+
+class BaseFrameLoader(abc.ABC):
+    """
+    Shared interface of the video frame loaders.
+    Attributes:
+        frame_store: Optional FrameStore consulted before decoding.
+    """
+
+    frame_store = None
+
+    @abc.abstractmethod
+    def load_vid_frame(
+        self, ind: int, camname: Text, extension: Text = ".mp4"
+    ) -> np.ndarray:
+        """Load a full video frame from a single camera.
+
+        Args:
+            ind (int): Frame index
+            camname (Text): Camera name
+            extension (Text, optional): Video extension
+
+        Returns:
+            np.ndarray: Video frame as h x w x c numpy ndarray
+        """
+
+    def load_cropped_frame(
+        self,
+        ind: int,
+        camname: Text,
+        crop_height: Tuple,
+        crop_width: Tuple,
+        extension: Text = ".mp4",
+    ) -> np.ndarray:
+        """Load a video frame cropped to (crop_height, crop_width).
+
+        Frames pre-extracted into the frame store with a compatible crop are
+        served without decoding.
+
+        Args:
+            ind (int): Frame index
+            camname (Text): Camera name
+            crop_height (Tuple): (first, last) pixels in image height
+            crop_width (Tuple): (first, last) pixels in image width
+            extension (Text, optional): Video extension
+
+        Returns:
+            np.ndarray: Cropped video frame
+        """
+        if self.frame_store is not None:
+            im = self.frame_store.get(ind, camname, crop_height, crop_width)
+            if im is not None:
+                return im
+        return self.load_vid_frame(ind, camname, extension)[
+            crop_height[0] : crop_height[1], crop_width[0] : crop_width[1]
+        ]
+
+
+class LoadVideoFrame(BaseFrameLoader):
     """
     This class generalized load_vid_frame for access by all generators
     Args:
@@ -169,22 +965,70 @@ class LoadVideoFrame:
         vidreaders: Dictionary of all video file paths
         camnames: All Camera names
         predict_flag: If True, uses imageio rather than OpenCV
+        max_stream_gap: Largest forward jump between consecutive requests of a
+            camera that is served by decoding forward instead of seeking.
+            0 disables streaming.
+        frame_cache: Cache of decoded frames consulted before decoding.
+            Defaults to the process-wide FRAME_CACHE.
+        n_readers: Number of video readers kept open per camera.
+        preopen_frames: Open the next chunk once a request is within this many
+            frames of its start. 0 disables opening ahead.
+        use_keyframe_index: If True, seek using sidecar keyframe indexes (OpenCV
+            readers only). Defaults to the setting of configure_seeking.
     """
 
-    def __init__(self, _N_VIDEO_FRAMES, vidreaders, camnames, predict_flag):
+    def __init__(
+        self,
+        _N_VIDEO_FRAMES,
+        vidreaders,
+        camnames,
+        predict_flag,
+        max_stream_gap=MAX_STREAM_GAP,
+        frame_cache=None,
+        n_readers=2,
+        preopen_frames=PREOPEN_FRAMES,
+        use_keyframe_index=None,
+    ):
 
         self._N_VIDEO_FRAMES = _N_VIDEO_FRAMES
         self.vidreaders = vidreaders
         self.camnames = camnames
         self.predict_flag = predict_flag
+        self.max_stream_gap = max_stream_gap
+        self.frame_cache = FRAME_CACHE if frame_cache is None else frame_cache
+        self.prefetcher = None
+        # per-camera frame -> (video file, local frame) lookup, see ChunkIndex
+        self.chunk_index = {}
+
+        self.preopen_frames = preopen_frames
+        # we keep recently used video objects open so we don't open a new one every time
+        if use_keyframe_index is None:
+            use_keyframe_index = _USE_KEYFRAME_INDEX
+        self.readers = ReaderPool(
+            predict_flag, size=n_readers, use_keyframe_index=use_keyframe_index
+        )
 
-        # we keep a running video object so at least we don't open a new one every time
-        self.currvideo = {}
-        self.currvideo_name = {}
-        for dd in camnames.keys():
-            for cc in camnames[dd]:
-                self.currvideo[cc] = None
-                self.currvideo_name[cc] = None
+        # reader and last frame number decoded from each (camera, video), used
+        # to detect monotonically increasing (streamable) requests
+        self.last_frame = {}
+
+    def start_prefetch(self, schedule: Dict, extension: Text = ".mp4", depth: int = 8):
+        """Start decoding the scheduled frames of each camera in the background.
+
+        Args:
+            schedule (Dict): Camera names mapped to the ordered frame indices
+                that will be requested from this loader.
+            extension (Text, optional): Video extension
+            depth (int, optional): Maximum number of decoded frames buffered per camera
+        """
+        self.stop_prefetch()
+        self.prefetcher = FramePrefetcher(self, schedule, extension, depth)
+
+    def stop_prefetch(self):
+        """Stop background decoding and release the prefetch readers."""
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
 
     def load_vid_frame(
         self, ind: int, camname: Text, extension: Text = ".mp4"
@@ -201,76 +1045,107 @@ def load_vid_frame(
         Returns:
             np.ndarray: Video frame as w x h x c numpy ndarray
         """
-        chunks = self._N_VIDEO_FRAMES[camname]
-        cur_video_id = np.nonzero([c <= ind for c in chunks])[0][-1]
-        cur_first_frame = chunks[cur_video_id]
-        fname = str(cur_first_frame) + extension
-        frame_num = int(ind - cur_first_frame)
-
-        keyname = os.path.join(camname, fname)
-
-        thisvid_name = self.vidreaders[camname][keyname]
-        abname = thisvid_name.split("/")[-1]
-        if abname == self.currvideo_name[camname]:
-            vid = self.currvideo[camname]
-        else:
-            # use imageio for prediction, because linear seeking
-            # is faster with imageio than opencv
-            try:
-                vid = (
-                    imageio.get_reader(thisvid_name)
-                    if self.predict_flag
-                    else MediaVideo(thisvid_name, grayscale=False)
-                )
-            except (OSError, IOError, RuntimeError):
-                time.sleep(2)
-                vid = (
-                    imageio.get_reader(thisvid_name)
-                    if self.predict_flag
-                    else MediaVideo(thisvid_name, grayscale=False)
-                )
-            print("Loading new video: {} for {}".format(abname, camname))
-            self.currvideo_name[camname] = abname
-            # close current vid
-            # Without a sleep here, ffmpeg can hang on video close
-            time.sleep(0.25)
-
-            # Close previously opened and unneeded videos by their camera name
-            # Assumes the camera names do not contain underscores other than the expid. 
-            # previous_camera_name = "_".join(camname.split("_")[1:])
-            previous_camera_name = camname.split("_")[-1]
-            for key, value in self.currvideo.items():
-                if previous_camera_name in key:
-                    if value is not None:
-                        self.currvideo[
-                            key
-                        ].close() if self.predict_flag else self.currvideo[
-                            key
-                        ]._reader_.release()
-            self.currvideo[camname] = vid
-        im = self._load_frame_multiple_attempts(frame_num, vid)
+        if self.frame_store is not None:
+            im = self.frame_store.get(ind, camname)
+            if im is not None:
+                return im
+
+        if self.prefetcher is not None:
+            im = self.prefetcher.get(ind, camname)
+            if im is not None:
+                return im
+
+        if camname not in self.chunk_index:
+            self.chunk_index[camname] = get_chunk_index(
+                camname, self._N_VIDEO_FRAMES[camname], self.vidreaders[camname], extension
+            )
+        thisvid_name, frame_num = self.chunk_index[camname].resolve(ind)
+
+        # The video file identifies experiment and camera, so frames shared
+        # between generators (or social instances) hit the same entry
+        cache_key = (thisvid_name, frame_num)
+        if self.frame_cache.enabled:
+            im = self.frame_cache.get(cache_key)
+            if im is not None:
+                return im
+
+        if self.preopen_frames > 0:
+            self._open_next_chunk(ind, camname, thisvid_name)
+
+        # readers and their stream positions are shared by all generation
+        # threads, so a video is decoded by one request at a time
+        with self.readers.lock(thisvid_name):
+            vid = self.readers.get(camname, thisvid_name)
+            im, vid = self._load_frame_multiple_attempts(
+                frame_num, vid, camname, thisvid_name,
+                stream_gap=self._stream_gap(camname, thisvid_name, frame_num, vid),
+            )
+            # remember which reader decoded the frame, see _stream_gap
+            self.last_frame[(camname, thisvid_name)] = (vid, frame_num)
+        if self.frame_cache.enabled:
+            self.frame_cache.put(cache_key, im)
         return im
 
-    def _load_frame_multiple_attempts(self, frame_num, vid, n_attempts=10):
+    def seek_stats(self) -> Dict:
+        """Summary of how frames were positioned in their videos (OpenCV readers)."""
+        return self.readers.seek_stats.summary()
+
+    def close(self):
+        """Close all open video readers."""
+        self.stop_prefetch()
+        self.readers.close()
+        self.last_frame = {}
+
+    def _open_next_chunk(self, ind, camname, thisvid_name):
+        """Open the following chunk in the background when ind nears its start."""
+        try:
+            next_name, _ = self.chunk_index[camname].resolve(ind + self.preopen_frames)
+        except (IndexError, KeyError):
+            return
+        if next_name != thisvid_name:
+            self.readers.open_ahead(camname, next_name)
+
+    def _stream_gap(self, camname, thisvid_name, frame_num, vid):
+        """Distance from the last decoded frame of this video if frame_num continues
+        a forward run of requests that can be decoded without seeking, else 0.
+
+        The last frame is only trusted if it was decoded by this same reader,
+        since a reader that was evicted and reopened starts at frame 0.
+        """
+        last_vid, last = self.last_frame.get((camname, thisvid_name), (None, None))
+        if last_vid is not vid:
+            return 0
+        gap = frame_num - last
+        return gap if 0 < gap <= self.max_stream_gap else 0
+
+    def _load_frame_multiple_attempts(
+        self, frame_num, vid, camname, thisvid_name, n_attempts=3, stream_gap=0
+    ):
         attempts = 0
         while attempts < n_attempts:
-            im = self._load_frame(frame_num, vid)
-            if im is None:
-                attempts += 1
-            else:
+            im = self._load_frame(frame_num, vid, stream_gap)
+            if im is not None:
                 break
+            # A failed read leaves the decoder in an unknown state, so retry
+            # right away on a freshly opened reader instead of waiting
+            attempts += 1
+            vid = self.readers.reopen(camname, thisvid_name)
+            self.last_frame.pop((camname, thisvid_name), None)
+            stream_gap = 0
         else:
-            raise KeyError
-        return im
+            raise KeyError(f"Unable to load frame {frame_num} from {thisvid_name}.")
+        return im, vid
 
-    def _load_frame(self, frame_num, vid):
+    def _load_frame(self, frame_num, vid, stream_gap=0):
         im = None
         try:
-            im = (
-                vid.get_data(frame_num).astype("uint8")
-                if self.predict_flag
-                else vid.get_frame(frame_num)
-            )
+            if not self.predict_flag:
+                im = vid.get_frame(frame_num, max_forward=stream_gap)
+            elif stream_gap == 1:
+                # imageio keeps its decoder positioned right after the last frame
+                im = vid.get_next_data().astype("uint8")
+            else:
+                im = vid.get_data(frame_num).astype("uint8")
         # This deals with a strange indexing error in the pup data.
         except IndexError:
             print("Indexing error, using previous frame")
@@ -281,6 +1156,528 @@ def _load_frame(self, frame_num, vid):
             )
         # Files can lock if other processes are also trying to access the data.
         except KeyError:
-            time.sleep(5)
             pass
         return im
+
+
+class FramePrefetcher:
+    """
+    Decodes scheduled video frames ahead of their use, with one background
+    thread per camera, so that decoding overlaps with projection and network
+    inference in the consumer.
+    Workers decode through their own LoadVideoFrame, so its readers are never
+    shared with the consumer falling back to direct decoding.
+    Frames are served from a window of the next depth scheduled frames of each
+    camera, in any order, so that batches generated concurrently do not take
+    each other's frames. A request for a frame past the window skips the
+    scheduled frames before it.
+    Args:
+        load_frame: Frame loader the prefetched frames are served to
+        schedule: Camera names mapped to the ordered frame indices that will
+            be requested
+        extension: Video extension
+        depth: Maximum number of decoded frames buffered per camera
+    """
+
+    def __init__(
+        self,
+        load_frame: LoadVideoFrame,
+        schedule: Dict,
+        extension: Text = ".mp4",
+        depth: int = 8,
+    ):
+        self.schedule = schedule
+        self.depth = max(int(depth), 1)
+        self._loader = LoadVideoFrame(
+            load_frame._N_VIDEO_FRAMES,
+            load_frame.vidreaders,
+            load_frame.camnames,
+            load_frame.predict_flag,
+            max_stream_gap=load_frame.max_stream_gap,
+            frame_cache=load_frame.frame_cache,
+            n_readers=load_frame.readers.size,
+            preopen_frames=load_frame.preopen_frames,
+            use_keyframe_index=load_frame.readers.use_keyframe_index,
+        )
+        # first schedule position not yet served or skipped, positions claimed
+        # by a request, positions served out of order past the cursor, and
+        # decoded frames by position
+        self._cursor = {camname: 0 for camname in schedule}
+        self._claimed = {camname: set() for camname in schedule}
+        self._served = {camname: set() for camname in schedule}
+        self._decoded = {camname: {} for camname in schedule}
+        # frames may be requested from several generation threads
+        self._conditions = {camname: threading.Condition() for camname in schedule}
+        self._stop = threading.Event()
+        self._threads = []
+        for camname in schedule:
+            thread = threading.Thread(
+                target=self._worker, args=(camname, extension), daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self, camname: Text, extension: Text):
+        condition = self._conditions[camname]
+        for pos, ind in enumerate(self.schedule[camname]):
+            with condition:
+                while (
+                    not self._stop.is_set()
+                    and pos >= self._cursor[camname] + self.depth
+                ):
+                    condition.wait(0.1)
+                if self._stop.is_set():
+                    return
+                if pos < self._cursor[camname]:
+                    # skipped by the consumer
+                    continue
+            try:
+                item = self._loader.load_vid_frame(ind, camname, extension)
+            except Exception as err:
+                # hand the error to the consumer requesting this frame
+                item = err
+            with condition:
+                if pos >= self._cursor[camname] or pos in self._claimed[camname]:
+                    self._decoded[camname][pos] = item
+                condition.notify_all()
+
+    def _advance(self, camname: Text, cursor: int):
+        # callers hold the camera's condition
+        decoded, served = self._decoded[camname], self._served[camname]
+        claimed = self._claimed[camname]
+        for pos in range(self._cursor[camname], cursor):
+            # frames claimed by a waiting request are kept for it
+            if pos not in claimed:
+                decoded.pop(pos, None)
+            served.discard(pos)
+        while cursor in served:
+            served.discard(cursor)
+            cursor += 1
+        self._cursor[camname] = cursor
+
+    def get(self, ind: int, camname: Text) -> np.ndarray:
+        """Return the prefetched frame ind of camname.
+
+        Returns:
+            np.ndarray: The frame, or None if ind is not among the next
+                scheduled requests of camname.
+        """
+        if camname not in self._conditions:
+            return None
+        schedule = self.schedule[camname]
+        condition = self._conditions[camname]
+        claimed, decoded = self._claimed[camname], self._decoded[camname]
+        with condition:
+            cursor = self._cursor[camname]
+            # the earliest unclaimed match, within the window or else in the
+            # following one, skipping the frames before it
+            candidates = [
+                pos
+                for pos in range(cursor, min(cursor + 2 * self.depth, len(schedule)))
+                if schedule[pos] == ind and pos not in claimed
+            ]
+            if not candidates:
+                return None
+            pos = candidates[0]
+            if pos >= cursor + self.depth:
+                self._advance(camname, pos - self.depth + 1)
+            claimed.add(pos)
+            condition.notify_all()
+
+            # a frame skipped before it was decoded is not decoded anymore
+            while (
+                pos not in decoded
+                and pos >= self._cursor[camname]
+                and not self._stop.is_set()
+            ):
+                condition.wait(0.1)
+            item = decoded.pop(pos, None)
+            claimed.discard(pos)
+            if pos >= self._cursor[camname]:
+                self._served[camname].add(pos)
+                self._advance(camname, self._cursor[camname])
+            condition.notify_all()
+
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        """Stop the workers and release their video readers."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._loader.close()
+
+
+def _decode_worker(
+    tasks,
+    results,
+    ring_name,
+    ring_shape,
+    _N_VIDEO_FRAMES,
+    vidreaders,
+    camnames,
+    predict_flag,
+    use_keyframe_index,
+    keyframe_indexes,
+):
+    """Decode loop of a ProcessFrameLoader worker process.
+
+    Tasks are (ticket, camname, slot, ind, extension) tuples, answered on the
+    results queue by (ticket, error message or None) once the frame has been
+    written into the slot of the shared ring buffer. Module settings are not
+    inherited by spawned processes, so use_keyframe_index and the keyframe
+    indexes loaded by the parent (by video file) are passed in.
+    """
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=ring_name)
+    ring = np.ndarray(ring_shape, dtype=np.uint8, buffer=shm.buf)
+    _KEYFRAME_INDEXES.update(keyframe_indexes)
+    # caching happens in the parent, which owns the frames
+    loader = LoadVideoFrame(
+        _N_VIDEO_FRAMES,
+        vidreaders,
+        camnames,
+        predict_flag,
+        frame_cache=FrameCache(0),
+        use_keyframe_index=use_keyframe_index,
+    )
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        ticket, camname, slot, ind, extension = task
+        try:
+            frame = loader.load_vid_frame(ind, camname, extension)
+            if frame.shape != ring.shape[1:]:
+                raise ValueError(
+                    f"Frame shape {frame.shape} does not match {ring.shape[1:]}"
+                )
+            ring[slot] = frame
+            results.put((ticket, None))
+        except Exception as err:
+            results.put((ticket, repr(err)))
+
+    loader.close()
+    del ring
+    shm.close()
+
+
+class _CameraDecoders:
+    """Worker processes, queues and ring buffer serving one camera.
+
+    Frames of the same video file are always decoded by the same worker, so
+    that sequential requests are streamed rather than seeked. Ring slots are
+    handed out from a free list and returned once a frame has been copied out.
+    """
+
+    def __init__(self, ctx, camname, frame, n_workers, n_slots, loader_args):
+        from multiprocessing import shared_memory
+
+        self.ring_shape = (n_slots, *frame.shape)
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=int(np.prod(self.ring_shape))
+        )
+        self.ring = np.ndarray(self.ring_shape, dtype=np.uint8, buffer=self.shm.buf)
+        self.n_slots = n_slots
+        self.free_slots = queue.Queue()
+        for slot in range(n_slots):
+            self.free_slots.put(slot)
+        self.next_ticket = 0
+        self.affinity = {}
+        self.done = {}
+        self.submit_lock = threading.Lock()
+        self.result_lock = threading.Lock()
+        self.results = ctx.Queue()
+        self.tasks = [ctx.Queue() for _ in range(n_workers)]
+        self.workers = [
+            ctx.Process(
+                target=_decode_worker,
+                args=(tasks, self.results, self.shm.name, self.ring_shape, *loader_args),
+                daemon=True,
+            )
+            for tasks in self.tasks
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, camname, ind, extension, video, block=True):
+        """Queue a frame for decoding.
+
+        Returns:
+            Tuple: (ticket, slot) to pass to collect, or None if block is False
+                and no ring slot is free.
+        """
+        try:
+            slot = self.free_slots.get(block=block)
+        except queue.Empty:
+            return None
+        with self.submit_lock:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            worker = self.affinity.setdefault(video, len(self.affinity) % len(self.tasks))
+        self.tasks[worker].put((ticket, camname, slot, ind, extension))
+        return ticket, slot
+
+    def wait(self, ticket):
+        while True:
+            with self.result_lock:
+                if ticket in self.done:
+                    return self.done.pop(ticket)
+                done_ticket, err = self.results.get()
+                self.done[done_ticket] = err
+
+    def collect(self, ticket, slot):
+        """Wait for a submitted frame and release its slot.
+
+        Returns:
+            Tuple: A copy of the frame (None on error) and the error message.
+        """
+        try:
+            err = self.wait(ticket)
+            frame = self.ring[slot].copy() if err is None else None
+        finally:
+            self.free_slots.put(slot)
+        return frame, err
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        del self.ring
+        self.shm.close()
+        self.shm.unlink()
+
+
+class _ScheduledTickets:
+    """Decode requests submitted ahead of a camera's frame schedule."""
+
+    def __init__(self, schedule: List, depth: int):
+        self.schedule = schedule
+        self.depth = depth
+        # schedule position of the next frame to consume, and to submit
+        self.cursor = 0
+        self.submitted = 0
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+
+
+class ProcessFrameLoader(BaseFrameLoader):
+    """
+    Drop-in replacement of LoadVideoFrame that decodes in worker processes,
+    so that decoding for many cameras scales with CPU cores instead of
+    contending on the GIL. Each camera gets its own workers, which write
+    decoded frames into a preallocated shared-memory ring buffer and hand
+    back only the slot index. Frames are copied out of the ring before they
+    are returned, so they stay valid independently of later requests.
+    Each video file is decoded by a single worker, in request order, so that
+    workers stream through their videos; with start_prefetch, the scheduled
+    frames are submitted ahead, keeping up to n_slots - 1 requests per camera
+    in flight.
+    Call close() to stop the worker processes and free the shared memory.
+    Args:
+        _N_VIDEO_FRAMES: Array of chunked video indices
+        vidreaders: Dictionary of all video file paths
+        camnames: All Camera names
+        predict_flag: If True, uses imageio rather than OpenCV
+        n_workers: Number of decoder processes per camera
+        n_slots: Number of frames in each camera's ring buffer
+        frame_cache: Cache of decoded frames consulted before decoding.
+            Defaults to the process-wide FRAME_CACHE.
+        use_keyframe_index: If True, the workers seek using sidecar keyframe
+            indexes (OpenCV readers only). Defaults to the setting of
+            configure_seeking in this process.
+    """
+
+    def __init__(
+        self,
+        _N_VIDEO_FRAMES,
+        vidreaders,
+        camnames,
+        predict_flag,
+        n_workers=1,
+        n_slots=None,
+        frame_cache=None,
+        use_keyframe_index=None,
+    ):
+        self._N_VIDEO_FRAMES = _N_VIDEO_FRAMES
+        self.vidreaders = vidreaders
+        self.camnames = camnames
+        self.predict_flag = predict_flag
+        self.n_workers = max(int(n_workers), 1)
+        self.n_slots = max(n_slots if n_slots is not None else 4 * self.n_workers, 2)
+        self.frame_cache = FRAME_CACHE if frame_cache is None else frame_cache
+        if use_keyframe_index is None:
+            use_keyframe_index = _USE_KEYFRAME_INDEX
+        self.use_keyframe_index = use_keyframe_index
+        self._ctx = multiprocessing.get_context("spawn")
+        self._cameras = {}
+        self._scheduled = {}
+        self._lock = threading.Lock()
+        # decodes the first frame of each camera, which sizes its ring buffer
+        self._probe = LoadVideoFrame(
+            _N_VIDEO_FRAMES,
+            vidreaders,
+            camnames,
+            predict_flag,
+            frame_cache=FrameCache(0),
+            use_keyframe_index=use_keyframe_index,
+        )
+        self._chunk_index = {}
+
+    def _resolve(self, ind, camname, extension):
+        if camname not in self._chunk_index:
+            self._chunk_index[camname] = get_chunk_index(
+                camname, self._N_VIDEO_FRAMES[camname], self.vidreaders[camname], extension
+            )
+        return self._chunk_index[camname].resolve(ind)
+
+    def _keyframe_indexes(self, camname: Text) -> Dict:
+        """Keyframe indexes of the videos of a camera, for its decoder processes."""
+        if not self.use_keyframe_index or self.predict_flag:
+            return {}
+        indexes = {}
+        for filename in self.vidreaders[camname].values():
+            keyframes = load_keyframe_index(filename)
+            if keyframes is not None:
+                indexes[filename] = keyframes
+        return indexes
+
+    def load_vid_frame(
+        self, ind: int, camname: Text, extension: Text = ".mp4"
+    ) -> np.ndarray:
+        """Load video frame from a single camera, see LoadVideoFrame.load_vid_frame."""
+        cache_key = self._resolve(ind, camname, extension)
+        if self.frame_cache.enabled:
+            im = self.frame_cache.get(cache_key)
+            if im is not None:
+                return im
+
+        with self._lock:
+            decoders = self._cameras.get(camname, None)
+            if decoders is None:
+                im = self._probe.load_vid_frame(ind, camname, extension)
+                self._cameras[camname] = _CameraDecoders(
+                    self._ctx,
+                    camname,
+                    im,
+                    self.n_workers,
+                    self.n_slots,
+                    (
+                        self._N_VIDEO_FRAMES,
+                        self.vidreaders,
+                        self.camnames,
+                        self.predict_flag,
+                        self.use_keyframe_index,
+                        self._keyframe_indexes(camname),
+                    ),
+                )
+                self._probe.close()
+        if decoders is None:
+            if self.frame_cache.enabled:
+                self.frame_cache.put(cache_key, im)
+            return im
+
+        request = self._take_scheduled(decoders, ind, camname, extension)
+        if request is None:
+            request = decoders.submit(camname, ind, extension, cache_key[0])
+        im, err = decoders.collect(*request)
+        if err is not None:
+            raise KeyError(f"Unable to load frame {ind} for {camname}: {err}")
+
+        if self.frame_cache.enabled:
+            self.frame_cache.put(cache_key, im)
+        return im
+
+    def _take_scheduled(self, decoders, ind, camname, extension):
+        """Return the (ticket, slot) of frame ind if it was submitted ahead.
+
+        Submitted frames scheduled before ind are skipped, and the schedule is
+        then topped up.
+        """
+        scheduled = self._scheduled.get(camname, None)
+        if scheduled is None:
+            return None
+        with scheduled.lock:
+            found = [
+                pos for pos, (pending_ind, _) in scheduled.pending.items() if pending_ind == ind
+            ]
+            request = None
+            if found:
+                while request is None:
+                    pos, (_, pending) = scheduled.pending.popitem(last=False)
+                    if pos == found[0]:
+                        request = pending
+                    else:
+                        decoders.collect(*pending)
+                scheduled.cursor = found[0] + 1
+            self._submit_scheduled(decoders, camname, scheduled, extension)
+        return request
+
+    def _submit_scheduled(self, decoders, camname, scheduled, extension):
+        # one slot always stays free for frames requested outside the schedule
+        depth = min(scheduled.depth, self.n_slots - 1)
+        scheduled.submitted = max(scheduled.submitted, scheduled.cursor)
+        while (
+            len(scheduled.pending) < depth
+            and scheduled.submitted < len(scheduled.schedule)
+        ):
+            ind = scheduled.schedule[scheduled.submitted]
+            try:
+                video = self._resolve(ind, camname, extension)[0]
+            except (IndexError, KeyError):
+                # left for the consumer to report
+                scheduled.submitted += 1
+                continue
+            pending = decoders.submit(camname, ind, extension, video, block=False)
+            if pending is None:
+                break
+            scheduled.pending[scheduled.submitted] = (ind, pending)
+            scheduled.submitted += 1
+
+    def start_prefetch(self, schedule: Dict, extension: Text = ".mp4", depth: int = 8):
+        """Submit the scheduled frames of each camera to the decoder processes ahead
+        of their requests.
+
+        Args:
+            schedule (Dict): Camera names mapped to the ordered frame indices
+                that will be requested from this loader.
+            extension (Text, optional): Video extension
+            depth (int, optional): Maximum number of frames in flight per camera,
+                at most n_slots - 1.
+        """
+        self.stop_prefetch()
+        self._scheduled = {
+            camname: _ScheduledTickets(list(inds), depth)
+            for camname, inds in schedule.items()
+        }
+
+    def stop_prefetch(self):
+        """Drop the frames submitted ahead, freeing their ring slots."""
+        scheduled, self._scheduled = self._scheduled, {}
+        for camname, tickets in scheduled.items():
+            with tickets.lock:
+                for _, pending in tickets.pending.values():
+                    self._cameras[camname].collect(*pending)
+                tickets.pending.clear()
+
+    def close(self):
+        """Stop the decoder processes and free the ring buffers."""
+        self.stop_prefetch()
+        with self._lock:
+            for decoders in self._cameras.values():
+                decoders.close()
+            self._cameras = {}
+        self._probe.close()
+
+    def __del__(self):
+        # fallback for loaders that were not closed
+        try:
+            self.close()
+        except Exception:
+            pass
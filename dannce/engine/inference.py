@@ -1,8 +1,14 @@
 """Handle inference procedures for dannce and com networks.
 """
+import collections
+import hashlib
 import numpy as np
 import os
+import queue
+import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 import dannce.engine.data.processing as processing
 from dannce.engine.data import ops
 from dannce.config import print_and_set
@@ -10,6 +16,7 @@
 import torch
 import matplotlib
 from dannce.engine.data.processing import savedata_tomat, savedata_expval
+from dannce.engine.data.io import PredictionStore, HeatmapArchive
 
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
@@ -576,67 +583,562 @@ def infer_com(
         sample_save (int, optional): Number of samples to use in fps estimation.
     """
     end_time = time.time()
-    for n_frame in tqdm(range(start_ind, end_ind)):
-        #end_time = print_checkpoint(
-        #    n_frame, start_ind, end_time, sample_save=sample_save
-        #)
-        pred_batch = predict_batch(model, generator, n_frame, params, device)
-        n_batches = pred_batch.shape[0]
-
-        for n_batch in range(n_batches):
-            # By selecting -1 for the last axis, we get the COM index for a
-            # normal COM network, and also the COM index for a multi_mode COM network,
-            # as in multimode the COM label is put at the end
-            if params["mirror"] and params["n_instances"] == 1:
-                # For mirror we need to reshape pred so that the cameras are in front, so
-                # it works with the downstream code
-                pred = pred_batch[n_batch, 0]
-                pred = np.transpose(pred, (2, 0, 1))
-            elif params["mirror"]:
-                raise Exception("mirror mode with multiple animal instances not currently supported.")
-            elif params["n_instances"] > 1 and params["n_channels_out"] > 1:
-                pred = pred_batch[n_batch, ...]
-            else:
-                pred = pred_batch[n_batch, :, :, :, -1]
-            sample_id = partition["valid_sampleIDs"][n_frame * n_batches + n_batch]
-            save_data[sample_id] = {}
-            save_data[sample_id]["triangulation"] = {}
-            n_cams = pred.shape[0]
-
-            for n_cam in range(n_cams):
-                args = [
-                    pred,
-                    pred_batch,
-                    n_cam,
-                    sample_id,
-                    n_frame,
-                    n_batch,
-                    params,
-                    save_data,
-                    cameras,
-                    generator,
-                ]
+    if params["frame_prefetch_depth"]:
+        generator.start_prefetch(
+            range(start_ind, end_ind), depth=params["frame_prefetch_depth"]
+        )
+
+    try:
+        for n_frame in tqdm(range(start_ind, end_ind)):
+            #end_time = print_checkpoint(
+            #    n_frame, start_ind, end_time, sample_save=sample_save
+            #)
+            pred_batch = predict_batch(model, generator, n_frame, params, device)
+            n_batches = pred_batch.shape[0]
+
+            for n_batch in range(n_batches):
+                # By selecting -1 for the last axis, we get the COM index for a
+                # normal COM network, and also the COM index for a multi_mode COM network,
+                # as in multimode the COM label is put at the end
+                if params["mirror"] and params["n_instances"] == 1:
+                    # For mirror we need to reshape pred so that the cameras are in front, so
+                    # it works with the downstream code
+                    pred = pred_batch[n_batch, 0]
+                    pred = np.transpose(pred, (2, 0, 1))
+                elif params["mirror"]:
+                    raise Exception("mirror mode with multiple animal instances not currently supported.")
+                elif params["n_instances"] > 1 and params["n_channels_out"] > 1:
+                    pred = pred_batch[n_batch, ...]
+                else:
+                    pred = pred_batch[n_batch, :, :, :, -1]
+                sample_id = partition["valid_sampleIDs"][n_frame * n_batches + n_batch]
+                save_data[sample_id] = {}
+                save_data[sample_id]["triangulation"] = {}
+                n_cams = pred.shape[0]
+
+                for n_cam in range(n_cams):
+                    args = [
+                        pred,
+                        pred_batch,
+                        n_cam,
+                        sample_id,
+                        n_frame,
+                        n_batch,
+                        params,
+                        save_data,
+                        cameras,
+                        generator,
+                    ]
+                    if params["n_instances"] == 1:
+                        save_data = extract_single_instance(*args)
+                    elif params["n_channels_out"] == 1:
+                        save_data = extract_multi_instance_single_channel(*args)
+                    elif params["n_channels_out"] > 1:
+                        save_data = extract_multi_instance_multi_channel(*args)
+
+                # Handle triangulation for single or multi instance
                 if params["n_instances"] == 1:
-                    save_data = extract_single_instance(*args)
+                    save_data = triangulate_single_instance(
+                        n_cams, sample_id, params, camera_mats, save_data
+                    )
                 elif params["n_channels_out"] == 1:
-                    save_data = extract_multi_instance_single_channel(*args)
+                    save_data = triangulate_multi_instance_single_channel(
+                        n_cams, sample_id, params, camera_mats, cameras, save_data
+                    )
                 elif params["n_channels_out"] > 1:
-                    save_data = extract_multi_instance_multi_channel(*args)
+                    save_data = triangulate_multi_instance_multi_channel(
+                        n_cams, sample_id, params, camera_mats, save_data
+                    )
+
+    finally:
+        generator.stop_prefetch()
+    return save_data
+
+def generate_dannce_inputs(generator, params: Dict, i: int, sil_generator=None) -> Tuple:
+    """Generate the network inputs of one batch.
+
+    Args:
+        generator (keras.utils.Sequence): DANNCE data generator
+        params (Dict): Parameters dictionary.
+        i (int): Batch index
+        sil_generator (optional): Silhouette generator, whose volumes are
+            appended to the image volumes.
+
+    Returns:
+        Tuple: volumes [B, C, H, W, D], grids (None for MAX networks) and the
+            generator targets.
+    """
+    ims = generator.__getitem__(i)
+    if sil_generator is not None:
+        sil_ims = sil_generator.__getitem__(i)
+        sil_ims = processing.extract_3d_sil(sil_ims[0][0], 18)
+        if torch.is_tensor(ims[0][0]):
+            sil_ims = torch.as_tensor(sil_ims, device=ims[0][0].device)
+            ims[0][0] = torch.cat((ims[0][0], sil_ims, sil_ims, sil_ims), dim=-1)
+        else:
+            ims[0][0] = [np.concatenate((ims[0][0], sil_ims, sil_ims, sil_ims), axis=-1)]
+
+    # volumes may already be device tensors when the generator has tensor_output
+    vols = torch.as_tensor(ims[0][0]).permute(0, 4, 1, 2, 3) # [B, C, H, W, D]
+    # replace occluded view
+    if params["downscale_occluded_view"]:
+        occlusion_scores = ims[0][2]
+        occluded_views = (occlusion_scores > 0.5)
+
+        vols = vols.reshape(vols.shape[0], -1, 3, *vols.shape[2:]) #[B, 6, 3, H, W, D]
+
+        for instance in range(occluded_views.shape[0]):
+            occluded = np.where(occluded_views[instance])[0]
+            unoccluded = np.where(~occluded_views[instance])[0]
+            for view in occluded:
+                alternative = np.random.choice(unoccluded)
+                vols[instance][view] = vols[instance][alternative]
+                print(f"Replace view {view} with {alternative}")
+
+        vols = vols.reshape(vols.shape[0], -1, *vols.shape[3:])
+
+    grids = torch.as_tensor(ims[0][1]) if params["expval"] else None
+    return vols, grids, ims[1]
 
-            # Handle triangulation for single or multi instance
-            if params["n_instances"] == 1:
-                save_data = triangulate_single_instance(
-                    n_cams, sample_id, params, camera_mats, save_data
+
+def predict_dannce_inputs(model, vols, grids, device: Text) -> Tuple:
+    """Run the network on a batch of volumes.
+
+    Args:
+        model (Model): Inference model.
+        vols (torch.Tensor): Input volumes, [B, C, H, W, D]
+        grids (torch.Tensor): Voxel grid coordinates, or None for MAX networks.
+        device (Text): Gpu device name
+
+    Returns:
+        Tuple: Network outputs (coordinates, heatmaps, features).
+    """
+    model_inputs = [vols.to(device)]
+    model_inputs.append(grids.to(device) if grids is not None else None)
+    with torch.no_grad():
+        return model(*model_inputs)
+
+
+def reduce_dannce_outputs(pred: Tuple, params: Dict, keep_heatmaps: bool = False) -> Dict:
+    """Reduce network outputs on the compute device to the stored quantities.
+
+    For AVG networks only the coordinates, the per-joint heatmap maxima and,
+    if params["predict_topk"] > 0, the top-k voxels of each joint are kept, so
+    full heatmaps only cross to the host when they are saved. MAX outputs are
+    reduced per sample when stored, so their heatmaps are kept as they are.
+
+    Args:
+        pred (Tuple): Network outputs (coordinates, heatmaps, features).
+        params (Dict): Parameters dictionary.
+        keep_heatmaps (bool, optional): If True, also keep the AVG heatmaps.
+
+    Returns:
+        Dict: Reduced outputs, with the batch along the first dimension.
+    """
+    heatmaps = pred[1].detach()
+    if not params["expval"]:
+        return {"heatmaps": heatmaps}
+
+    outputs = {
+        "pred_coord": pred[0].detach(),
+        "pred_max": torch.amax(heatmaps, dim=(2, 3, 4)),
+    }
+    if params["predict_topk"]:
+        # flat voxel indices into each joint's heatmap
+        values, indices = torch.topk(
+            heatmaps.flatten(start_dim=2), params["predict_topk"], dim=2
+        )
+        outputs["topk_values"], outputs["topk_indices"] = values, indices
+    if keep_heatmaps:
+        outputs["heatmaps"] = heatmaps
+    return outputs
+
+
+class DebugTifWriter:
+    """Write the heatmaps of sampled predictions as tifs on a background thread.
+
+    Heatmaps are queued for a writer thread, so sampled frames cost one copy
+    to the host in the inference loop. When the writer falls behind, frames
+    are dropped rather than stalling inference. Failing writes do not stop
+    inference either: the first error is kept in error and reported by close.
+    """
+
+    def __init__(self, savedir: Text, interval: int = 100, queue_size: int = 16):
+        """Start the writer.
+
+        Args:
+            savedir (Text): Output directory
+            interval (int, optional): Save every interval-th sample.
+            queue_size (int, optional): Maximum number of queued samples.
+        """
+        self.savedir = savedir
+        self.interval = max(1, interval)
+        self.n_dropped = 0
+        self.n_failed = 0
+        self.error = None
+        if not os.path.exists(savedir):
+            os.makedirs(savedir)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def wants(self, n_sample: int) -> bool:
+        """Whether the sample with this index is saved."""
+        return n_sample % self.interval == 0
+
+    def submit(self, sampleID, heatmaps: np.ndarray):
+        """Queue the heatmaps of a sample.
+
+        Args:
+            sampleID: Sample ID, used in the file names.
+            heatmaps (np.ndarray): Heatmaps, [H, W, D, n_joints]
+        """
+        if not self._thread.is_alive():
+            self.n_dropped += 1
+            return
+        try:
+            self._queue.put_nowait((sampleID, heatmaps))
+        except queue.Full:
+            self.n_dropped += 1
+
+    def _write(self, sampleID, heatmaps: np.ndarray):
+        for k in range(heatmaps.shape[-1]):
+            im = processing.norm_im(heatmaps[..., k]) * 255
+            im = im.astype("uint8")
+            of = os.path.join(self.savedir, f"{sampleID}_{k}.tif")
+            imageio.mimwrite(of, np.transpose(im, [2, 0, 1]))
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            # keep draining the queue after a failure, so submit never blocks
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.n_failed += 1
+                if self.error is None:
+                    self.error = e
+
+    def close(self, timeout: float = 60.0):
+        """Write the queued heatmaps and stop the writer.
+
+        Args:
+            timeout (float, optional): Seconds to wait for the queued heatmaps.
+        """
+        deadline = time.time() + timeout
+        while self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                if time.time() > deadline:
+                    break
+        self._thread.join(max(0.0, deadline - time.time()))
+        if self._thread.is_alive():
+            print("Debug heatmap writer did not finish within {} s".format(timeout))
+        if self.n_dropped:
+            print(
+                "Dropped {} debug heatmaps while the writer was busy".format(self.n_dropped)
+            )
+        if self.error is not None:
+            print(
+                "Failed to write {} debug heatmaps to {}: {}".format(
+                    self.n_failed, self.savedir, self.error
                 )
-            elif params["n_channels_out"] == 1:
-                save_data = triangulate_multi_instance_single_channel(
-                    n_cams, sample_id, params, camera_mats, cameras, save_data
+            )
+
+
+def store_dannce_predictions(
+    save_data: Dict,
+    pred: Dict,
+    targets: List,
+    params: Dict,
+    partition: Dict,
+    i: int,
+    idx: int,
+    save_path: Text = None,
+    debug_writer: DebugTifWriter = None,
+    heatmap_archive: HeatmapArchive = None,
+):
+    """Reduce the network outputs of one batch and store them in save_data.
+
+    Args:
+        save_data (Dict): Predictions by sample index, updated in place.
+        pred (Dict): Reduced network outputs of the batch, see reduce_dannce_outputs.
+        targets (List): Generator targets of the batch.
+        params (Dict): Parameters dictionary.
+        partition (Dict): Partition dictionary
+        i (int): Batch index in the generator
+        idx (int): Batch index relative to the first predicted batch
+        save_path (Text, optional): If given, heatmaps of AVG networks are saved
+            to this directory.
+        debug_writer (DebugTifWriter, optional): If given, heatmaps of MAX
+            networks are saved as tifs for the samples it selects.
+        heatmap_archive (HeatmapArchive, optional): If given, heatmaps of AVG
+            networks are appended to this archive.
+    """
+    if params["expval"]:
+        # only the reduced outputs are copied to the host
+        outputs = {key: value.cpu().numpy() for key, value in pred.items()}
+        batch_size = outputs["pred_coord"].shape[0]
+        for j in range(batch_size):
+            sampleID = partition["valid_sampleIDs"][i * batch_size + j]
+            save_data[idx * batch_size + j] = {
+                "pred_max": outputs["pred_max"][j],
+                "pred_coord": outputs["pred_coord"][j],
+                "sampleID": sampleID,
+            }
+            if "topk_values" in outputs:
+                save_data[idx * batch_size + j]["topk_values"] = outputs["topk_values"][j]
+                save_data[idx * batch_size + j]["topk_indices"] = outputs["topk_indices"][j]
+            if save_path is not None:
+                np.save(os.path.join(save_path, sampleID), outputs["heatmaps"][j])
+            if heatmap_archive is not None:
+                heatmap_archive.append(sampleID, outputs["heatmaps"][j])
+
+    else:
+        pred = pred["heatmaps"]
+        for j in range(pred.shape[0]):
+            preds = pred[j].permute(1, 2, 3, 0).detach()
+            pred_max = preds.max(0).values.max(0).values.max(0).values
+            pred_total = preds.sum((0, 1, 2))
+            (
+                xcoord,
+                ycoord,
+                zcoord,
+            ) = processing.plot_markers_3d_torch(preds)
+            coord = torch.stack([xcoord, ycoord, zcoord])
+            pred_log = pred_max.log() - pred_total.log()
+            sampleID = partition["valid_sampleIDs"][i * pred.shape[0] + j]
+
+            save_data[idx * pred.shape[0] + j] = {
+                "pred_max": pred_max.cpu().numpy(),
+                "pred_coord": coord.cpu().numpy(),
+                "true_coord_nogrid": targets[0][j],
+                "logmax": pred_log.cpu().numpy(),
+                "sampleID": sampleID,
+            }
+
+            # save predicted heatmaps of sampled frames
+            if debug_writer is not None and debug_writer.wants(idx * pred.shape[0] + j):
+                debug_writer.submit(sampleID, preds.cpu().numpy())
+
+
+class InferencePipeline:
+    """Overlap volume generation, network evaluation and result storage.
+
+    Batches are generated by a pool of worker threads and handed over, in
+    order, through a bounded queue. The network consumes all batches that are
+    ready at once, up to max_batches, and a writer thread stores the results,
+    so throughput is limited by the slowest stage rather than the sum of all.
+
+    Volume generation is dominated by video decoding, projection and sampling,
+    which release the GIL, so threads keep the generators' video readers,
+    thread pools and device tensors shared instead of copying them into
+    worker processes.
+    """
+
+    STAGES = ("generate", "predict", "store")
+
+    def __init__(
+        self,
+        generate_fn,
+        predict_fn,
+        store_fn,
+        n_workers: int = 2,
+        max_batches: int = 4,
+        queue_size: int = None,
+    ):
+        """Initialize the pipeline.
+
+        Args:
+            generate_fn: Function of a batch index returning (volumes, grids, targets).
+            predict_fn: Function of (volumes, grids) returning a dictionary of
+                output tensors, with the batch along their first dimension.
+            store_fn: Function of (outputs, targets, i, idx) storing the results
+                of one generated batch.
+            n_workers (int, optional): Number of volume generation threads.
+            max_batches (int, optional): Maximum number of generated batches
+                evaluated by the network at once.
+            queue_size (int, optional): Maximum number of generated batches
+                waiting for the network. Defaults to 2 * max_batches.
+        """
+        self.generate_fn = generate_fn
+        self.predict_fn = predict_fn
+        self.store_fn = store_fn
+        self.n_workers = max(1, n_workers)
+        self.max_batches = max(1, max_batches)
+        self.queue_size = queue_size or 2 * self.max_batches
+        self.busy = {stage: 0.0 for stage in self.STAGES}
+        self.n_calls = 0
+        self.n_batches = 0
+        self.n_samples = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _timed(self, stage: Text, fn, *args):
+        ts = time.time()
+        out = fn(*args)
+        with self._lock:
+            self.busy[stage] += time.time() - ts
+        return out
+
+    def _put(self, q: queue.Queue, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _produce(self, batch_indices: List, ready: queue.Queue):
+        """Generate batches in the worker pool and queue them in order."""
+        pending = collections.deque()
+        executor = ThreadPoolExecutor(self.n_workers)
+        try:
+            for idx, i in enumerate(batch_indices):
+                if self._stop.is_set():
+                    break
+                pending.append(
+                    (idx, i, executor.submit(self._timed, "generate", self.generate_fn, i))
                 )
-            elif params["n_channels_out"] > 1:
-                save_data = triangulate_multi_instance_multi_channel(
-                    n_cams, sample_id, params, camera_mats, save_data
+                if len(pending) >= self.n_workers:
+                    idx_, i_, future = pending.popleft()
+                    self._put(ready, (idx_, i_, future.result()))
+            while pending and not self._stop.is_set():
+                idx_, i_, future = pending.popleft()
+                self._put(ready, (idx_, i_, future.result()))
+        except Exception as err:
+            # hand the error to the consumer
+            self._put(ready, err)
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+        self._put(ready, None)
+
+    def _write(self, results: queue.Queue, errors: List):
+        """Store network outputs until the end of the queue."""
+        while True:
+            item = results.get()
+            if item is None:
+                return
+            if errors:
+                continue
+            try:
+                for pred, targets, i, idx in item:
+                    self._timed("store", self.store_fn, pred, targets, i, idx)
+            except Exception as err:
+                errors.append(err)
+                self._stop.set()
+
+    def run(self, batch_indices: List):
+        """Predict and store all batches.
+
+        Args:
+            batch_indices (List): Generator batch indices, in prediction order.
+        """
+        ready = queue.Queue(maxsize=self.queue_size)
+        results = queue.Queue(maxsize=self.queue_size)
+        errors = []
+        producer = threading.Thread(
+            target=self._produce, args=(batch_indices, ready), daemon=True
+        )
+        writer = threading.Thread(target=self._write, args=(results, errors), daemon=True)
+        start = time.time()
+        producer.start()
+        writer.start()
+
+        pbar = tqdm(total=len(batch_indices))
+        done = False
+        try:
+            while not done and not errors:
+                try:
+                    items = [ready.get(timeout=0.1)]
+                except queue.Empty:
+                    continue
+                while len(items) < self.max_batches and items[-1] is not None:
+                    try:
+                        items.append(ready.get_nowait())
+                    except queue.Empty:
+                        break
+                if items[-1] is None:
+                    done = True
+                    items = items[:-1]
+                for item in items:
+                    if isinstance(item, Exception):
+                        raise item
+                if not items:
+                    continue
+
+                ts = time.time()
+                sizes = [item[2][0].shape[0] for item in items]
+                vols = torch.cat([item[2][0] for item in items])
+                grids = None
+                if items[0][2][1] is not None:
+                    grids = torch.cat([item[2][1] for item in items])
+                pred = self.predict_fn(vols, grids)
+                # split the outputs back into the generated batches
+                pred = {key: value.split(sizes) for key, value in pred.items()}
+                self.busy["predict"] += time.time() - ts
+                self.n_calls += 1
+                self.n_batches += len(items)
+                self.n_samples += sum(sizes)
+
+                results.put(
+                    [
+                        ({key: value[b] for key, value in pred.items()}, item[2][2], item[1], item[0])
+                        for b, item in enumerate(items)
+                    ]
                 )
-    return save_data
+                pbar.update(len(items))
+        finally:
+            if not done:
+                self._stop.set()
+            # the writer drains the queue until the end marker, even after errors
+            results.put(None)
+            writer.join()
+            self._stop.set()
+            producer.join()
+            pbar.close()
+            self.elapsed = time.time() - start
+        if errors:
+            raise errors[0]
+
+    def utilization(self) -> Dict:
+        """Fraction of the wall time each stage was busy.
+
+        Generation is summed over its worker threads, so it can exceed 1
+        when the workers overlap.
+
+        Returns:
+            Dict: Utilization by stage.
+        """
+        return {
+            stage: busy / max(self.elapsed, 1e-9) for stage, busy in self.busy.items()
+        }
+
+    def report(self):
+        """Print throughput and per-stage utilization."""
+        print(
+            "Predicted {} samples ({} batches, {} network calls) in {:.1f} sec, {:.2f} samples/sec".format(
+                self.n_samples,
+                self.n_batches,
+                self.n_calls,
+                self.elapsed,
+                self.n_samples / max(self.elapsed, 1e-9),
+            )
+        )
+        print(
+            "Stage utilization: "
+            + ", ".join(
+                "{} {:.2f}".format(stage, u) for stage, u in self.utilization().items()
+            )
+        )
+
 
 def infer_dannce(
     generator,
@@ -668,130 +1170,171 @@ def infer_dannce(
         print_and_set(params, "maxbatch", len(generator))
 
     end_time = time.time()
-    save_data = {}
     start_ind = params["start_batch"]
     end_ind = params["maxbatch"]
 
-    if save_heatmaps:
+    # predictions are appended to the store as they are made. With
+    # resume_predictions, a run resumes after the batches it already holds,
+    # unless any input of the generation or the network has changed
+    store_path = os.path.join(params["dannce_predict_dir"], prediction_store_name(params))
+    meta = {key: params.get(key, None) for key in PREDICTION_STORE_KEYS}
+    # files can change in place, so identify them by their contents too
+    meta["model_file"] = model_file_signature(params["dannce_predict_model"])
+    meta["com_file_digest"] = file_digest(params["com_file"])
+    pred_store = PredictionStore(store_path, meta=meta)
+    if not params["resume_predictions"]:
+        pred_store.clear()
+    save_data, done = pred_store.load()
+    batch_indices = [i for i in range(start_ind, end_ind) if i not in done]
+    if done:
+        print(
+            "Resuming prediction, {} of {} batches already in {}".format(
+                end_ind - start_ind - len(batch_indices), end_ind - start_ind, store_path
+            )
+        )
+
+    save_path, heatmap_archive = None, None
+    if save_heatmaps and params["heatmap_encoding"] is not None:
+        heatmap_archive = HeatmapArchive(
+            os.path.join(params["dannce_predict_dir"], "heatmap_archive"),
+            encoding=params["heatmap_encoding"],
+            k=params["heatmap_topk"],
+        )
+    elif save_heatmaps:
         save_path = os.path.join(params["dannce_predict_dir"], "heatmaps")
         if not os.path.exists(save_path):
             os.makedirs(save_path)
 
-    pbar = tqdm(range(start_ind, end_ind))
-    for idx, i in enumerate(pbar):
-        # print("Predicting on batch {}".format(i), flush=True)
-        # if (i - start_ind) % 10 == 0 and i != start_ind:
-            # print(i)
-            # print("10 batches took {} seconds".format(time.time() - end_time))
-            # end_time = time.time()
-
-        if (i - start_ind) % 1000 == 0 and i != start_ind:
-            print("Saving checkpoint at {}th batch".format(i))
-            if params["expval"]:
-                p_n = savedata_expval(
-                    params["dannce_predict_dir"] + "/save_data_AVG.mat",
-                    params,
-                    write=True,
-                    data=save_data,
-                    tcoord=False,
-                    num_markers=n_chn,
-                    pmax=True,
-                )
-            else:
-                p_n = savedata_tomat(
-                    params["dannce_predict_dir"] + "/save_data_MAX.mat",
-                    params,
-                    params["vmin"],
-                    params["vmax"],
-                    params["nvox"],
-                    write=True,
-                    data=save_data,
-                    num_markers=n_chn,
-                    tcoord=False,
-                )
+    if params["frame_prefetch_depth"]:
+        generator.start_prefetch(batch_indices, depth=params["frame_prefetch_depth"])
 
-        ims = generator.__getitem__(i)
-        if sil_generator is not None:
-            sil_ims = sil_generator.__getitem__(i)
-            sil_ims = processing.extract_3d_sil(sil_ims[0][0], 18)
-            ims[0][0] = [np.concatenate((ims[0][0], sil_ims, sil_ims, sil_ims), axis=-1)]
-        
-        vols = torch.from_numpy(ims[0][0]).permute(0, 4, 1, 2, 3) # [B, C, H, W, D]
-        # replace occluded view
-        if params["downscale_occluded_view"]:
-            occlusion_scores = ims[0][2]
-            occluded_views = (occlusion_scores > 0.5)
-
-            vols = vols.reshape(vols.shape[0], -1, 3, *vols.shape[2:]) #[B, 6, 3, H, W, D]
-
-            for instance in range(occluded_views.shape[0]):
-                occluded = np.where(occluded_views[instance])[0]
-                unoccluded = np.where(~occluded_views[instance])[0]
-                for view in occluded:
-                    alternative = np.random.choice(unoccluded)
-                    vols[instance][view] = vols[instance][alternative]
-                    print(f"Replace view {view} with {alternative}")
-            
-            vols = vols.reshape(vols.shape[0], -1, *vols.shape[3:])
-
-        model_inputs = [vols.to(device)]
-        if params["expval"]:
-            model_inputs.append(torch.from_numpy(ims[0][1]).to(device)) 
-        else:
-            model_inputs.append(None)
-        
-        with torch.no_grad():
-            pred = model(*model_inputs)
-
-        if params["expval"]:
-            probmap = torch.amax(pred[1], dim=(2, 3, 4)).squeeze(0).detach().cpu().numpy()
-            heatmaps = pred[1].squeeze().detach().cpu().numpy()
-            pred = pred[0].detach().cpu().numpy()
-            for j in range(pred.shape[0]):
-                pred_max = probmap[j]
-                sampleID = partition["valid_sampleIDs"][i * pred.shape[0] + j]
-                save_data[idx * pred.shape[0] + j] = {
-                    "pred_max": pred_max,
-                    "pred_coord": pred[j],
-                    "sampleID": sampleID,
-                }
-                if save_heatmaps:
-                    np.save(os.path.join(save_path, sampleID), heatmaps[j])
+    debug_writer = None
+    if not params["expval"] and params["debug_max_tifdir"] is not None:
+        debug_writer = DebugTifWriter(
+            params["debug_max_tifdir"], interval=params["debug_max_interval"]
+        )
 
-        else:
-            pred = pred[1]
-            for j in range(pred.shape[0]):
-                preds = pred[j].permute(1, 2, 3, 0).detach()
-                pred_max = preds.max(0).values.max(0).values.max(0).values
-                pred_total = preds.sum((0, 1, 2))
-                (
-                    xcoord,
-                    ycoord,
-                    zcoord,
-                ) = processing.plot_markers_3d_torch(preds)
-                coord = torch.stack([xcoord, ycoord, zcoord])
-                pred_log = pred_max.log() - pred_total.log()
-                sampleID = partition["valid_sampleIDs"][i * pred.shape[0] + j]
-
-                save_data[idx * pred.shape[0] + j] = {
-                    "pred_max": pred_max.cpu().numpy(),
-                    "pred_coord": coord.cpu().numpy(),
-                    "true_coord_nogrid": ims[1][0][j],
-                    "logmax": pred_log.cpu().numpy(),
-                    "sampleID": sampleID,
-                }
-
-                # save predicted heatmaps
-                savedir = './debug_MAX'
-                if not os.path.exists(savedir):
-                    os.makedirs(savedir)
-                for i in range(preds.shape[-1]):
-                    im = processing.norm_im(preds[..., i].cpu().numpy()) * 255
-                    im = im.astype("uint8")
-                    of = os.path.join(savedir, f"{sampleID}_{i}.tif")
-                    imageio.mimwrite(of, np.transpose(im, [2, 0, 1]))
+    def store(pred, targets, i, idx):
+        records = {}
+        # sample indices are relative to the first batch, also when resuming
+        store_dannce_predictions(
+            records, pred, targets, params, partition, i, i - start_ind, save_path,
+            debug_writer, heatmap_archive,
+        )
+        save_data.update(records)
+        pred_store.append(i, records)
+
+    def close_outputs():
+        pred_store.flush()
+        if debug_writer is not None:
+            debug_writer.close()
+        if heatmap_archive is not None:
+            heatmap_archive.close()
+
+    if params["inference_workers"] > 0:
+        pipeline = InferencePipeline(
+            lambda i: generate_dannce_inputs(generator, params, i, sil_generator),
+            lambda vols, grids: reduce_dannce_outputs(
+                predict_dannce_inputs(model, vols, grids, device), params, save_heatmaps
+            ),
+            store,
+            n_workers=params["inference_workers"],
+            max_batches=params["inference_max_batches"],
+        )
+        try:
+            pipeline.run(batch_indices)
+        finally:
+            generator.stop_prefetch()
+            close_outputs()
+        pipeline.report()
+        return dict(sorted(save_data.items()))
+
+    pbar = tqdm(batch_indices)
+    try:
+        for idx, i in enumerate(pbar):
+            # print("Predicting on batch {}".format(i), flush=True)
+            # if (i - start_ind) % 10 == 0 and i != start_ind:
+                # print(i)
+                # print("10 batches took {} seconds".format(time.time() - end_time))
+                # end_time = time.time()
+
+            vols, grids, targets = generate_dannce_inputs(generator, params, i, sil_generator)
+            pred = predict_dannce_inputs(model, vols, grids, device)
+            store(reduce_dannce_outputs(pred, params, save_heatmaps), targets, i, idx)
+    finally:
+        # keep the predictions made so far when a run is interrupted
+        generator.stop_prefetch()
+        close_outputs()
+    return dict(sorted(save_data.items()))
+
+
+# parameters the stored predictions of a run depend on, see infer_dannce
+PREDICTION_STORE_KEYS = [
+    "dannce_predict_model", "expval", "n_markers", "batch_size", "start_batch",
+    "vmin", "vmax", "nvox", "com_file", "predict_topk", "interp",
+    "mip_sampling", "mirror", "crop_height", "crop_width", "camnames", "n_views",
+    "viddir", "label3d_file", "extension", "n_instances", "channel_combo", "mono",
+    "depth", "com_method", "cthresh", "comthresh", "medfilt_window",
+]
+
+
+def file_digest(path: Text) -> Text:
+    """SHA-1 digest of the contents of a file.
 
-    return save_data
+    Args:
+        path (Text): Path to the file.
+
+    Returns:
+        Text: Hex digest, or None if the file does not exist.
+    """
+    if path is None or not os.path.isfile(path):
+        return None
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def model_file_signature(model_path: Text) -> Dict:
+    """Size and modification time of a model file, to tell apart different
+    weights saved under the same path.
+
+    Args:
+        model_path (Text): Path to the model file.
+
+    Returns:
+        Dict: File size and modification time, or None if the file does not exist.
+    """
+    if model_path is None or not os.path.isfile(model_path):
+        return None
+    stat = os.stat(model_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def discard_prediction_store(params: Dict):
+    """Delete the prediction store of a run, once its predictions are saved.
+
+    Args:
+        params (Dict): Parameters dictionary.
+    """
+    store_path = os.path.join(params["dannce_predict_dir"], prediction_store_name(params))
+    shutil.rmtree(store_path, ignore_errors=True)
+
+
+def prediction_store_name(params: Dict) -> Text:
+    """Directory name of the prediction store of a run, matching its .mat file.
+
+    Args:
+        params (Dict): Parameters dictionary.
+
+    Returns:
+        Text: Store directory name
+    """
+    name = "predictions_AVG" if params["expval"] else "predictions_MAX"
+    if params["save_tag"] is not None:
+        name += "%d" % (params["save_tag"])
+    return name
 
 def save_results(params, save_data):
     if params["expval"]:
@@ -247,15 +247,13 @@ def _generate_gaussian_target(self, centers, grids):
         centers: [batch_size, 3, n_joints]
         grid: [batch_size, 3, h, w, d]
         """
-        y_3d = grids.new_zeros(centers.shape[0], centers.shape[2], *grids.shape[2:]) #[bs, n_joints, n_vox, n_vox, n_vox]
-        for i in range(y_3d.shape[0]):
-            for j in range(y_3d.shape[1]):
-                y_3d[i, j] = torch.exp(-((grids[i, 1] - centers[i, 1, j])**2 
-                            + (grids[i, 0] - centers[i, 0, j])**2
-                            + (grids[i, 2] - centers[i, 2, j])**2))
-                y_3d[i, j] /= (2 * self.sigma**2)
-                
-        return y_3d
+        coords = grids.unbind(dim=1)
+        profiles = ops.grid_profiles(coords)
+        # grids rotated by continuous rotation augmentation are not separable
+        if not ops.profiles_match(coords, profiles):
+            profiles = coords
+        #[bs, n_joints, n_vox, n_vox, n_vox]
+        return ops.gaussian_targets(centers, profiles, self.sigma)
 
     def forward(self, kpts_gt, kpts_pred, heatmaps, grids):
         """
@@ -5,7 +5,7 @@
 from tqdm import tqdm
 
 from dannce.engine.trainer.base_trainer import BaseTrainer
-from dannce.engine.trainer.train_utils import prepare_batch, LossHelper, MetricHelper
+from dannce.engine.trainer.train_utils import prepare_batch, make_max_targets, LossHelper, MetricHelper
 import dannce.engine.data.processing as processing
 from dannce.engine.inference import form_batch
 
@@ -28,6 +28,9 @@ def __init__(self, device, train_dataloader, valid_dataloader, lr_scheduler=None
         self.form_batch = self.params.get("form_batch", False)        
         self.form_bs = self.params.get("form_bs", None)
 
+        # whether MAX targets are built from the keypoints on the device
+        self.max_targets_on_device = self.params.get("max_targets_on_device", False)
+
         # set up csv file for tracking training and validation stats
         stats_file = open(os.path.join(self.params["dannce_train_dir"], "training.csv"), 'w', newline='')
         stats_writer = csv.writer(stats_file)
@@ -86,6 +89,16 @@ def _forward(self, epoch, batch, train=True):
             volumes = volumes.permute(0, 4, 1, 2, 3)
             keypoints_3d_gt = keypoints_3d_gt.repeat(self.form_bs, 1, 1)
 
+        if self.max_targets_on_device:
+            keypoints_3d_gt = make_max_targets(
+                keypoints_3d_gt,
+                grid_centers,
+                self.params["sigma"],
+                separable=not (train and self.params["augment_continuous_rotation"]),
+            )
+            # MAX networks are not given the grid
+            grid_centers = None
+
         keypoints_3d_pred, heatmaps, _ = self.model(volumes, grid_centers)
 
         keypoints_3d_gt, keypoints_3d_pred, heatmaps = self._split_data(keypoints_3d_gt, keypoints_3d_pred, heatmaps)
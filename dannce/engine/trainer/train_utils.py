@@ -1,5 +1,6 @@
 import dannce.engine.models.loss as custom_losses
 import dannce.engine.models.metrics as custom_metrics
+from dannce.engine.data import ops
 import numpy as np
 # import pandas as pd
 
@@ -11,6 +12,26 @@ def prepare_batch(batch, device):
     
     return volumes, grids, targets, auxs
 
+def make_max_targets(keypoints, grids, sigma, separable=True):
+    """Build MAX network Gaussian target volumes from 3D keypoints.
+
+    Args:
+        keypoints (torch.Tensor): 3D keypoints, [bs, 3, n_joints]
+        grids (torch.Tensor): Voxel centers, [bs, nvox**3, 3]
+        sigma (float): Gaussian standard deviation
+        separable (bool): If True, assume axis-aligned grids and build the targets
+            as outer products of 1D Gaussians. Grids rotated by arbitrary angles
+            need the dense computation.
+
+    Returns:
+        torch.Tensor: Targets, [bs, nvox, nvox, nvox, n_joints]
+    """
+    nvox = int(round(grids.shape[1] ** (1 / 3)))
+    coords = grids.reshape(grids.shape[0], nvox, nvox, nvox, 3).unbind(dim=-1)
+    if separable:
+        coords = ops.grid_profiles(coords)
+    return ops.gaussian_targets(keypoints, coords, sigma).permute(0, 2, 3, 4, 1)
+
 class LossHelper:
     def __init__(self, params):
         self.loss_params = params
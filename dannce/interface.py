@@ -6,6 +6,8 @@
 
 import dannce.config as config
 import dannce.engine.inference as inference
+from dannce.engine.data.video import configure_frame_cache, configure_seeking, FRAME_CACHE
+from dannce.engine.data.generator import configure_cpu_threads
 from dannce.engine.models.nets import initialize_train, initialize_model, initialize_com_train
 from dannce.engine.trainer.dannce_trainer import DannceTrainer
 from dannce.engine.trainer.com_trainer import COMTrainer
@@ -31,6 +33,9 @@ def dannce_train(params: Dict):
         shared_args_train,
         shared_args_valid
     ) = config.setup_train(params)
+    configure_frame_cache(params["frame_cache_mb"])
+    configure_seeking(params["use_keyframe_index"])
+    configure_cpu_threads(params["generator_threads"])
 
     # Make the training directory if it does not exist.
     make_folder("dannce_train_dir", params)
@@ -44,8 +49,13 @@ def dannce_train(params: Dict):
     # if not params["multi_gpu_train"]:
     # os.environ["CUDA_VISIBLE_DEVICES"] = params["gpu_id"]
     # deploy GPU devices
-    assert torch.cuda.is_available(), "No available GPU device."
-    
+    # npy volume caches can be generated on CPU-only nodes, see generator_device
+    if params["build_npy_only"]:
+        if not params["use_npy"] and params["dataset"] != "rat7m":
+            raise Exception("build_npy_only requires use_npy.")
+    else:
+        assert torch.cuda.is_available(), "No available GPU device."
+
     if params["multi_gpu_train"]:
         params["gpu_id"] = list(range(torch.cuda.device_count()))
         device = torch.device("cuda") # use all available GPUs
@@ -76,6 +86,10 @@ def dannce_train(params: Dict):
         logger
     )
 
+    if params["build_npy_only"]:
+        logger.info("npy volumes are written, skipping training.")
+        return
+
     # Build network
     logger.info("Initializing Network...")
     model, optimizer, lr_scheduler = initialize_train(params, n_cams, device, logger)
@@ -110,6 +124,9 @@ def dannce_predict(params: Dict):
     # Because CUDA_VISBILE_DEVICES is already set to a single GPU, the gpu_id here should be "0"
     device = "cuda:0"
     params, valid_params = config.setup_predict(params)
+    configure_frame_cache(params["frame_cache_mb"])
+    configure_seeking(params["use_keyframe_index"])
+    configure_cpu_threads(params["generator_threads"])
     predict_generator, predict_generator_sil, camnames, partition = make_dataset_inference(params, valid_params)
 
     # model = build_model(params, camnames)
@@ -120,17 +137,26 @@ def dannce_predict(params: Dict):
     model.load_state_dict(torch.load(params["dannce_predict_model"])['state_dict'])
     model.eval()
 
-    save_data = inference.infer_dannce(
-        predict_generator,
-        params,
-        model,
-        partition,
-        device,
-        params["n_markers"],
-        predict_generator_sil,
-        save_heatmaps=False
-    )
+    try:
+        save_data = inference.infer_dannce(
+            predict_generator,
+            params,
+            model,
+            partition,
+            device,
+            params["n_markers"],
+            predict_generator_sil,
+            save_heatmaps=params["save_heatmaps"]
+        )
+    finally:
+        predict_generator.close()
+        if predict_generator_sil is not None:
+            predict_generator_sil.close()
     inference.save_results(params, save_data)
+    # the exported file holds every prediction of the store
+    inference.discard_prediction_store(params)
+    if FRAME_CACHE.enabled:
+        print("Frame cache: {}".format(FRAME_CACHE.stats()))
 
 def com_train(params: Dict):
     """Train COM network
@@ -138,6 +164,8 @@ def com_train(params: Dict):
         params (Dict): Parameters dictionary.
     """
     params, train_params, valid_params = config.setup_com_train(params)
+    configure_frame_cache(params["frame_cache_mb"])
+    configure_seeking(params["use_keyframe_index"])
 
     # make the train directory if does not exist
     make_folder("com_train_dir", params)
@@ -187,6 +215,8 @@ def com_predict(params):
 
     device = "cuda:0"
     params, predict_params = config.setup_com_predict(params)
+    configure_frame_cache(params["frame_cache_mb"])
+    configure_seeking(params["use_keyframe_index"])
     predict_generator, params, partition, camera_mats, cameras, datadict = make_dataset_com_inference(params, predict_params)
 
     print("Initializing Network...")
@@ -203,22 +233,27 @@ def com_predict(params):
         ]
     ) if params["max_num_samples"] != "max" else len(predict_generator)
 
-    save_data = inference.infer_com(
-        params["start_sample"],
-        endIdx,
-        predict_generator,
-        params,
-        model,
-        partition,
-        save_data,
-        camera_mats,
-        cameras,
-        device
-    )
+    try:
+        save_data = inference.infer_com(
+            params["start_sample"],
+            endIdx,
+            predict_generator,
+            params,
+            model,
+            partition,
+            save_data,
+            camera_mats,
+            cameras,
+            device
+        )
+    finally:
+        predict_generator.close()
 
     filename = "com3d" if params["max_num_samples"] != "max" else "com3d%d" % (params["start_sample"])
     processing.save_COM_checkpoint(
         save_data, params["com_predict_dir"], datadict, cameras, params, file_name=filename
     )
+    if FRAME_CACHE.enabled:
+        print("Frame cache: {}".format(FRAME_CACHE.stats()))
 
     print("done!")
\ No newline at end of file
@@ -6,12 +6,13 @@
 import pandas as pd
 import json
 from copy import deepcopy
-from typing import Dict, Text
+from typing import Dict, List, Text
 import torch
 
 from dannce.engine.data import serve_data_DANNCE, dataset, generator, processing
 from dannce.engine.models.segmentation import get_instance_segmentation_model
 from dannce.engine.data.processing import _DEFAULT_SEG_MODEL, mask_coords_outside_volume
+from dannce.engine.data.video import FrameStore, build_keyframe_indexes, extract_labeled_frames
 
 import imageio
 from tqdm import tqdm
@@ -147,6 +148,8 @@ def make_dataset(
     
     # initialize needed videos
     vids = processing.initialize_all_vids(params, datadict, vid_exps, pathonly=True)
+    if params["use_keyframe_index"]:
+        build_keyframe_indexes(vids)
 
     base_params = {
         **base_params,
@@ -461,6 +464,51 @@ def _make_data_npy(
 
     return train_generator, valid_generator
 
+def attach_frame_store(params: Dict, datadict: Dict, generators: List, logger):
+    """Serve the labeled frames of the generators from a pre-extracted frame store.
+
+    The store in params["frame_store_dir"] is (re-)extracted when it is
+    missing, does not cover all frames referenced by datadict, or was
+    extracted with a crop that does not contain the generators' crop.
+
+    Args:
+        params (Dict): Parameters dictionary.
+        datadict (Dict): Label dictionary shared by the generators.
+        generators (List): Generators reading frames through a LoadVideoFrame.
+        logger: Logger.
+    """
+    store_dir = params["frame_store_dir"]
+    if store_dir is None or params["immode"] != "vid":
+        return
+
+    gen = generators[0]
+    store = FrameStore(store_dir) if FrameStore.exists(store_dir) else None
+    if store is not None and not store.serves_crop(gen.crop_height, gen.crop_width):
+        logger.warning(
+            "Frame store {} was extracted with crop {}, {}, which does not contain "
+            "crop {}, {}. Extracting it again".format(
+                store_dir, store.crop_height, store.crop_width, gen.crop_height, gen.crop_width
+            )
+        )
+        store = None
+    if store is None or not store.covers(datadict):
+        # release the memory maps of the files about to be rewritten
+        store = None
+        logger.info("Extracting labeled frames into {}".format(store_dir))
+        store = extract_labeled_frames(
+            datadict,
+            gen.vidreaders,
+            gen._N_VIDEO_FRAMES,
+            store_dir,
+            crop_height=gen.crop_height,
+            crop_width=gen.crop_width,
+            predict_flag=gen.predict_flag,
+        )
+    logger.info("Loading labeled frames from {}".format(store_dir))
+    for gen in generators:
+        gen.load_frame.frame_store = store
+
+
 def _make_data_mem(        
         params, base_params, shared_args, shared_args_train, shared_args_valid,
         datadict, datadict_3d, com3d_dict, 
@@ -480,7 +528,7 @@ def _make_data_mem(
 
     spec_params = {
         "channel_combo":  params["channel_combo"],
-        "expval": params["expval"],
+        "expval": params["expval"] or params["max_targets_on_device"],
     }
 
     valid_params = {**base_params, **spec_params}
@@ -503,6 +551,7 @@ def _make_data_mem(
 
     train_generator = genfunc(*train_gen_params, **valid_params)
     valid_generator = genfunc(*valid_gen_params, **valid_params)
+    attach_frame_store(params, datadict, [train_generator, valid_generator], logger)
 
     # load everything into memory
     X_train, X_train_grid, y_train = processing.load_volumes_into_mem(
@@ -617,7 +666,9 @@ def get_segmentation_model(params, valid_params, vids):
     checkpoints = torch.load(_DEFAULT_SEG_MODEL)["state_dict"]
     segmentation_model.load_state_dict(checkpoints)
     segmentation_model.eval()
-    segmentation_model = segmentation_model.to("cuda:0")
+    segmentation_model = segmentation_model.to(
+        generator.generator_device(device=valid_params.get("device", None))
+    )
 
     return segmentation_model, valid_params_sil
 
@@ -732,6 +783,8 @@ def make_dataset_inference(params, valid_params):
         valid_params_sil["vidreaders"] = vids_sil
         valid_params_sil["norm_im"] = False
         valid_params_sil["expval"] = True
+        # silhouettes are post-processed in numpy
+        valid_params_sil["tensor_output"] = False
 
         predict_generator_sil = generator.DataGenerator_3Dconv(
             *predict_params,
@@ -767,6 +820,8 @@ def make_data_com(params, train_params, valid_params, logger):
     vids = {}
     for e in range(num_experiments):
         vids = processing.initialize_vids(params, datadict, e, vids, pathonly=True)
+    if params["use_keyframe_index"]:
+        build_keyframe_indexes(vids)
 
     train_params = {
         **train_params,
@@ -806,6 +861,7 @@ def make_data_com(params, train_params, valid_params, logger):
         vids,
         **valid_params
     )
+    attach_frame_store(params, labels, [train_generator, valid_generator], logger)
 
     logger.info("Loading data")
     ims_train = np.zeros(
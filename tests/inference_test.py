@@ -0,0 +1,101 @@
+import threading
+import time
+
+from absl.testing import absltest
+import numpy as np
+import torch
+
+from dannce.engine import inference
+
+BATCH_SIZE = 3
+N_VOX = 4
+
+
+def generate(i: int):
+    """Deterministic batch i, generated in a random amount of time so that
+    concurrent workers finish out of order.
+    """
+    rng = np.random.default_rng(i)
+    time.sleep(rng.uniform(0, 0.02))
+    vols = torch.as_tensor(
+        rng.normal(size=(BATCH_SIZE, N_VOX, N_VOX, N_VOX, 3)), dtype=torch.float32
+    )
+    grids = torch.as_tensor(rng.normal(size=(BATCH_SIZE, N_VOX ** 3, 3)), dtype=torch.float32)
+    targets = ["%d_%d" % (i, b) for b in range(BATCH_SIZE)]
+    return vols, grids, targets
+
+
+def predict(vols, grids):
+    """Per-sample outputs, as the network computes them."""
+    return {
+        "pred": vols.sum(dim=(1, 2, 3)),
+        "grid": grids.mean(dim=1),
+    }
+
+
+class Recorder:
+    def __init__(self):
+        self.records = {}
+        self.order = []
+        self._lock = threading.Lock()
+
+    def store(self, pred, targets, i, idx):
+        with self._lock:
+            self.order.append(idx)
+            for b, target in enumerate(targets):
+                self.records[target] = (
+                    i,
+                    idx,
+                    pred["pred"][b].numpy().copy(),
+                    pred["grid"][b].numpy().copy(),
+                )
+
+
+def run_serial(batch_indices):
+    recorder = Recorder()
+    for idx, i in enumerate(batch_indices):
+        vols, grids, targets = generate(i)
+        recorder.store(predict(vols, grids), targets, i, idx)
+    return recorder
+
+
+class InferencePipelineTest(absltest.TestCase):
+    def test_matches_serial(self):
+        batch_indices = list(range(5, 25))
+        expected = run_serial(batch_indices)
+        for n_workers, max_batches in [(1, 1), (4, 3), (8, 8)]:
+            recorder = Recorder()
+            pipeline = inference.InferencePipeline(
+                generate, predict, recorder.store, n_workers=n_workers, max_batches=max_batches
+            )
+            pipeline.run(batch_indices)
+
+            # results are stored in batch order, whatever order they are generated in
+            self.assertEqual(recorder.order, list(range(len(batch_indices))))
+            self.assertEqual(sorted(recorder.records), sorted(expected.records))
+            for target, (i, idx, pred, grid) in expected.records.items():
+                i_, idx_, pred_, grid_ = recorder.records[target]
+                self.assertEqual((i_, idx_), (i, idx))
+                np.testing.assert_allclose(pred_, pred, rtol=1e-6)
+                np.testing.assert_allclose(grid_, grid, rtol=1e-6)
+            self.assertEqual(pipeline.n_batches, len(batch_indices))
+
+    def test_generation_error_is_raised(self):
+        def failing_generate(i):
+            if i == 3:
+                raise ValueError("cannot generate batch 3")
+            return generate(i)
+
+        recorder = Recorder()
+        pipeline = inference.InferencePipeline(
+            failing_generate, predict, recorder.store, n_workers=4, max_batches=2
+        )
+        with self.assertRaisesRegex(ValueError, "batch 3"):
+            pipeline.run(list(range(10)))
+        # batches before the failing one are kept
+        self.assertEqual(recorder.order, list(range(len(recorder.order))))
+        self.assertLessEqual(len(recorder.order), 3)
+
+
+if __name__ == "__main__":
+    absltest.main()
@@ -0,0 +1,113 @@
+import os
+import tempfile
+
+from absl.testing import absltest
+import numpy as np
+
+from dannce.engine.data import io
+
+SHAPE = (3, 8, 8, 8)
+
+
+def make_heatmaps(seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(size=SHAPE).astype(np.float32)
+
+
+class PredictionStoreTest(absltest.TestCase):
+    def test_resume_and_settings_change(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = io.PredictionStore(path, meta={"nvox": 64}, batches_per_chunk=2)
+            for batch in range(3):
+                store.append(batch, {batch: "pred%d" % batch})
+            store.flush()
+
+            store = io.PredictionStore(path, meta={"nvox": 64})
+            data, batches = store.load()
+            self.assertEqual(batches, {0, 1, 2})
+            self.assertEqual(data, {0: "pred0", 1: "pred1", 2: "pred2"})
+
+            store = io.PredictionStore(path, meta={"nvox": 80})
+            self.assertEqual(store.load(), ({}, set()))
+
+    def test_clear(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = io.PredictionStore(path)
+            store.append(0, {0: "pred0"})
+            store.flush()
+            store.append(1, {1: "pred1"})
+            store.clear()
+            store.append(2, {2: "pred2"})
+            store.flush()
+            self.assertEqual(io.PredictionStore(path).load(), ({2: "pred2"}, {2}))
+
+
+class HeatmapArchiveTest(absltest.TestCase):
+    def test_round_trip(self):
+        heatmaps = [make_heatmaps(seed) for seed in range(4)]
+        for encoding, atol in [("float16", 1e-2), ("uint8", 0.05)]:
+            with tempfile.TemporaryDirectory() as path:
+                # tiny shards, to write several of them
+                archive = io.HeatmapArchive(path, encoding=encoding, shard_mb=1e-3)
+                for n, h in enumerate(heatmaps):
+                    archive.append("sample%d" % n, h)
+                archive.close()
+
+                reader = io.HeatmapArchiveReader(path)
+                self.assertLen(reader, len(heatmaps))
+                self.assertGreater(
+                    len([f for f in os.listdir(path) if f.startswith("shard_")]), 1
+                )
+                for n, h in enumerate(heatmaps):
+                    np.testing.assert_allclose(reader["sample%d" % n], h, atol=atol)
+
+    def test_topk_keeps_largest_voxels(self):
+        h = make_heatmaps()
+        with tempfile.TemporaryDirectory() as path:
+            archive = io.HeatmapArchive(path, encoding="topk", k=5)
+            archive.append(0, h)
+            archive.close()
+            result = io.HeatmapArchiveReader(path)[0]
+
+        flat, result = h.reshape(SHAPE[0], -1), result.reshape(SHAPE[0], -1)
+        for j in range(SHAPE[0]):
+            top = np.argsort(flat[j])[-5:]
+            np.testing.assert_array_equal(result[j, top], flat[j, top])
+            rest = np.setdiff1d(np.arange(flat.shape[1]), top)
+            np.testing.assert_array_equal(result[j, rest], flat[j].min())
+
+    def test_topk_larger_than_heatmaps(self):
+        h = make_heatmaps()
+        n_voxels = int(np.prod(SHAPE[1:]))
+        with tempfile.TemporaryDirectory() as path:
+            archive = io.HeatmapArchive(path, encoding="topk", k=n_voxels + 10)
+            archive.append(0, h)
+            archive.close()
+            # reopening with the requested k matches the clamped one
+            archive = io.HeatmapArchive(path, encoding="topk", k=n_voxels + 10)
+            archive.append(1, h)
+            archive.close()
+
+            reader = io.HeatmapArchiveReader(path)
+            self.assertEqual(reader.k, n_voxels)
+            for sampleID in [0, 1]:
+                self.assertEqual(reader.index[str(sampleID)]["k"], n_voxels)
+                np.testing.assert_array_equal(reader[sampleID], h.astype(np.float32))
+
+    def test_reopen_appends(self):
+        with tempfile.TemporaryDirectory() as path:
+            archive = io.HeatmapArchive(path)
+            archive.append(0, make_heatmaps(0))
+            archive.close()
+            archive = io.HeatmapArchive(path)
+            archive.append(0, make_heatmaps(1))
+            archive.append(1, make_heatmaps(2))
+            archive.close()
+
+            reader = io.HeatmapArchiveReader(path)
+            self.assertEqual(reader.sample_ids(), ["0", "1"])
+            np.testing.assert_allclose(reader[0], make_heatmaps(1), atol=1e-2)
+
+
+if __name__ == "__main__":
+    absltest.main()
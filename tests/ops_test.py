@@ -0,0 +1,199 @@
+from absl.testing import absltest
+import numpy as np
+import torch
+
+import dannce.engine.data.ops as ops
+
+N_VOX = 16
+IM_H, IM_W = 48, 64
+
+
+def make_image_and_points(seed: int = 0):
+    """Random uint8 image and flattened projected grid points, including
+    points on and beyond the image borders.
+    """
+    rng = np.random.default_rng(seed)
+    im = rng.integers(0, 256, size=(IM_H, IM_W, 3), dtype=np.uint8)
+    pts = np.stack(
+        (
+            rng.uniform(-5, IM_W + 5, size=N_VOX ** 3),
+            rng.uniform(-5, IM_H + 5, size=N_VOX ** 3),
+        ),
+        axis=1,
+    )
+    pts[:4] = [[0, 0], [IM_W - 1, IM_H - 1], [IM_W - 1, 0], [0, IM_H - 1]]
+    return im, torch.as_tensor(pts, dtype=torch.float32)
+
+
+class SampleGridTest(absltest.TestCase):
+    def test_grid_sample_matches_linear(self):
+        im, pts = make_image_and_points()
+        expected = ops.sample_grid(im, pts, "cpu", method="linear")
+        result = ops.sample_grid(im, pts, "cpu", method="grid_sample")
+        self.assertEqual(tuple(result.shape), tuple(expected.shape))
+        np.testing.assert_allclose(
+            result.numpy(), expected.numpy(), rtol=0, atol=1e-3
+        )
+
+    def test_corner_weights(self):
+        # the (y0, x1) corner, read at x = 0.3, y = 0.6
+        im = np.zeros((4, 4, 1), dtype=np.uint8)
+        im[0, 1] = 100
+        pts = torch.zeros((8, 2), dtype=torch.float32)
+        pts[:, 0], pts[:, 1] = 0.3, 0.6
+        # linear weights this corner by (x1 - x) * (y - y0), bilinear_exact by
+        # (x - x0) * (y1 - y)
+        for method, value in [("linear", 42), ("grid_sample", 42), ("bilinear_exact", 12)]:
+            result = ops.sample_grid(im, pts, "cpu", method=method)
+            np.testing.assert_allclose(result.numpy(), value, rtol=0, atol=1e-3)
+            result = ops.sample_grid_batch(
+                torch.as_tensor(im[None]), pts[None], "cpu", method=method
+            )
+            np.testing.assert_allclose(result.numpy(), value, rtol=0, atol=1e-3)
+
+    def test_grid_sample_matches_linear_integer_points(self):
+        im, _ = make_image_and_points()
+        ys, xs = np.meshgrid(np.arange(IM_H), np.arange(IM_W), indexing="ij")
+        pts = np.stack((xs.ravel(), ys.ravel()), axis=1)
+        n = int(np.floor(len(pts) ** (1 / 3.0))) ** 3
+        pts = torch.as_tensor(pts[:n], dtype=torch.float32)
+        expected = ops.sample_grid(im, pts, "cpu", method="linear")
+        result = ops.sample_grid(im, pts, "cpu", method="grid_sample")
+        np.testing.assert_allclose(
+            result.numpy(), expected.numpy(), rtol=0, atol=1e-3
+        )
+
+    def test_batched_grid_sample_matches_linear(self):
+        ims, pts = zip(*[make_image_and_points(seed) for seed in range(3)])
+        expected = torch.cat(
+            [ops.sample_grid(im, p, "cpu", method="linear") for im, p in zip(ims, pts)]
+        )
+        for method in ["linear", "grid_sample"]:
+            result = ops.sample_grid_batch(
+                torch.as_tensor(np.stack(ims)), torch.stack(pts), "cpu", method=method
+            )
+            np.testing.assert_allclose(
+                result.numpy(), expected.numpy(), rtol=0, atol=1e-3
+            )
+
+
+class CameraBankTest(absltest.TestCase):
+    def test_bank_projection_matches_camera_params(self):
+        rng = np.random.default_rng(0)
+        K = np.array([[800.0, 0, 0], [0.5, 820.0, 0], [320.0, 240.0, 1]])
+        params = {
+            camname: {
+                "K": K,
+                "R": np.linalg.qr(rng.normal(size=(3, 3)))[0],
+                "t": np.array([[0.0, 0.0, 1000.0]]) + rng.normal(size=(1, 3)),
+                "RDistort": rng.normal(scale=0.05, size=(1, n_radial)),
+                "TDistort": rng.normal(scale=0.01, size=(1, 2)),
+            }
+            for camname, n_radial in [("Camera1", 2), ("Camera2", 3)]
+        }
+        bank = ops.CameraBank({0: params}, {0: list(params)}, "cpu")
+        pts = torch.as_tensor(rng.uniform(-100, 100, size=(64, 3)), dtype=torch.float32)
+        for camname, p in params.items():
+            M = torch.as_tensor(ops.camera_matrix(p["K"], p["R"], p["t"]), dtype=torch.float32)
+            proj = ops.project_to2d(pts, M, "cpu")
+            expected = ops.distortPoints(
+                proj[:, :2], p["K"], np.squeeze(p["RDistort"]), np.squeeze(p["TDistort"]), "cpu"
+            ).transpose(0, 1)
+            cam = bank.camera(0, camname)
+            proj = ops.project_to2d(pts, cam["M"], "cpu")
+            result = ops.distortPoints_batch(
+                proj[None, :, :2], cam["K"][None], cam["RDistort"][None], cam["TDistort"][None], "cpu"
+            )[0]
+            np.testing.assert_allclose(result.numpy(), expected.numpy(), rtol=1e-4, atol=1e-2)
+
+
+class ProjectionRoiTest(absltest.TestCase):
+    def test_roi_crop_preserves_samples(self):
+        im, pts = make_image_and_points()
+        # including grids entirely left of, above, and right of / below the image
+        for scale, shift in [(1.0, 0.0), (0.2, 10.0), (0.1, -20.0), (0.1, -100.0), (0.1, 200.0)]:
+            p = pts * scale + shift
+            roi = ops.projection_roi(p, im.shape)
+            roi_im, roi_pts = ops.crop_to_roi(im, p, roi)
+            for method in ["nearest", "linear", "grid_sample", "bilinear_exact"]:
+                expected = ops.sample_grid(im, p, "cpu", method=method)
+                result = ops.sample_grid(roi_im, roi_pts, "cpu", method=method)
+                np.testing.assert_allclose(
+                    result.numpy(), expected.numpy(), rtol=0, atol=1e-3
+                )
+
+
+class MipSamplingTest(absltest.TestCase):
+    def test_level_matches_voxel_footprint(self):
+        offsets = torch.arange(N_VOX, dtype=torch.float32)
+        for spacing, level in [(0.5, 0), (1.5, 0), (2.5, 1), (9.0, 3), (100.0, ops.MAX_MIP_LEVEL)]:
+            y, x, z = torch.meshgrid(offsets, offsets, offsets)
+            pts = torch.stack((x.ravel() * spacing, (y.ravel() + z.ravel()) * spacing), axis=1)
+            self.assertEqual(ops.mip_level(pts), level)
+
+    def test_constant_image_is_preserved(self):
+        im = np.full((IM_H, IM_W, 1), 77, dtype=np.uint8)
+        _, pts = make_image_and_points()
+        level_im = ops.downsample_image(im, 2)
+        self.assertEqual(level_im.shape, (IM_H // 4, IM_W // 4, 1))
+        level_pts = ops.rescale_coords(pts, im.shape, level_im.shape)
+        self.assertGreaterEqual(float(level_pts.min()), 0)
+        self.assertLessEqual(float(level_pts[:, 0].max()), level_im.shape[1] - 1)
+        self.assertLessEqual(float(level_pts[:, 1].max()), level_im.shape[0] - 1)
+        for method in ["nearest", "bilinear_exact"]:
+            result = ops.sample_grid(level_im, level_pts, "cpu", method=method)
+            np.testing.assert_allclose(result.numpy(), 77, rtol=0, atol=1e-3)
+        # linear zeroes the corners past the last row and column
+        inside = (level_pts[:, 0] < level_im.shape[1] - 1) & (
+            level_pts[:, 1] < level_im.shape[0] - 1
+        )
+        for method in ["linear", "grid_sample"]:
+            result = ops.sample_grid(level_im, level_pts, "cpu", method=method)
+            result = result[0].permute(1, 2, 3, 0).reshape(-1, 1)
+            np.testing.assert_allclose(result[inside].numpy(), 77, rtol=0, atol=1e-3)
+
+
+class GaussianTargetsTest(absltest.TestCase):
+    def test_separable_targets_match_dense(self):
+        rng = np.random.default_rng(0)
+        offsets = torch.linspace(-60, 60, N_VOX)
+        # generator grid layout: y along the first axis, x along the second
+        y, x, z = torch.meshgrid(offsets, offsets + 5, offsets - 5)
+        coords = [c[None] + 10 for c in (x, y, z)]
+        centers = torch.as_tensor(rng.uniform(-50, 50, size=(1, 3, 4)), dtype=torch.float32)
+        sigma = 10
+
+        expected = torch.stack(
+            [
+                torch.exp(
+                    -(
+                        (coords[0][0] - centers[0, 0, j]) ** 2
+                        + (coords[1][0] - centers[0, 1, j]) ** 2
+                        + (coords[2][0] - centers[0, 2, j]) ** 2
+                    )
+                    / (2 * sigma ** 2)
+                )
+                for j in range(centers.shape[-1])
+            ]
+        )[None]
+        result = ops.gaussian_targets(centers, ops.grid_profiles(coords), sigma)
+        self.assertEqual(tuple(result.shape), tuple(expected.shape))
+        np.testing.assert_allclose(
+            result.numpy(), expected.numpy(), rtol=1e-4, atol=1e-6
+        )
+
+
+    def test_rotated_grids_are_not_separable(self):
+        offsets = torch.linspace(-60, 60, N_VOX)
+        y, x, z = torch.meshgrid(offsets, offsets, offsets)
+        coords = [c[None] for c in (x, y, z)]
+        self.assertTrue(ops.profiles_match(coords, ops.grid_profiles(coords)))
+
+        # rotate about z by 30 degrees
+        cos, sin = np.cos(np.pi / 6), np.sin(np.pi / 6)
+        rotated = [cos * coords[0] - sin * coords[1], sin * coords[0] + cos * coords[1], coords[2]]
+        self.assertFalse(ops.profiles_match(rotated, ops.grid_profiles(rotated)))
+
+
+if __name__ == "__main__":
+    absltest.main()
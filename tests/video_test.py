@@ -0,0 +1,423 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+
+from absl.testing import absltest
+import imageio
+import numpy as np
+
+from dannce.engine.data import video
+
+CAMNAME = "Camera1"
+CHUNK_FRAMES = 20
+N_FRAMES = 2 * CHUNK_FRAMES
+FRAME_HEIGHT, FRAME_WIDTH = 48, 64
+
+
+def make_frame(height: int = 40, width: int = 60, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+
+
+def make_video_frame(ind: int):
+    """Smooth frame whose content identifies its index after compression."""
+    y, x = np.mgrid[0:FRAME_HEIGHT, 0:FRAME_WIDTH]
+    frame = np.stack(
+        [(x * 4 + ind * 6) % 256, (y * 5 + ind * 3) % 256, np.full_like(x, ind * 6)],
+        axis=-1,
+    )
+    return frame.astype(np.uint8)
+
+
+def write_videos(video_dir: str):
+    """Write N_FRAMES frames as two chunks of CHUNK_FRAMES frames, with a
+    keyframe every 8 frames, so that seeks land inside GOPs.
+    """
+    os.makedirs(os.path.join(video_dir, CAMNAME))
+    vidreaders, chunks = {CAMNAME: {}}, {CAMNAME: []}
+    for first in range(0, N_FRAMES, CHUNK_FRAMES):
+        keyname = os.path.join(CAMNAME, str(first) + ".mp4")
+        path = os.path.join(video_dir, keyname)
+        writer = imageio.get_writer(
+            path, fps=30, macro_block_size=16, output_params=["-g", "8"]
+        )
+        for ind in range(first, first + CHUNK_FRAMES):
+            writer.append_data(make_video_frame(ind))
+        writer.close()
+        vidreaders[CAMNAME][keyname] = path
+        chunks[CAMNAME].append(first)
+    return vidreaders, chunks
+
+
+class RecropTest(absltest.TestCase):
+    def test_matches_cropping_the_frame(self):
+        frame = make_frame()
+        stored_crop = ((5, 35), (10, 50))
+        stored = frame[5:35, 10:50]
+        for crop in [((5, 35), (10, 50)), ((10, 30), (20, 40))]:
+            np.testing.assert_array_equal(
+                video._recrop(stored, stored_crop, crop),
+                frame[crop[0][0] : crop[0][1], crop[1][0] : crop[1][1]],
+            )
+        self.assertIsNone(video._recrop(stored, stored_crop, ((0, 30), (10, 50))))
+        self.assertIsNone(video._recrop(stored, stored_crop, ((5, 36), (10, 50))))
+        self.assertIsNone(video._recrop(stored, stored_crop, (None, (10, 50))))
+
+    def test_crop_past_the_frame_is_clipped(self):
+        # a small camera of a rig whose crop was inferred from a larger one
+        frame = make_frame()
+        stored_crop = ((0, 64), (0, 80))
+        stored = frame[0:64, 0:80]
+        self.assertEqual(stored.shape[:2], frame.shape[:2])
+        for crop in [((0, 64), (0, 80)), ((0, 100), (0, 100)), ((10, 64), (20, 80))]:
+            np.testing.assert_array_equal(
+                video._recrop(stored, stored_crop, crop),
+                frame[crop[0][0] : crop[0][1], crop[1][0] : crop[1][1]],
+            )
+        np.testing.assert_array_equal(
+            video._recrop(stored, stored_crop, (None, None)), frame
+        )
+
+
+class FrameCacheTest(absltest.TestCase):
+    def test_evicts_least_recently_used(self):
+        frame = np.zeros(100, dtype=np.uint8)
+        cache = video.FrameCache(max_bytes=250)
+        cache.put("a", frame)
+        cache.put("b", frame)
+        self.assertIs(cache.get("a"), frame)
+        cache.put("c", frame)
+        # "b" was used least recently
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (3, 1))
+        self.assertEqual((stats["frames"], stats["nbytes"]), (2, 200))
+
+    def test_budget(self):
+        cache = video.FrameCache(max_bytes=250)
+        cache.put("large", np.zeros(300, dtype=np.uint8))
+        self.assertIsNone(cache.get("large"))
+        self.assertFalse(video.FrameCache().enabled)
+
+        for key in "abc":
+            cache.put(key, np.zeros(100, dtype=np.uint8))
+        cache.resize(100)
+        self.assertEqual(cache.stats()["frames"], 1)
+        self.assertIsNotNone(cache.get("c"))
+        cache.clear()
+        self.assertEqual(cache.stats()["nbytes"], 0)
+        self.assertIsNone(cache.get("c"))
+
+
+class ChunkIndexTest(absltest.TestCase):
+    def test_resolve(self):
+        index = video.ChunkIndex(
+            [0, 100, 250], ["a.mp4", None, "c.mp4"], ["a", "b", "c"]
+        )
+        self.assertEqual(index.resolve(0), ("a.mp4", 0))
+        self.assertEqual(index.resolve(99), ("a.mp4", 99))
+        self.assertEqual(index.resolve(250), ("c.mp4", 0))
+        self.assertEqual(index.resolve(1000), ("c.mp4", 750))
+        with self.assertRaises(KeyError):
+            index.resolve(100)
+        with self.assertRaises(IndexError):
+            video.ChunkIndex([10, 20], ["a.mp4", "b.mp4"], ["a", "b"]).resolve(5)
+
+    def test_from_chunks(self):
+        vidreaders = {
+            os.path.join(CAMNAME, "0.mp4"): "/videos/0.mp4",
+            os.path.join(CAMNAME, "20.mp4"): "/videos/20.mp4",
+        }
+        index = video.ChunkIndex.from_chunks(CAMNAME, [0, 20], vidreaders)
+        self.assertEqual(index.resolve(19), ("/videos/0.mp4", 19))
+        self.assertEqual(index.resolve(20), ("/videos/20.mp4", 0))
+
+
+class VideoTestCase(absltest.TestCase):
+    """Reads videos written to a temporary directory, and compares the frames
+    returned by the loaders to ones decoded by seeking to each frame.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.video_dir = tempfile.mkdtemp()
+        cls.vidreaders, cls.chunks = write_videos(cls.video_dir)
+        cls.reference = {
+            predict_flag: cls.read_reference(predict_flag)
+            for predict_flag in [False, True]
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.video_dir)
+        super().tearDownClass()
+
+    @classmethod
+    def make_loader(cls, predict_flag=False, **kwargs):
+        kwargs.setdefault("frame_cache", video.FrameCache(0))
+        kwargs.setdefault("use_keyframe_index", False)
+        return video.LoadVideoFrame(
+            cls.chunks, cls.vidreaders, {0: [CAMNAME]}, predict_flag, **kwargs
+        )
+
+    @classmethod
+    def read_reference(cls, predict_flag):
+        # every request seeks, and the frames are read backwards
+        loader = cls.make_loader(predict_flag, max_stream_gap=0, preopen_frames=0)
+        frames = {
+            ind: np.array(loader.load_vid_frame(ind, CAMNAME))
+            for ind in reversed(range(N_FRAMES))
+        }
+        loader.close()
+        return frames
+
+    def assertMatchesReference(self, frames, predict_flag=False):
+        for ind, frame in frames.items():
+            np.testing.assert_array_equal(
+                frame, self.reference[predict_flag][ind], err_msg=f"frame {ind}"
+            )
+
+
+class LoadVideoFrameTest(VideoTestCase):
+    def test_reference_frames_are_distinct(self):
+        frames = self.reference[False]
+        self.assertEqual(frames[0].shape, (FRAME_HEIGHT, FRAME_WIDTH, 3))
+        for ind in range(1, N_FRAMES):
+            self.assertFalse(np.array_equal(frames[ind - 1], frames[ind]))
+
+    def test_streaming_matches_seeking(self):
+        for predict_flag in [False, True]:
+            loader = self.make_loader(predict_flag)
+            frames = {ind: loader.load_vid_frame(ind, CAMNAME) for ind in range(N_FRAMES)}
+            # a forward jump within the stream gap, and a backward one
+            frames[CHUNK_FRAMES + 15] = loader.load_vid_frame(CHUNK_FRAMES + 15, CAMNAME)
+            frames[3] = loader.load_vid_frame(3, CAMNAME)
+            frames[9] = loader.load_vid_frame(9, CAMNAME)
+            if not predict_flag:
+                stats = loader.seek_stats()
+                self.assertLess(stats["seeks"], stats["requests"] // 2)
+            loader.close()
+            self.assertMatchesReference(frames, predict_flag)
+
+    def test_random_access_matches_seeking(self):
+        inds = list(range(N_FRAMES)) * 2
+        random.Random(0).shuffle(inds)
+        for max_stream_gap in [0, 8, 64]:
+            loader = self.make_loader(max_stream_gap=max_stream_gap)
+            frames = [(ind, loader.load_vid_frame(ind, CAMNAME)) for ind in inds]
+            loader.close()
+            for ind, frame in frames:
+                self.assertMatchesReference({ind: frame})
+
+    def test_reopened_reader_is_not_streamed(self):
+        # with a single reader per camera, alternating between chunks evicts
+        # the reader whose last frame was recorded
+        loader = self.make_loader(n_readers=1, preopen_frames=0)
+        frames = []
+        for ind in range(CHUNK_FRAMES // 2):
+            for first in [0, CHUNK_FRAMES]:
+                frames.append((first + ind, loader.load_vid_frame(first + ind, CAMNAME)))
+        loader.close()
+        self.assertEqual(loader.last_frame, {})
+        for ind, frame in frames:
+            self.assertMatchesReference({ind: frame})
+
+    def test_keyframe_index_matches_seeking(self):
+        if shutil.which("ffprobe") is None:
+            self.skipTest("ffprobe is not installed")
+        loader = self.make_loader(use_keyframe_index=True, max_stream_gap=0)
+        frames = {
+            ind: loader.load_vid_frame(ind, CAMNAME) for ind in reversed(range(N_FRAMES))
+        }
+        loader.close()
+        self.assertMatchesReference(frames)
+        for path in self.vidreaders[CAMNAME].values():
+            self.assertTrue(os.path.isfile(video.keyframe_index_path(path)))
+
+    def test_concurrent_requests(self):
+        loader = self.make_loader()
+        results = [[] for _ in range(4)]
+
+        def read(out, offset):
+            for i in range(N_FRAMES):
+                ind = (i + offset) % N_FRAMES
+                out.append((ind, np.array(loader.load_vid_frame(ind, CAMNAME))))
+
+        threads = [
+            threading.Thread(target=read, args=(out, 5 * i))
+            for i, out in enumerate(results)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        loader.close()
+        for out in results:
+            self.assertLen(out, N_FRAMES)
+            for ind, frame in out:
+                self.assertMatchesReference({ind: frame})
+
+    def test_frame_cache(self):
+        cache = video.FrameCache(1 << 20)
+        loader = self.make_loader(frame_cache=cache)
+        first = loader.load_vid_frame(5, CAMNAME)
+        self.assertIs(loader.load_vid_frame(5, CAMNAME), first)
+        loader.close()
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertMatchesReference({5: first})
+
+
+class ReaderPoolTest(VideoTestCase):
+    def test_close_stops_the_background_thread(self):
+        n_threads = threading.active_count()
+        for _ in range(3):
+            loader = self.make_loader(n_readers=1, preopen_frames=10)
+            for ind in range(0, N_FRAMES, 3):
+                loader.load_vid_frame(ind, CAMNAME)
+            loader.close()
+            self.assertIsNone(loader.readers._executor)
+            self.assertEqual(loader.readers._readers, {})
+        self.assertLessEqual(threading.active_count(), n_threads)
+
+    def test_reuse_after_close(self):
+        loader = self.make_loader()
+        loader.load_vid_frame(3, CAMNAME)
+        loader.close()
+        frame = loader.load_vid_frame(CHUNK_FRAMES + 3, CAMNAME)
+        loader.close()
+        self.assertMatchesReference({CHUNK_FRAMES + 3: frame})
+
+
+class FramePrefetcherTest(VideoTestCase):
+    def test_serves_the_window_in_any_order(self):
+        loader = self.make_loader()
+        schedule = list(range(N_FRAMES))
+        loader.start_prefetch({CAMNAME: schedule}, depth=4)
+        prefetcher = loader.prefetcher
+        frames = {}
+        for ind in [1, 0, 3, 2]:
+            frames[ind] = prefetcher.get(ind, CAMNAME)
+        # past the window but within the following one: skips frames 4 to 6
+        frames[10] = prefetcher.get(10, CAMNAME)
+        self.assertIsNone(prefetcher.get(5, CAMNAME))
+        # beyond the following window
+        self.assertIsNone(prefetcher.get(30, CAMNAME))
+        self.assertIsNone(prefetcher.get(0, "Camera2"))
+        frames[11] = prefetcher.get(11, CAMNAME)
+        # unscheduled requests fall back to direct decoding
+        frames[5] = loader.load_vid_frame(5, CAMNAME)
+        loader.stop_prefetch()
+        self.assertIsNone(loader.prefetcher)
+        loader.close()
+        self.assertMatchesReference(frames)
+
+    def test_repeated_indices(self):
+        loader = self.make_loader()
+        schedule = [0, 0, 1, 2, 2, 3]
+        loader.start_prefetch({CAMNAME: schedule}, depth=2)
+        frames = [(ind, loader.prefetcher.get(ind, CAMNAME)) for ind in schedule]
+        loader.close()
+        for ind, frame in frames:
+            self.assertIsNotNone(frame)
+            self.assertMatchesReference({ind: frame})
+
+
+class ProcessFrameLoaderTest(VideoTestCase):
+    def make_process_loader(self, **kwargs):
+        return video.ProcessFrameLoader(
+            self.chunks,
+            self.vidreaders,
+            {0: [CAMNAME]},
+            False,
+            frame_cache=video.FrameCache(0),
+            use_keyframe_index=False,
+            **kwargs,
+        )
+
+    def test_matches_seeking(self):
+        loader = self.make_process_loader(n_workers=2, n_slots=4)
+        try:
+            frames = {ind: loader.load_vid_frame(ind, CAMNAME) for ind in range(N_FRAMES)}
+            # frames are copied out of the ring buffer
+            frames[0][:] = 0
+            np.testing.assert_array_equal(
+                loader.load_vid_frame(0, CAMNAME), self.reference[False][0]
+            )
+            frames[0] = loader.load_vid_frame(0, CAMNAME)
+        finally:
+            loader.close()
+        self.assertEqual(loader._cameras, {})
+        self.assertMatchesReference(frames)
+
+    def test_scheduled_tickets(self):
+        loader = self.make_process_loader(n_workers=2, n_slots=4)
+        schedule = list(range(0, N_FRAMES, 2))
+        try:
+            # the first request sizes the ring buffer
+            frames = {0: loader.load_vid_frame(0, CAMNAME)}
+            loader.start_prefetch({CAMNAME: schedule}, depth=8)
+            for ind in schedule[1:6]:
+                frames[ind] = loader.load_vid_frame(ind, CAMNAME)
+            # skipped scheduled frames, and requests outside the schedule
+            for ind in [16, 21, 3, 22, 24]:
+                frames[ind] = loader.load_vid_frame(ind, CAMNAME)
+            scheduled = loader._scheduled[CAMNAME]
+            self.assertLessEqual(len(scheduled.pending), loader.n_slots - 1)
+            self.assertEqual(scheduled.cursor, schedule.index(24) + 1)
+            loader.stop_prefetch()
+            frames[26] = loader.load_vid_frame(26, CAMNAME)
+        finally:
+            loader.close()
+        self.assertMatchesReference(frames)
+
+
+class FrameStoreTest(VideoTestCase):
+    def test_extract_labeled_frames(self):
+        datadict = {
+            i: {"frames": {CAMNAME: ind}} for i, ind in enumerate([25, 3, 7, 3])
+        }
+        crop_height, crop_width = (4, 40), (8, 56)
+        store_dir = os.path.join(self.video_dir, "frame_store")
+        store = video.extract_labeled_frames(
+            datadict, self.vidreaders, self.chunks, store_dir, crop_height, crop_width
+        )
+        self.assertTrue(video.FrameStore.exists(store_dir))
+        self.assertTrue(store.covers(datadict))
+        self.assertFalse(store.covers({0: {"frames": {CAMNAME: 4}}}))
+        self.assertTrue(store.serves_crop((10, 20), (8, 56)))
+        self.assertFalse(store.serves_crop((0, 20), (8, 56)))
+        self.assertFalse(store.serves_crop(None, None))
+
+        for ind in [3, 7, 25]:
+            reference = self.reference[False][ind]
+            np.testing.assert_array_equal(
+                store.get(ind, CAMNAME, crop_height, crop_width),
+                reference[4:40, 8:56],
+            )
+            np.testing.assert_array_equal(
+                store.get(ind, CAMNAME, (10, 20), (30, 50)), reference[10:20, 30:50]
+            )
+        self.assertIsNone(store.get(4, CAMNAME, crop_height, crop_width))
+
+        # loaders serve stored frames without decoding, and decode the others
+        loader = self.make_loader()
+        loader.frame_store = video.FrameStore(store_dir)
+        np.testing.assert_array_equal(
+            loader.load_cropped_frame(7, CAMNAME, crop_height, crop_width),
+            self.reference[False][7][4:40, 8:56],
+        )
+        self.assertEqual(loader.readers._readers, {})
+        np.testing.assert_array_equal(
+            loader.load_cropped_frame(8, CAMNAME, crop_height, crop_width),
+            self.reference[False][8][4:40, 8:56],
+        )
+        loader.close()
+
+
+if __name__ == "__main__":
+    absltest.main()